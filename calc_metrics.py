@@ -1,14 +1,17 @@
 import argparse
 
+import numpy as np
+
 from data_utils import load_data, load_score_file
 from data_utils.metrics import calc_metrics
+from data_utils.prediction_store import is_prediction_store, PredictionReader
 from experiments.exp_def import TaskDefs
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--task_def", type=str, default="experiments/glue/glue_task_def.yml")
 parser.add_argument("--task", type=str)
 parser.add_argument("--std_input", type=str)
-parser.add_argument("--score", type=str)
+parser.add_argument("--score", type=str, help="JSON score file or binary prediction store (.pred)")
 
 
 def generate_golds_predictions_scores(sample_id_2_pred_score_seg_dic, sample_objs):
@@ -30,20 +33,30 @@ def generate_golds_predictions_scores(sample_id_2_pred_score_seg_dic, sample_obj
         scores.extend(score_seg)
     return golds, predictions, scores
 
+
+def gather_golds_predictions_scores(reader, sample_objs):
+    """same as generate_golds_predictions_scores, reading rows of the memory-mapped store at once"""
+    row_index = dict((str(uid), row) for row, uid in enumerate(reader.uids))
+    assert set(str(sample_obj["uid"]) for sample_obj in sample_objs) == set(row_index.keys())
+    golds = [sample_obj["label"] for sample_obj in sample_objs]
+    rows = np.array([row_index[str(sample_obj["uid"])] for sample_obj in sample_objs], dtype=np.int64)
+    predictions = np.asarray(reader.predictions)[rows]
+    scores = reader.scores[rows].reshape(-1)
+    return golds, predictions, scores
+
 args = parser.parse_args()
 
 task_def_path = args.task_def
 task_defs = TaskDefs(task_def_path)
 task_def = task_defs.get_task_def(args.task)
 n_class = task_def.n_class
-sample_id_2_pred_score_seg_dic = load_score_file(args.score, n_class)
-
-data_type = task_def.data_type
-task_type = task_def.task_type
-label_mapper = task_def.label_vocab
-sample_objs = load_data(args.std_input, data_type, task_type, label_mapper)
+sample_objs = load_data(args.std_input, task_def)
 
-golds, predictions, scores = generate_golds_predictions_scores(sample_id_2_pred_score_seg_dic, sample_objs)
+if is_prediction_store(args.score):
+    golds, predictions, scores = gather_golds_predictions_scores(PredictionReader(args.score), sample_objs)
+else:
+    sample_id_2_pred_score_seg_dic = load_score_file(args.score, n_class)
+    golds, predictions, scores = generate_golds_predictions_scores(sample_id_2_pred_score_seg_dic, sample_objs)
 
 metrics = calc_metrics(task_def.metric_meta, golds, predictions, scores)
 print(metrics)
@@ -2,6 +2,7 @@ import json
 import numpy as np
 
 from data_utils.task_def import TaskType, DataFormat
+from data_utils.prediction_store import load_predictions, PredictionReader
 import tasks
 
 def load_data(file_path, task_def):
@@ -61,14 +62,20 @@ def load_data(file_path, task_def):
     return rows
 
 def load_score_file(score_path, n_class):
+    """score_path is a JSON score file or a binary prediction store (data_utils.prediction_store)"""
     sample_id_2_pred_score_seg_dic = {}
-    score_obj = json.loads(open(score_path, encoding="utf-8").read())
-    assert (len(score_obj["scores"]) % len(score_obj["uids"]) == 0) and \
-           (len(score_obj["scores"]) / len(score_obj["uids"]) == n_class), \
-        "scores column size should equal to sample count or multiple of sample count (for classification problem)"
-
-    scores = score_obj["scores"]
-    score_segs = [scores[i * n_class: (i+1) * n_class] for i in range(len(score_obj["uids"]))]
+    score_obj = load_predictions(score_path)
+    if isinstance(score_obj, PredictionReader):
+        assert score_obj.score_width == n_class, \
+            "scores column size should equal to sample count or multiple of sample count (for classification problem)"
+        # rows of the memory-mapped (N, n_class) array
+        score_segs = score_obj.scores
+    else:
+        assert (len(score_obj["scores"]) % len(score_obj["uids"]) == 0) and \
+               (len(score_obj["scores"]) / len(score_obj["uids"]) == n_class), \
+            "scores column size should equal to sample count or multiple of sample count (for classification problem)"
+        scores = score_obj["scores"]
+        score_segs = [scores[i * n_class: (i+1) * n_class] for i in range(len(score_obj["uids"]))]
     for sample_id, pred, score_seg in zip(score_obj["uids"], score_obj["predictions"], score_segs):
         sample_id_2_pred_score_seg_dic[sample_id] = (pred, score_seg)
-    return sample_id_2_pred_score_seg_dic
\ No newline at end of file
+    return sample_id_2_pred_score_seg_dic
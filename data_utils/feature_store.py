@@ -0,0 +1,192 @@
+# Copyright (c) Microsoft. All rights reserved.
+"""Encoder features, streamed batch by batch into binary shards and memory-mapped when reading.
+Written by extractor.py and by train.py --encode_mode.
+
+A store is a directory with:
+    features.{shard}.bin          float16/float32 rows of n_layers * hidden_size values,
+                                  one row per token, or one row per sample when pooled
+    index.bin                     int64 (shard, offset, length) of every sample, in rows
+    uid_offsets.bin / uids.bin    uid string table
+    meta.json                     dtype, layers, pooling, hidden size and shard size
+A new shard is started once the current one holds shard_rows rows; a sample is never split.
+The files are only appended to, so an interrupted export resumes after the last sample
+whose features, index entry and uid were all written.
+"""
+import os
+import json
+import numpy as np
+
+META_FILE = 'meta.json'
+POOLING_MODES = ('cls', 'mean', 'full')
+DTYPES = ('float16', 'float32')
+
+
+def is_feature_store(path):
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+def shard_file(shard):
+    return 'features.{}.bin'.format(shard)
+
+
+def _size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class FeatureWriter(object):
+    def __init__(self, path, layers, hidden_size, pooling='full', dtype='float16', shard_rows=None, resume=False):
+        """shard_rows: rows per shard, None for a single shard.
+        resume: keep the samples already in path and append after them;
+        num_samples is the number of samples to skip in the input
+        """
+        if pooling not in POOLING_MODES:
+            raise ValueError('unknown pooling {}, expected one of {}'.format(pooling, POOLING_MODES))
+        if dtype not in DTYPES:
+            raise ValueError('unknown dtype {}, expected one of {}'.format(dtype, DTYPES))
+        self.path = path
+        self.meta = {'layers': list(layers), 'hidden_size': hidden_size, 'pooling': pooling, 'dtype': dtype,
+                     'shard_rows': shard_rows}
+        self.dtype = np.dtype(dtype)
+        self.width = len(layers) * hidden_size
+        self.shard_rows = shard_rows
+        os.makedirs(path, exist_ok=True)
+        if resume and is_feature_store(path):
+            with open(os.path.join(path, META_FILE), encoding='utf-8') as reader:
+                meta = json.load(reader)
+            if meta != self.meta:
+                raise ValueError('{} was written with {}, can not resume with {}'.format(path, meta, self.meta))
+        else:
+            with open(os.path.join(path, META_FILE), 'w', encoding='utf-8') as writer:
+                json.dump(self.meta, writer)
+            for name in ('index.bin', 'uid_offsets.bin', 'uids.bin'):
+                open(self._file_path(name), 'wb').close()
+        self._truncate()
+        self._files = dict((name, open(self._file_path(name), 'ab'))
+                           for name in ('index.bin', 'uid_offsets.bin', 'uids.bin'))
+        self._shard_writer = open(self._file_path(shard_file(self.shard)), 'ab')
+
+    def _file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _truncate(self):
+        """drops what was written after the last complete sample"""
+        self.num_samples = min(_size(self._file_path('index.bin')) // 24, _size(self._file_path('uid_offsets.bin')) // 8)
+        self.shard, self.shard_end, self.uid_end = 0, 0, 0
+        if self.num_samples > 0:
+            last = np.memmap(self._file_path('index.bin'), dtype=np.int64, mode='r', shape=(self.num_samples, 3))[-1]
+            self.shard, self.shard_end = int(last[0]), int(last[1] + last[2])
+            self.uid_end = int(np.memmap(self._file_path('uid_offsets.bin'), dtype=np.int64, mode='r',
+                                         shape=(self.num_samples,))[-1])
+        os.truncate(self._file_path('index.bin'), self.num_samples * 24)
+        os.truncate(self._file_path('uid_offsets.bin'), self.num_samples * 8)
+        os.truncate(self._file_path('uids.bin'), self.uid_end)
+        if os.path.exists(self._file_path(shard_file(self.shard))):
+            os.truncate(self._file_path(shard_file(self.shard)), self.shard_end * self.width * self.dtype.itemsize)
+        shard = self.shard + 1
+        while os.path.exists(self._file_path(shard_file(shard))):
+            os.remove(self._file_path(shard_file(shard)))
+            shard += 1
+
+    def _next_shard(self):
+        self._shard_writer.close()
+        self.shard += 1
+        self.shard_end = 0
+        self._shard_writer = open(self._file_path(shard_file(self.shard)), 'ab')
+
+    def write(self, features, lengths, uids):
+        """appends one batch. features: (n_rows, n_layers, hidden_size), the rows of the samples one
+        after the other; lengths: rows of every sample, 1 when pooled
+        """
+        if len(uids) == 0:
+            return
+        features = np.ascontiguousarray(features, dtype=self.dtype).reshape(-1, self.width)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if len(lengths) != len(uids) or lengths.sum() != len(features):
+            raise ValueError('{} rows can not be split into {} samples'.format(len(features), len(uids)))
+        if self.shard_rows and self.shard_end >= self.shard_rows:
+            self._next_shard()
+        index = np.stack([np.full_like(lengths, self.shard),
+                          self.shard_end + np.cumsum(lengths) - lengths,
+                          lengths], axis=1)
+        encoded = [str(uid).encode('utf-8') for uid in uids]
+        uid_offsets = self.uid_end + np.cumsum([len(uid) for uid in encoded], dtype=np.int64)
+        # the index goes last, a sample only counts once it is written
+        self._shard_writer.write(features.tobytes())
+        self._files['uids.bin'].write(b''.join(encoded))
+        self._shard_writer.flush()
+        self._files['uids.bin'].flush()
+        self._files['index.bin'].write(index.tobytes())
+        self._files['uid_offsets.bin'].write(uid_offsets.tobytes())
+        self._files['index.bin'].flush()
+        self._files['uid_offsets.bin'].flush()
+        self.shard_end += len(features)
+        self.uid_end = int(uid_offsets[-1])
+        self.num_samples += len(uids)
+
+    def close(self):
+        for writer in self._files.values():
+            writer.close()
+        self._files = {}
+        self._shard_writer.close()
+
+
+class FeatureStore(object):
+    """store[i]: features of sample i, (length, n_layers, hidden_size) for pooling 'full',
+    (n_layers, hidden_size) otherwise; store.get(uid) looks a sample up by its uid.
+    store.index is the (shard, offset, length) of every sample. A shard is only mapped
+    once a sample in it is read. Only the path is pickled.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as reader:
+            meta = json.load(reader)
+        self.layers = meta['layers']
+        self.hidden_size = meta['hidden_size']
+        self.pooling = meta['pooling']
+        self.dtype = np.dtype(meta['dtype'])
+        self.index = self._memmap('index.bin', np.int64).reshape(-1, 3)
+        self._shards = {}
+        self._uids = None
+        self._uid_index = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def _memmap(self, name, dtype):
+        path = os.path.join(self.path, name)
+        if _size(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self, shard):
+        """all rows of a shard, (n_rows, n_layers, hidden_size)"""
+        if shard not in self._shards:
+            features = self._memmap(shard_file(shard), self.dtype)
+            self._shards[shard] = features.reshape(-1, len(self.layers), self.hidden_size)
+        return self._shards[shard]
+
+    @property
+    def uids(self):
+        if self._uids is None:
+            offsets = self._memmap('uid_offsets.bin', np.int64)
+            text = self._memmap('uids.bin', np.uint8).tobytes()
+            starts = [0] + offsets[:-1].tolist()
+            self._uids = [text[s:e].decode('utf-8') for s, e in zip(starts, offsets.tolist())]
+        return self._uids
+
+    def __getitem__(self, idx):
+        shard, offset, length = (int(x) for x in self.index[idx])
+        if self.pooling != 'full':
+            return self.shard(shard)[offset]
+        return self.shard(shard)[offset:offset + length]
+
+    def get(self, uid):
+        if self._uid_index is None:
+            self._uid_index = dict((uid, idx) for idx, uid in enumerate(self.uids))
+        return self[self._uid_index[str(uid)]]
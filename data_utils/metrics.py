@@ -1,46 +1,55 @@
 # Copyright (c) Microsoft. All rights reserved.
 from enum import Enum
 
-from sklearn.metrics import matthews_corrcoef
-from sklearn.metrics import accuracy_score, f1_score
-from sklearn.metrics import roc_auc_score
-from sklearn.metrics import confusion_matrix
-from scipy.stats import pearsonr, spearmanr
-from seqeval.metrics import classification_report
+import numpy as np
+
 from data_utils.squad_eval import evaluate_func
 
+# sklearn, scipy and seqeval are imported by the metric functions: Metric is needed by every
+# entry point (through experiments.exp_def), the metric libraries only when scores are computed
+
 def compute_acc(predicts, labels):
+    from sklearn.metrics import accuracy_score
     return 100.0 * accuracy_score(labels, predicts)
 
 def compute_f1(predicts, labels):
+    from sklearn.metrics import f1_score
     return 100.0 * f1_score(labels, predicts)
 
 def compute_f1mac(predicts, labels):
+    from sklearn.metrics import f1_score
     return 100.0 * f1_score(labels, predicts, average='macro')
 
 def compute_f1mic(predicts, labels):
+    from sklearn.metrics import f1_score
     return 100.0 * f1_score(labels, predicts, average='micro')
 
 def compute_mcc(predicts, labels):
+    from sklearn.metrics import matthews_corrcoef
     return 100.0 * matthews_corrcoef(labels, predicts)
 
 def compute_pearson(predicts, labels):
+    from scipy.stats import pearsonr
     pcof = pearsonr(labels, predicts)[0]
     return 100.0 * pcof
 
 def compute_spearman(predicts, labels):
+    from scipy.stats import spearmanr
     scof = spearmanr(labels, predicts)[0]
     return 100.0 * scof
 
 def compute_auc(predicts, labels):
+    from sklearn.metrics import roc_auc_score
     auc = roc_auc_score(labels, predicts)
     return 100.0 * auc
 
 def compute_cmat(predicts, labels):
+    from sklearn.metrics import confusion_matrix
     #return str(confusion_matrix(labels, predicts))
     return confusion_matrix(labels, predicts)
 
 def compute_seqacc(predicts, labels, label_mapper):
+    from seqeval.metrics import classification_report
     y_true, y_pred = [], []
     def trim(predict, label):
         temp_1 =  []
@@ -115,3 +124,235 @@ def calc_metrics(metric_meta, golds, predictions, scores, label_mapper=None):
             metric = metric_func(scores, golds)
         metrics[metric_name] = metric
     return metrics
+
+
+class ConfusionAccumulator(object):
+    """Running confusion matrix (rows: gold, columns: prediction) for ACC/F1/MCC/F1MAC/F1MIC/CMAT.
+    Labels are kept in the order they are first seen and sorted when the metric is computed,
+    which gives the same label set as sklearn (union of golds and predictions).
+    """
+    def __init__(self):
+        self.label_index = {}
+        self.cmat = np.zeros((0, 0), dtype=np.int64)
+
+    def _index(self, values):
+        uniques, inverse = np.unique(values, return_inverse=True)
+        for label in uniques.tolist():
+            if label not in self.label_index:
+                self.label_index[label] = len(self.label_index)
+        size = len(self.label_index)
+        if size > self.cmat.shape[0]:
+            cmat = np.zeros((size, size), dtype=np.int64)
+            cmat[:self.cmat.shape[0], :self.cmat.shape[1]] = self.cmat
+            self.cmat = cmat
+        mapping = np.array([self.label_index[label] for label in uniques.tolist()], dtype=np.int64)
+        return mapping[inverse]
+
+    def update(self, predicts, labels, scores=None):
+        predicts, labels = np.asarray(predicts), np.asarray(labels)
+        if labels.size == 0:
+            return
+        index = self._index(np.concatenate([labels, predicts]))
+        size = self.cmat.shape[0]
+        counts = np.bincount(index[:len(labels)] * size + index[len(labels):], minlength=size * size)
+        self.cmat += counts.reshape(size, size)
+
+    def merge(self, other):
+        if other.label_index:
+            index = self._index(np.asarray(list(other.label_index)))
+            self.cmat[np.ix_(index, index)] += other.cmat
+
+    def confusion_matrix(self):
+        """returns the sorted labels and the matching confusion matrix"""
+        labels = sorted(self.label_index)
+        order = [self.label_index[label] for label in labels]
+        return labels, self.cmat[np.ix_(order, order)]
+
+    @staticmethod
+    def _f1(tp, fp, fn):
+        denom = 2 * tp + fp + fn
+        return np.where(denom > 0, 2 * tp / np.maximum(denom, 1), 0.0)
+
+    def compute(self, metric):
+        labels, cmat = self.confusion_matrix()
+        if metric == Metric.CMAT:
+            return cmat
+        tp = np.diag(cmat).astype(np.float64)
+        t_sum, p_sum = cmat.sum(1).astype(np.float64), cmat.sum(0).astype(np.float64)
+        fp, fn = p_sum - tp, t_sum - tp
+        total = cmat.sum()
+        if metric == Metric.ACC:
+            return 100.0 * tp.sum() / total
+        if metric == Metric.F1:
+            if 1 not in labels:
+                return 0.0
+            pos = labels.index(1)
+            return 100.0 * float(self._f1(tp[pos], fp[pos], fn[pos]))
+        if metric == Metric.F1MAC:
+            return 100.0 * float(self._f1(tp, fp, fn).mean())
+        if metric == Metric.F1MIC:
+            return 100.0 * float(self._f1(tp.sum(), fp.sum(), fn.sum()))
+        if metric == Metric.MCC:
+            total = float(total)
+            cov_ytyp = tp.sum() * total - np.dot(t_sum, p_sum)
+            cov_ypyp = total ** 2 - np.dot(p_sum, p_sum)
+            cov_ytyt = total ** 2 - np.dot(t_sum, t_sum)
+            if cov_ypyp * cov_ytyt == 0:
+                return 0.0
+            return 100.0 * cov_ytyp / np.sqrt(cov_ytyt * cov_ypyp)
+        raise ValueError('Unsupported metric for confusion matrix: {}'.format(metric))
+
+
+class PearsonAccumulator(object):
+    """Streaming Pearson correlation from running means and co-moments (Chan et al. merge)"""
+    def __init__(self):
+        self.n = 0
+        self.mean_x = self.mean_y = 0.0
+        self.m2_x = self.m2_y = self.c_xy = 0.0
+
+    def update(self, predicts, labels, scores=None):
+        x, y = np.asarray(predicts, dtype=np.float64), np.asarray(labels, dtype=np.float64)
+        n_b = len(x)
+        if n_b == 0:
+            return
+        mean_x, mean_y = x.mean(), y.mean()
+        dx, dy = x - mean_x, y - mean_y
+        n = self.n + n_b
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        self.m2_x += np.dot(dx, dx) + delta_x ** 2 * self.n * n_b / n
+        self.m2_y += np.dot(dy, dy) + delta_y ** 2 * self.n * n_b / n
+        self.c_xy += np.dot(dx, dy) + delta_x * delta_y * self.n * n_b / n
+        self.mean_x += delta_x * n_b / n
+        self.mean_y += delta_y * n_b / n
+        self.n = n
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta_x, delta_y = other.mean_x - self.mean_x, other.mean_y - self.mean_y
+        self.m2_x += other.m2_x + delta_x ** 2 * self.n * other.n / n
+        self.m2_y += other.m2_y + delta_y ** 2 * self.n * other.n / n
+        self.c_xy += other.c_xy + delta_x * delta_y * self.n * other.n / n
+        self.mean_x += delta_x * other.n / n
+        self.mean_y += delta_y * other.n / n
+        self.n = n
+
+    def compute(self, metric=Metric.Pearson):
+        return 100.0 * self.c_xy / np.sqrt(self.m2_x * self.m2_y)
+
+
+class RankAccumulator(object):
+    """Keeps (score, gold) pairs for Spearman/AUC, which need a global sort.
+    With sample_size > 0 a uniform reservoir of at most sample_size pairs is kept (bottom-k of
+    random keys), which bounds memory at the price of an approximate metric; otherwise all pairs
+    are kept as compact float arrays and the metric is exact.
+    """
+    def __init__(self, sample_size=0, seed=2018):
+        self.sample_size = sample_size
+        self.rng = np.random.RandomState(seed)
+        self.predicts, self.labels, self.keys = [], [], []
+
+    def update(self, predicts, labels, scores=None):
+        self.predicts.append(np.asarray(predicts, dtype=np.float32))
+        self.labels.append(np.asarray(labels, dtype=np.float32))
+        if self.sample_size > 0:
+            self.keys.append(self.rng.random_sample(len(self.labels[-1])))
+            self._shrink()
+
+    def _shrink(self):
+        keys = np.concatenate(self.keys)
+        if len(keys) > self.sample_size:
+            keep = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            self.keys = [keys[keep]]
+            self.predicts = [np.concatenate(self.predicts)[keep]]
+            self.labels = [np.concatenate(self.labels)[keep]]
+
+    def merge(self, other):
+        """the reservoirs are merged by their keys, so the accumulators should be seeded differently"""
+        self.predicts.extend(other.predicts)
+        self.labels.extend(other.labels)
+        if self.sample_size > 0:
+            self.keys.extend(other.keys)
+            self._shrink()
+
+    def compute(self, metric):
+        predicts = np.concatenate(self.predicts) if self.predicts else np.zeros(0, dtype=np.float32)
+        labels = np.concatenate(self.labels) if self.labels else np.zeros(0, dtype=np.float32)
+        return METRIC_FUNC[metric](predicts, labels)
+
+
+class BufferedAccumulator(object):
+    """Fallback for metrics which need the full structured outputs (SeqEval, EmF1)"""
+    def __init__(self, label_mapper=None):
+        self.label_mapper = label_mapper
+        self.predicts, self.labels = [], []
+
+    def update(self, predicts, labels, scores=None):
+        self.predicts.extend(predicts)
+        self.labels.extend(labels)
+
+    def merge(self, other):
+        self.predicts.extend(other.predicts)
+        self.labels.extend(other.labels)
+
+    def compute(self, metric):
+        if metric == Metric.SeqEval:
+            return METRIC_FUNC[metric](self.predicts, self.labels, self.label_mapper)
+        return METRIC_FUNC[metric](self.predicts, self.labels)
+
+
+CONFUSION_METRICS = (Metric.ACC, Metric.F1, Metric.MCC, Metric.F1MAC, Metric.F1MIC, Metric.CMAT)
+
+
+class StreamingMetrics(object):
+    """Incremental version of calc_metrics: call update() once per batch and compute() at the end.
+    Memory stays constant except for exact Spearman/AUC (use rank_sample_size to bound it) and the
+    buffered SeqEval/EmF1 metrics. States of different data shards are combined with merge().
+    """
+    def __init__(self, metric_meta, label_mapper=None, rank_sample_size=0, seed=2018):
+        self.metric_meta = metric_meta
+        self.accumulators = {}
+        for mm in metric_meta:
+            key = self._key(mm)
+            if key in self.accumulators:
+                continue
+            if key == 'confusion':
+                self.accumulators[key] = ConfusionAccumulator()
+            elif key == 'pearson':
+                self.accumulators[key] = PearsonAccumulator()
+            elif key == 'buffer':
+                self.accumulators[key] = BufferedAccumulator(label_mapper)
+            else:
+                self.accumulators[key] = RankAccumulator(rank_sample_size, seed=seed)
+
+    @staticmethod
+    def _key(mm):
+        if mm in CONFUSION_METRICS:
+            return 'confusion'
+        if mm == Metric.Pearson:
+            return 'pearson'
+        if mm in (Metric.Spearman, Metric.AUC):
+            return mm.name
+        return 'buffer'
+
+    def update(self, predictions, golds, scores):
+        for key, acc in self.accumulators.items():
+            if key == 'confusion' or key == 'buffer':
+                acc.update(predictions, golds)
+            elif key == Metric.AUC.name:
+                assert len(scores) == 2 * len(golds), "AUC is only valid for binary classification problem"
+                acc.update(scores[1::2], golds)
+            else:
+                acc.update(scores, golds)
+
+    def merge(self, other):
+        for key, acc in self.accumulators.items():
+            acc.merge(other.accumulators[key])
+        return self
+
+    def compute(self):
+        metrics = {}
+        for mm in self.metric_meta:
+            metrics[mm.name] = self.accumulators[self._key(mm)].compute(mm)
+        return metrics
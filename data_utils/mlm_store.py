@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft. All rights reserved.
+"""Pre-tokenized MLM corpus: token ids of all paragraphs in one flat int32 file with paragraph
+and document offsets, written by experiments/mlm/mlm_prepro.py and memory-mapped for training.
+"""
+import os
+import json
+import collections
+import numpy as np
+
+META_FILE = 'meta.json'
+
+
+def mlm_store_path(path):
+    """wiki_train.json -> wiki_train.mlm"""
+    return '{}.mlm'.format(os.path.splitext(path)[0])
+
+
+def is_mlm_store(path):
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+class MLMCorpusWriter(object):
+    def __init__(self, path, vocab, bert_model=None, do_lower_case=None):
+        """vocab: the tokenizer vocab, token -> id"""
+        self.path = path
+        self.meta = {'vocab': list(vocab.keys()), 'bert_model': bert_model, 'do_lower_case': do_lower_case}
+        os.makedirs(path, exist_ok=True)
+        self._token_writer = open(os.path.join(path, 'token_id.bin'), 'wb')
+        self.para_offsets = [0]
+        self.doc_offsets = [0]
+
+    def add_document(self, paragraphs):
+        """paragraphs: list of token id arrays; empty paragraphs and documents are dropped"""
+        paragraphs = [para for para in paragraphs if len(para) > 0]
+        if len(paragraphs) == 0:
+            return
+        for para in paragraphs:
+            self._token_writer.write(np.asarray(para, dtype=np.int32).tobytes())
+            self.para_offsets.append(self.para_offsets[-1] + len(para))
+        self.doc_offsets.append(len(self.para_offsets) - 1)
+
+    def close(self):
+        self._token_writer.close()
+        np.save(os.path.join(self.path, 'para_offsets.npy'), np.asarray(self.para_offsets, dtype=np.int64))
+        np.save(os.path.join(self.path, 'doc_offsets.npy'), np.asarray(self.doc_offsets, dtype=np.int64))
+        self.meta.update({'num_docs': len(self.doc_offsets) - 1,
+                          'num_paras': len(self.para_offsets) - 1,
+                          'num_tokens': self.para_offsets[-1]})
+        with open(os.path.join(self.path, META_FILE), 'w', encoding='utf-8') as writer:
+            json.dump(self.meta, writer)
+
+
+class MLMCorpusStore(object):
+    """Indexable like the list of tokenized documents: store[i] is the list of paragraph id arrays.
+    It also carries the tokenizer vocab (store.vocab), so no tokenizer is loaded for training.
+    Only the path (and the selected documents) is pickled.
+    """
+    def __init__(self, path, indices=None):
+        self.path = path
+        self.indices = indices
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as reader:
+            meta = json.load(reader)
+        self.num_docs = meta['num_docs']
+        self.num_tokens = meta['num_tokens']
+        self.bert_model = meta['bert_model']
+        self.vocab = collections.OrderedDict((token, idx) for idx, token in enumerate(meta['vocab']))
+        self.para_offsets = np.load(os.path.join(path, 'para_offsets.npy'))
+        self.doc_offsets = np.load(os.path.join(path, 'doc_offsets.npy'))
+        self._token_ids = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['indices'])
+
+    def select(self, indices):
+        return MLMCorpusStore(self.path, np.asarray(indices, dtype=np.int64))
+
+    @property
+    def token_ids(self):
+        if self._token_ids is None:
+            if self.num_tokens == 0:
+                self._token_ids = np.zeros(0, dtype=np.int32)
+            else:
+                self._token_ids = np.memmap(os.path.join(self.path, 'token_id.bin'), dtype=np.int32, mode='r')
+        return self._token_ids
+
+    def __len__(self):
+        return self.num_docs if self.indices is None else len(self.indices)
+
+    def __getitem__(self, idx):
+        if self.indices is not None:
+            idx = int(self.indices[idx])
+        token_ids = self.token_ids
+        first, last = int(self.doc_offsets[idx]), int(self.doc_offsets[idx + 1])
+        offsets = self.para_offsets[first:last + 1].tolist()
+        return [token_ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
@@ -0,0 +1,160 @@
+# Copyright (c) Microsoft. All rights reserved.
+"""Compact feature store of extractive MRC data (e.g. SQuAD).
+
+The doc-stride features of all examples are packed into flat arrays with offsets:
+token ids, segment ids, the token to original word map (-1 for query/special tokens)
+and the max context flags. Documents, uids and answers are stored once per example.
+Arrays are saved as .npy files and memory-mapped when reading.
+"""
+import os
+import json
+import numpy as np
+
+META_FILE = 'meta.json'
+FEATURE_FIELDS = ('example_index', 'doc_span_index', 'doc_offset', 'start_position', 'end_position', 'label')
+
+
+def mrc_store_path(path):
+    """squad_dev.json -> squad_dev.mrc"""
+    return '{}.mrc'.format(os.path.splitext(path)[0])
+
+
+def is_mrc_store(path):
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+def prepared_data_exists(path):
+    """whether the prepared json at path or its MRC store, which prepro_std.py writes instead, exists"""
+    return os.path.exists(path) or is_mrc_store(mrc_store_path(path))
+
+
+class MRCFeatureWriter(object):
+    def __init__(self, path, vocab=None):
+        self.path = path
+        self.vocab = vocab
+        self.uids = []
+        self.answers = []
+        self.docs = []
+        self.token_ids = []
+        self.type_ids = []
+        self.token_to_orig_maps = []
+        self.token_is_max_contexts = []
+        self.features = dict((field, []) for field in FEATURE_FIELDS)
+        self.store_indices = []
+
+    def add_example(self, uid, doc, answer):
+        """returns the index of the example in the store"""
+        self.uids.append(uid)
+        self.docs.append(doc.encode('utf-8'))
+        self.answers.append(answer)
+        return len(self.uids) - 1
+
+    def add_feature(self, store_index, feature):
+        seq_len = len(feature.input_ids)
+        token_to_orig_map = np.full(seq_len, -1, dtype=np.int32)
+        token_is_max_context = np.zeros(seq_len, dtype=np.bool_)
+        for pos, word in feature.token_to_orig_map.items():
+            token_to_orig_map[int(pos)] = word
+        for pos, flag in feature.token_is_max_context.items():
+            token_is_max_context[int(pos)] = flag
+        self.token_ids.append(np.asarray(feature.input_ids, dtype=np.int32))
+        self.type_ids.append(np.asarray(feature.segment_ids, dtype=np.int8))
+        self.token_to_orig_maps.append(token_to_orig_map)
+        self.token_is_max_contexts.append(token_is_max_context)
+        self.store_indices.append(store_index)
+        for field in FEATURE_FIELDS:
+            value = feature.is_impossible if field == 'label' else getattr(feature, field)
+            self.features[field].append(-1 if value is None else int(value))
+
+    @staticmethod
+    def _offsets(arrays):
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(arr) for arr in arrays], out=offsets[1:])
+        return offsets
+
+    def _save(self, name, arr):
+        np.save(os.path.join(self.path, '{}.npy'.format(name)), arr)
+
+    def close(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._save('offsets', self._offsets(self.token_ids))
+        self._save('token_id', np.concatenate(self.token_ids) if self.token_ids else np.zeros(0, dtype=np.int32))
+        self._save('type_id', np.concatenate(self.type_ids) if self.type_ids else np.zeros(0, dtype=np.int8))
+        self._save('token_to_orig_map', np.concatenate(self.token_to_orig_maps) if self.token_to_orig_maps else np.zeros(0, dtype=np.int32))
+        self._save('token_is_max_context', np.concatenate(self.token_is_max_contexts) if self.token_is_max_contexts else np.zeros(0, dtype=np.bool_))
+        self._save('store_index', np.asarray(self.store_indices, dtype=np.int32))
+        for field in FEATURE_FIELDS:
+            self._save(field, np.asarray(self.features[field], dtype=np.int32))
+        self._save('doc_offsets', self._offsets(self.docs))
+        self._save('doc_text', np.frombuffer(b''.join(self.docs), dtype=np.uint8))
+        meta = {'num_features': len(self.token_ids),
+                'num_examples': len(self.uids),
+                'uids': self.uids,
+                'answers': self.answers,
+                'vocab': self.vocab}
+        with open(os.path.join(self.path, META_FILE), 'w', encoding='utf-8') as writer:
+            json.dump(meta, writer)
+
+
+class MRCFeatureStore(object):
+    """Reader of a MRCFeatureWriter output, indexable like the list of JSON samples.
+    Only the path (and the selected indices) is pickled, so the store can be shipped to
+    DataLoader workers or put into batch_info.
+    """
+    def __init__(self, path, indices=None):
+        self.path = path
+        self.indices = indices
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as reader:
+            meta = json.load(reader)
+        self.num_features = meta['num_features']
+        self.uids = meta['uids']
+        self.answers = meta['answers']
+        self.vocab = meta['vocab']
+        self._arrays = {}
+
+    def __getstate__(self):
+        return {'path': self.path, 'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['indices'])
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, '{}.npy'.format(name)), mmap_mode='r')
+        return self._arrays[name]
+
+    def seq_lens(self):
+        return np.diff(self._array('offsets'))
+
+    def select(self, indices):
+        return MRCFeatureStore(self.path, np.asarray(indices, dtype=np.int64))
+
+    def __len__(self):
+        return self.num_features if self.indices is None else len(self.indices)
+
+    def __getitem__(self, idx):
+        if self.indices is not None:
+            idx = int(self.indices[idx])
+        offsets = self._array('offsets')
+        start, end = int(offsets[idx]), int(offsets[idx + 1])
+        store_index = int(self._array('store_index')[idx])
+        sample = {'uid': self.uids[store_index],
+                  'token_id': self._array('token_id')[start:end].tolist(),
+                  'type_id': self._array('type_id')[start:end].tolist(),
+                  'token_to_orig_map': np.array(self._array('token_to_orig_map')[start:end]),
+                  'token_is_max_context': np.array(self._array('token_is_max_context')[start:end]),
+                  'store_index': store_index,
+                  'answer': self.answers[store_index],
+                  'doc_store': self}
+        for field in FEATURE_FIELDS:
+            sample[field] = int(self._array(field)[idx])
+        sample['label'] = bool(sample['label'])
+        return sample
+
+    def get_doc(self, store_index):
+        doc_offsets = self._array('doc_offsets')
+        start, end = int(doc_offsets[store_index]), int(doc_offsets[store_index + 1])
+        return self._array('doc_text')[start:end].tobytes().decode('utf-8')
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.vocab[i] for i in ids]
@@ -0,0 +1,246 @@
+# Copyright (c) Microsoft. All rights reserved.
+"""Columnar prediction/score files, written batch by batch and memory-mapped when reading.
+
+A store is a directory with:
+    scores.bin / score_offsets.bin    float32 scores, (N, n_class) when every row has the same width
+    predictions.bin                   int64 predictions, (N,) or (N, k) for ranking;
+                                      other predictions (spans, tag sequences) go to predictions.jsonl
+    uid_offsets.bin / uids.bin        uid string table
+    meta.json                         row count, dtypes, widths and metrics
+"""
+import os
+import json
+import shutil
+import numpy as np
+
+META_FILE = 'meta.json'
+COPY_ROWS = 1 << 20
+
+
+def prediction_path(path):
+    """mnli_matched_dev_scores_epoch_0.json -> mnli_matched_dev_scores_epoch_0.pred"""
+    return '{}.pred'.format(os.path.splitext(path)[0])
+
+
+def prediction_shard_path(path, rank):
+    """the store of one rank in distributed evaluation, merged into path by merge_predictions"""
+    return '{}.rank{}'.format(path, rank)
+
+
+def is_prediction_store(path):
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+def _is_int_column(values):
+    if isinstance(values, np.ndarray):
+        return np.issubdtype(values.dtype, np.integer)
+    return all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in values)
+
+
+class PredictionWriter(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.num_rows = 0
+        self.score_width = None
+        self.prediction_width = None
+        self.prediction_format = None
+        self.uid_type = None
+        self.score_end = 0
+        self.uid_end = 0
+        self._files = {}
+
+    def _file(self, name):
+        if name not in self._files:
+            self._files[name] = open(os.path.join(self.path, name), 'wb')
+        return self._files[name]
+
+    def _write_scores(self, scores, rows):
+        scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        width = len(scores) // rows if rows else 0
+        if width * rows != len(scores):
+            raise ValueError('{} scores can not be split into {} rows'.format(len(scores), rows))
+        if self.score_width is None:
+            self.score_width = width
+        elif self.score_width != width:
+            # e.g. sequence labeling, scores are padded to the batch length
+            self.score_width = -1
+        offsets = self.score_end + width * np.arange(1, rows + 1, dtype=np.int64)
+        self.score_end += len(scores)
+        self._file('scores.bin').write(scores.tobytes())
+        self._file('score_offsets.bin').write(offsets.tobytes())
+
+    def _write_predictions(self, predictions, rows):
+        if self.prediction_format is None:
+            self.prediction_format = 'int64' if _is_int_column(predictions) else 'jsonl'
+        if self.prediction_format == 'int64':
+            if not _is_int_column(predictions):
+                raise ValueError('predictions switched from int to {}'.format(type(predictions[0])))
+            width = len(predictions) // rows
+            if self.prediction_width is None:
+                self.prediction_width = width
+            if width * rows != len(predictions) or width != self.prediction_width:
+                raise ValueError('{} predictions can not be split into {} rows'.format(len(predictions), rows))
+            self._file('predictions.bin').write(np.asarray(predictions, dtype=np.int64).tobytes())
+        else:
+            writer = self._file('predictions.jsonl')
+            for pred in predictions:
+                writer.write('{}\n'.format(json.dumps(pred)).encode('utf-8'))
+
+    def _write_uids(self, uids):
+        uid_type = 'int' if _is_int_column(uids) else 'str'
+        self.uid_type = uid_type if self.uid_type in (None, uid_type) else 'str'
+        encoded = [str(uid).encode('utf-8') for uid in uids]
+        offsets = self.uid_end + np.cumsum([len(uid) for uid in encoded], dtype=np.int64)
+        self.uid_end = int(offsets[-1])
+        self._file('uids.bin').write(b''.join(encoded))
+        self._file('uid_offsets.bin').write(offsets.tobytes())
+
+    def write(self, predictions, scores, uids):
+        """appends one batch; there is one row per uid"""
+        rows = len(uids)
+        if rows == 0:
+            return
+        self._write_scores(scores, rows)
+        self._write_predictions(predictions, rows)
+        self._write_uids(uids)
+        self.num_rows += rows
+
+    def close(self, metrics=None):
+        for writer in self._files.values():
+            writer.close()
+        self._files = {}
+        meta = {'num_rows': self.num_rows,
+                'score_width': self.score_width,
+                'prediction_width': self.prediction_width,
+                'prediction_format': self.prediction_format,
+                'uid_type': self.uid_type,
+                'metrics': metrics or {}}
+        with open(os.path.join(self.path, META_FILE), 'w', encoding='utf-8') as writer:
+            json.dump(meta, writer)
+
+
+class PredictionReader(object):
+    """Reads a PredictionWriter output. Supports the keys of the JSON score files
+    (reader['predictions'], reader['uids'], reader['scores'], reader['metrics']),
+    so it can be passed wherever the JSON dict was used.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as reader:
+            meta = json.load(reader)
+        self.num_rows = meta['num_rows']
+        self.score_width = meta['score_width']
+        self.prediction_width = meta['prediction_width']
+        self.prediction_format = meta['prediction_format']
+        self.uid_type = meta['uid_type']
+        self.metrics = meta['metrics']
+        self._uids = None
+        self._predictions = None
+
+    def __len__(self):
+        return self.num_rows
+
+    def _memmap(self, name, dtype):
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    @property
+    def scores(self):
+        """(N, n_class) array, or a list of per row arrays when rows have different widths"""
+        scores = self._memmap('scores.bin', np.float32)
+        if self.score_width is not None and self.score_width >= 0:
+            return scores.reshape(self.num_rows, self.score_width)
+        offsets = self._memmap('score_offsets.bin', np.int64)
+        return np.split(scores, offsets[:-1])
+
+    @property
+    def predictions(self):
+        if self._predictions is None:
+            if self.prediction_format == 'int64':
+                predictions = self._memmap('predictions.bin', np.int64)
+                if self.prediction_width != 1:
+                    predictions = predictions.reshape(self.num_rows, self.prediction_width)
+                self._predictions = predictions
+            elif self.prediction_format == 'jsonl':
+                with open(os.path.join(self.path, 'predictions.jsonl'), encoding='utf-8') as reader:
+                    self._predictions = [json.loads(line) for line in reader]
+            else:
+                self._predictions = []
+        return self._predictions
+
+    @property
+    def uids(self):
+        if self._uids is None:
+            offsets = self._memmap('uid_offsets.bin', np.int64)
+            text = self._memmap('uids.bin', np.uint8).tobytes()
+            starts = [0] + offsets[:-1].tolist()
+            uids = [text[s:e].decode('utf-8') for s, e in zip(starts, offsets.tolist())]
+            self._uids = [int(uid) for uid in uids] if self.uid_type == 'int' else uids
+        return self._uids
+
+    def __getitem__(self, key):
+        if key not in ('predictions', 'scores', 'uids', 'metrics'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+def _merge_width(widths):
+    widths = set(widths)
+    if not widths:
+        return None
+    return widths.pop() if len(widths) == 1 else -1
+
+
+def merge_predictions(path, num_shards, metrics=None):
+    """Concatenates the stores written by num_shards ranks (prediction_shard_path) in rank order
+    into the store at path and removes them. The files are copied in chunks, so the merging rank
+    does not hold the outputs of the other ranks in memory.
+    """
+    shards = [PredictionReader(prediction_shard_path(path, rank)) for rank in range(num_shards)]
+    filled = [shard for shard in shards if shard.num_rows > 0]
+    formats = set(shard.prediction_format for shard in filled)
+    if len(formats) > 1:
+        raise ValueError('the shards have different prediction formats {}'.format(sorted(formats)))
+    prediction_widths = set(shard.prediction_width for shard in filled if shard.prediction_width is not None)
+    if len(prediction_widths) > 1:
+        raise ValueError('the shards have different prediction widths {}'.format(sorted(prediction_widths)))
+    os.makedirs(path, exist_ok=True)
+    for name in ('scores.bin', 'predictions.bin', 'predictions.jsonl', 'uids.bin'):
+        paths = [os.path.join(shard.path, name) for shard in filled if os.path.exists(os.path.join(shard.path, name))]
+        if paths:
+            with open(os.path.join(path, name), 'wb') as writer:
+                for shard_path in paths:
+                    with open(shard_path, 'rb') as reader:
+                        shutil.copyfileobj(reader, writer)
+    # the offsets are cumulative over the merged files
+    for name, data_name, itemsize in (('score_offsets.bin', 'scores.bin', 4), ('uid_offsets.bin', 'uids.bin', 1)):
+        if filled:
+            base = 0
+            with open(os.path.join(path, name), 'wb') as writer:
+                for shard in filled:
+                    offsets = shard._memmap(name, np.int64)
+                    for start in range(0, len(offsets), COPY_ROWS):
+                        writer.write((offsets[start:start + COPY_ROWS] + base).tobytes())
+                    base += os.path.getsize(os.path.join(shard.path, data_name)) // itemsize
+    uid_types = set(shard.uid_type for shard in filled)
+    meta = {'num_rows': sum(shard.num_rows for shard in shards),
+            'score_width': _merge_width(shard.score_width for shard in filled),
+            'prediction_width': prediction_widths.pop() if prediction_widths else None,
+            'prediction_format': formats.pop() if formats else None,
+            'uid_type': 'str' if 'str' in uid_types else ('int' if uid_types else None),
+            'metrics': metrics or {}}
+    with open(os.path.join(path, META_FILE), 'w', encoding='utf-8') as writer:
+        json.dump(meta, writer)
+    for shard in shards:
+        shutil.rmtree(shard.path)
+
+
+def load_predictions(path):
+    """returns the score file content: a PredictionReader for binary stores, a dict for JSON files"""
+    if is_prediction_store(path):
+        return PredictionReader(path)
+    with open(path, encoding='utf-8') as reader:
+        return json.load(reader)
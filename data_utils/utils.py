@@ -1,4 +1,6 @@
 # Copyright (c) Microsoft. All rights reserved.
+import os
+import pickle
 import random
 import torch
 import numpy
@@ -21,6 +23,47 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+class DeviceMeters(object):
+    """Running sums of training statistics per (name, task), kept as one device tensor so that
+    update() neither syncs with the host nor communicates. sync() reduces everything across ranks
+    with a single all_reduce and folds the sums into AverageMeters: meters[name] over all tasks and
+    task_meters[name][task_id] per task.
+    """
+    def __init__(self, names, num_tasks, device=None):
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.num_tasks = num_tasks
+        # [0]: sum of value * n, [1]: sum of n
+        self.buffer = torch.zeros(2, len(self.names), num_tasks, dtype=torch.float64, device=device)
+        self.meters = dict((name, AverageMeter()) for name in self.names)
+        self.task_meters = dict((name, [AverageMeter() for _ in range(num_tasks)]) for name in self.names)
+
+    def to(self, device):
+        self.buffer = self.buffer.to(device)
+        return self
+
+    def update(self, name, val, n=1, task_id=0):
+        i = self.index[name]
+        if torch.is_tensor(val):
+            val = val.detach().to(self.buffer.device, self.buffer.dtype)
+        self.buffer[0, i, task_id] += val * n
+        self.buffer[1, i, task_id] += n
+
+    def sync(self, distributed=False):
+        buffer = self.buffer
+        if distributed:
+            torch.distributed.all_reduce(buffer)
+        totals = buffer.to('cpu', copy=True)
+        self.buffer.zero_()
+        for name, i in self.index.items():
+            for task_id in range(self.num_tasks):
+                count = totals[1, i, task_id].item()
+                if count > 0:
+                    value = totals[0, i, task_id].item() / count
+                    self.task_meters[name][task_id].update(value, count)
+                    self.meters[name].update(value, count)
+
+
 def set_environment(seed, set_cuda=False):
     random.seed(seed)
     numpy.random.seed(seed)
@@ -28,6 +71,71 @@ def set_environment(seed, set_cuda=False):
     if torch.cuda.is_available() and set_cuda:
         torch.cuda.manual_seed_all(seed)
 
+def distributed_env(local_rank=-1, world_size=1):
+    """(rank, local_rank, local_size, world_size) of this process, read from the launcher:
+    OpenMPI mpirun (OMPI_COMM_WORLD_*), torchrun / torch.distributed.launch (RANK, LOCAL_RANK,
+    WORLD_SIZE, LOCAL_WORLD_SIZE) or else the --local_rank/--world_size arguments.
+    local_rank is -1 when the process is not launched for distributed training.
+    """
+    if os.getenv('OMPI_COMM_WORLD_RANK') is not None:
+        return (int(os.environ['OMPI_COMM_WORLD_RANK']),
+                int(os.environ['OMPI_COMM_WORLD_LOCAL_RANK']),
+                int(os.environ['OMPI_COMM_WORLD_LOCAL_SIZE']),
+                int(os.environ['OMPI_COMM_WORLD_SIZE']))
+    if os.getenv('WORLD_SIZE') is not None:
+        local_rank = int(os.getenv('LOCAL_RANK', local_rank))
+        world_size = int(os.environ['WORLD_SIZE'])
+        rank = int(os.getenv('RANK', local_rank))
+        local_size = int(os.getenv('LOCAL_WORLD_SIZE', world_size))
+        return rank, local_rank, local_size, world_size
+    if local_rank == -1:
+        return 0, -1, 1, 1
+    # single node
+    return local_rank, local_rank, world_size, world_size
+
+def init_distributed(rank, local_rank, local_size, world_size, backend=None, use_cuda=True):
+    """Joins the process group over tcp (MASTER_ADDR/MASTER_PORT) and returns the device of
+    this process: cuda:local_rank, or the CPU with the cores split among the local processes.
+    The backend defaults to nccl on GPU and gloo on CPU.
+    """
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+        if os.getenv('OMP_NUM_THREADS') is None:
+            # each process would otherwise start one thread per core
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, local_size)))
+    backend = backend or ('nccl' if use_cuda else 'gloo')
+    init_method = 'tcp://{}:{}'.format(os.getenv('MASTER_ADDR', 'localhost'), os.getenv('MASTER_PORT', '6600'))
+    torch.distributed.init_process_group(backend=backend, world_size=world_size, rank=rank, init_method=init_method)
+    return device
+
+def gather_to_rank0(obj):
+    """list of the (picklable) objects of all ranks in rank order on rank 0, None on the others"""
+    if not hasattr(torch.distributed, 'gather_object'):
+        return _gather_pickled_to_rank0(obj)
+    gathered = [None] * torch.distributed.get_world_size() if torch.distributed.get_rank() == 0 else None
+    torch.distributed.gather_object(obj, gathered, dst=0)
+    return gathered
+
+def _gather_pickled_to_rank0(obj):
+    """gather_to_rank0 for torch < 1.8: the pickled objects, padded to the longest one, are all-gathered"""
+    world_size = torch.distributed.get_world_size()
+    device = torch.device('cuda', torch.cuda.current_device()) if torch.distributed.get_backend() == 'nccl' else torch.device('cpu')
+    data = torch.from_numpy(numpy.frombuffer(pickle.dumps(obj), dtype=numpy.uint8).copy()).to(device)
+    size = torch.tensor([data.numel()], dtype=torch.long, device=device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    torch.distributed.all_gather(sizes, size)
+    sizes = [int(size.item()) for size in sizes]
+    padded = torch.zeros(max(sizes), dtype=torch.uint8, device=device)
+    padded[:data.numel()] = data
+    shards = [torch.zeros_like(padded) for _ in range(world_size)]
+    torch.distributed.all_gather(shards, padded)
+    if torch.distributed.get_rank() != 0:
+        return None
+    return [pickle.loads(shard[:size].cpu().numpy().tobytes()) for shard, size in zip(shards, sizes)]
+
 def patch_var(v, cuda=True):
     if cuda:
         v = v.cuda(non_blocking=True)
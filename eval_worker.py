@@ -0,0 +1,206 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Evaluates the checkpoints saved by train.py outside of the training process.
+
+Watch the output directory of a run (train.py --async_eval starts this process itself):
+    python eval_worker.py --output_dir checkpoints/mnli --data_dir data/canonical_data/bert_uncased_lower --test_datasets mnli_matched
+or evaluate a single checkpoint:
+    python eval_worker.py --checkpoint checkpoints/mnli/model_0_10000.pt ...
+
+Score files get the names the in-process evaluation gives them. The metrics of every checkpoint
+are also written next to it (model_0_10000.eval.json), which marks the checkpoint as evaluated.
+The watcher exits once train.py has written the train_done file and no checkpoint is left.
+"""
+import argparse
+import json
+import os
+import re
+import time
+import torch
+from torch.utils.data import DataLoader
+from experiments.exp_def import TaskDefs
+from data_utils.log_wrapper import create_logger
+from data_utils.mrc_store import prepared_data_exists
+from data_utils.prediction_store import PredictionWriter, PredictionReader, prediction_path
+from mt_dnn.batcher import SingleTaskDataset, Collater
+from mt_dnn.inference import eval_model
+from mt_dnn.model import MTDNNModel
+
+DONE_FILE = 'train_done'
+CHECKPOINT_PATTERN = re.compile(r'^model_(\d+)(?:_(\d+))?\.pt$')
+
+
+def checkpoint_step(path):
+    """model_{epoch}_{updates}.pt -> ('updates', updates), model_{epoch}.pt -> ('epoch', epoch),
+    None for other files
+    """
+    match = CHECKPOINT_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return None
+    if match.group(2) is not None:
+        return 'updates', int(match.group(2))
+    return 'epoch', int(match.group(1))
+
+
+def eval_file(checkpoint):
+    return '{}.eval.json'.format(os.path.splitext(checkpoint)[0])
+
+
+def pending_checkpoints(output_dir):
+    """checkpoints without metrics, oldest first"""
+    paths = [os.path.join(output_dir, name) for name in os.listdir(output_dir) if checkpoint_step(name) is not None]
+    return sorted([path for path in paths if not os.path.exists(eval_file(path))], key=os.path.getmtime)
+
+
+def split_paths(data_dir, datasets, split):
+    """(dataset, path) of the datasets with prepared data of the split"""
+    paths = [(dataset, os.path.join(data_dir, '{}_{}.json'.format(dataset, split))) for dataset in datasets]
+    return [(dataset, path) for dataset, path in paths if prepared_data_exists(path)]
+
+
+def dump(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+class CheckpointEvaluator(object):
+    def __init__(self, args, logger):
+        self.args = args
+        self.logger = logger
+        self.task_defs = TaskDefs(args.task_def)
+        self.device = torch.device('cuda' if args.cuda else 'cpu')
+        self.model = None
+        self.task_ids = {}
+        self.collater = None
+        self.tensorboard = None
+        if args.tensorboard:
+            from tensorboardX import SummaryWriter
+            self.tensorboard = SummaryWriter(log_dir=args.tensorboard_logdir)
+
+    def load(self, checkpoint):
+        state_dict = torch.load(checkpoint, map_location=self.device)
+        # the in-process evaluation uses the EMA weights as well
+        if 'ema' in state_dict:
+            state_dict['state'].update(state_dict['ema'])
+        state_dict.pop('ema', None)
+        state_dict.pop('optimizer', None)
+        if self.model is not None:
+            self.model.network.load_state_dict(state_dict['state'], strict=False)
+            return
+        config = state_dict['config']
+        config['cuda'] = self.args.cuda
+        config['local_rank'] = -1
+        config['multi_gpu_on'] = False
+        config['fp16'] = False
+        config['adv_train'] = False
+        config['ema_opt'] = 0
+        self.model = MTDNNModel(config, device=self.device, state_dict=state_dict)
+        # task ids follow the order of the training datasets
+        for dataset in config['train_datasets']:
+            self.task_ids.setdefault(dataset.split('_')[0], len(self.task_ids))
+        self.collater = Collater(is_train=False, encoder_type=config['encoder_type'],
+                                 max_seq_len=config['max_seq_len'], do_padding=config.get('do_padding', False),
+                                 bi_encoder=config.get('bi_encoder', False))
+
+    def evaluate(self, checkpoint):
+        args = self.args
+        step = checkpoint_step(checkpoint)
+        updates_str, updates = step if step is not None else ('updates', 0)
+        self.load(checkpoint)
+        splits = ['dev'] if args.skip_test else ['dev', 'test']
+        results = {}
+        for split in splits:
+            for dataset, path in split_paths(args.data_dir, args.test_datasets, split):
+                prefix = dataset.split('_')[0]
+                task_def = self.task_defs.get_task_def(prefix)
+                data_set = SingleTaskDataset(path, False, maxlen=args.max_seq_len, task_id=self.task_ids[prefix],
+                                             task_def=task_def, printable=False)
+                data = DataLoader(data_set, batch_size=args.batch_size_eval, collate_fn=self.collater.collate_fn,
+                                  pin_memory=args.cuda)
+                score_file = os.path.join(args.output_dir, '{}_{}_scores_{}_{}.json'.format(dataset, split, updates_str, updates))
+                writer = PredictionWriter(prediction_path(score_file)) if args.prediction_format == 'binary' else None
+                with torch.no_grad():
+                    metrics, predictions, scores, golds, ids = eval_model(self.model, data,
+                                                                          metric_meta=task_def.metric_meta,
+                                                                          device=self.device,
+                                                                          with_label=split == 'dev',
+                                                                          label_mapper=task_def.label_vocab,
+                                                                          task_type=task_def.task_type,
+                                                                          keep_predictions=writer is None,
+                                                                          prediction_writer=writer,
+                                                                          score_mode=args.score_mode)
+                metrics = dict((key, val if isinstance(val, (str, float)) else str(val)) for key, val in metrics.items())
+                for key, val in metrics.items():
+                    self.logger.info('Task {0} -- {1} {2} -- {3} {4}: {5}'.format(dataset, updates_str, updates, split, key, val))
+                    if self.tensorboard and isinstance(val, float):
+                        self.tensorboard.add_scalar('{}/{}/{}'.format(split.capitalize(), dataset, key), val, global_step=updates)
+                if writer is not None:
+                    writer.close(metrics)
+                    output = PredictionReader(prediction_path(score_file))
+                else:
+                    output = {'metrics': metrics, 'predictions': predictions, 'uids': ids, 'scores': scores}
+                    dump(score_file, output)
+                if args.glue_format_on:
+                    from experiments.glue.glue_utils import submit
+                    official_score_file = os.path.join(args.output_dir, '{}_{}_scores_{}.tsv'.format(dataset, split, updates_str))
+                    submit(official_score_file, output, task_def.label_vocab)
+                results['{}_{}'.format(dataset, split)] = metrics
+        if self.tensorboard:
+            self.tensorboard.flush()
+        dump(eval_file(checkpoint), {'checkpoint': os.path.basename(checkpoint), updates_str: updates, 'metrics': results})
+        return results
+
+    def close(self):
+        if self.tensorboard:
+            self.tensorboard.close()
+
+
+def watch(evaluator, output_dir, poll_interval):
+    while True:
+        # checked first, so checkpoints saved before the marker are still evaluated
+        done = os.path.exists(os.path.join(output_dir, DONE_FILE))
+        for checkpoint in pending_checkpoints(output_dir):
+            evaluator.logger.info('Evaluating {}'.format(checkpoint))
+            evaluator.evaluate(checkpoint)
+        if done:
+            break
+        time.sleep(poll_interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', default='checkpoint', help='run directory with the checkpoints; score files go there')
+    parser.add_argument('--checkpoint', type=str, default=None, help='evaluate this checkpoint only instead of watching')
+    parser.add_argument('--data_dir', default='data/canonical_data/bert_uncased_lower')
+    parser.add_argument('--task_def', type=str, default="experiments/glue/glue_task_def.yml")
+    parser.add_argument('--test_datasets', default='mnli_matched,mnli_mismatched')
+    parser.add_argument('--skip_test', action='store_true', help='only score the dev sets')
+    parser.add_argument('--max_seq_len', type=int, default=512)
+    parser.add_argument('--batch_size_eval', type=int, default=8)
+    parser.add_argument('--cuda', type=bool, default=torch.cuda.is_available(),
+                        help='whether to use GPU acceleration.')
+    parser.add_argument('--prediction_format', type=str, default='json', choices=['json', 'binary'])
+    parser.add_argument('--score_mode', type=str, default='full', choices=['full', 'top1', 'none'])
+    parser.add_argument('--glue_format_on', action='store_true')
+    parser.add_argument('--tensorboard', action='store_true')
+    parser.add_argument('--tensorboard_logdir', default='tensorboard_logdir')
+    parser.add_argument('--poll_interval', type=float, default=30, help='seconds between two looks for new checkpoints')
+    parser.add_argument('--log_file', default='mt-dnn-eval.log')
+    args = parser.parse_args()
+    args.test_datasets = args.test_datasets.split(',')
+    return args
+
+
+def main():
+    args = parse_args()
+    logger = create_logger(__name__, to_disk=True, log_file=args.log_file)
+    evaluator = CheckpointEvaluator(args, logger)
+    if args.checkpoint:
+        evaluator.evaluate(args.checkpoint)
+    else:
+        watch(evaluator, args.output_dir, args.poll_interval)
+    evaluator.close()
+
+
+if __name__ == '__main__':
+    main()
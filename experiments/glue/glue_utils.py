@@ -281,18 +281,18 @@ def load_qnnli(file, header=True, is_train=True):
 
 
 def submit(path, data, label_dict=None):
+    """data is the score dict or a data_utils.prediction_store.PredictionReader"""
     header = 'index\tprediction'
     with open(path ,'w') as writer:
         predictions, uids = data['predictions'], data['uids']
         writer.write('{}\n'.format(header))
         assert len(predictions) == len(uids)
         # sort label
-        paired = [(int(uid), predictions[idx]) for idx, uid in enumerate(uids)]
+        paired = [(int(uid), int(predictions[idx])) for idx, uid in enumerate(uids)]
         paired = sorted(paired, key=lambda item: item[0])
         for uid, pred in paired:
             if label_dict is None:
                 writer.write('{}\t{}\n'.format(uid, pred))
             else:
-                assert type(pred) is int
                 writer.write('{}\t{}\n'.format(uid, label_dict[pred]))
 
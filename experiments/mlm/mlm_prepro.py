@@ -0,0 +1,65 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Tokenizes a loose JSON MLM corpus (one {"text": ...} document per line, paragraphs separated by
+a blank line) once, with a process pool, into the memory-mapped store read by SingleTaskDataset.
+
+python experiments/mlm/mlm_prepro.py --input data/mlm/wiki_train.json --bert_model bert-base-uncased --do_lower_case
+"""
+import os
+import json
+import argparse
+from multiprocessing import Pool
+from sys import path
+import numpy as np
+
+path.append(os.getcwd())
+from data_utils.mlm_store import MLMCorpusWriter, mlm_store_path
+
+_tokenizer = None
+
+
+def _init_tokenizer(bert_model, do_lower_case):
+    global _tokenizer
+    from pytorch_pretrained_bert.tokenization import BertTokenizer
+    _tokenizer = BertTokenizer.from_pretrained(bert_model, do_lower_case=do_lower_case)
+
+
+def tokenize_document(line, tokenizer=None):
+    """same paragraph split as SingleTaskDataset.load; returns a list of int32 id arrays"""
+    tokenizer = tokenizer or _tokenizer
+    paras = json.loads(line)['text'].split('\n\n')
+    paras = [para.strip() for para in paras if len(para.strip()) > 0]
+    return [np.array(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(para)), dtype=np.int32) for para in paras]
+
+
+def build_mlm_store(input_path, output_path, bert_model, do_lower_case, num_workers=4, chunksize=64):
+    _init_tokenizer(bert_model, do_lower_case)
+    writer = MLMCorpusWriter(output_path, _tokenizer.vocab, bert_model=bert_model, do_lower_case=do_lower_case)
+    with open(input_path, encoding='utf-8') as reader:
+        if num_workers > 1:
+            with Pool(num_workers, initializer=_init_tokenizer, initargs=(bert_model, do_lower_case)) as pool:
+                # imap keeps the document order
+                for paragraphs in pool.imap(tokenize_document, reader, chunksize=chunksize):
+                    writer.add_document(paragraphs)
+        else:
+            for line in reader:
+                writer.add_document(tokenize_document(line))
+    writer.close()
+    return writer.meta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Preprocessing MLM corpus.')
+    parser.add_argument('--input', type=str, required=True, help='loose JSON corpus, e.g. data/mlm/wiki_train.json')
+    parser.add_argument('--output', type=str, default=None, help='defaults to the input path with a .mlm extension')
+    parser.add_argument('--bert_model', type=str, default='bert-base-uncased')
+    parser.add_argument('--do_lower_case', action='store_true')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    output = args.output or mlm_store_path(args.input)
+    meta = build_mlm_store(args.input, output, args.bert_model, args.do_lower_case, num_workers=args.num_workers)
+    print('Wrote {} documents, {} paragraphs, {} tokens to {}'.format(meta['num_docs'], meta['num_paras'], meta['num_tokens'], output))
@@ -3,6 +3,7 @@
 # Code is adpated from https://github.com/google-research/bert
 import json
 import collections
+import numpy as np
 
 MaskedLmInstance = collections.namedtuple("MaskedLmInstance",
                                           ["index", "label"])
@@ -202,3 +203,132 @@ def create_instances_from_document(
         i += 1
 
     return instances
+
+
+# Below works on token ids (numpy arrays) and builds only the sampled instance.
+MlmVocab = collections.namedtuple("MlmVocab",
+                                  ["cls_id", "sep_id", "mask_id", "vocab_size", "is_subword"])
+
+
+def build_mlm_vocab(tokenizer):
+    """ids of the special tokens and a bool array marking the "##" word pieces"""
+    vocab = tokenizer.vocab
+    is_subword = np.zeros(len(vocab), dtype=np.bool_)
+    for token, idx in vocab.items():
+        is_subword[idx] = token.startswith("##")
+    return MlmVocab(cls_id=vocab["[CLS]"], sep_id=vocab["[SEP]"], mask_id=vocab["[MASK]"],
+                    vocab_size=len(vocab), is_subword=is_subword)
+
+
+def truncate_seq_pair_ids(ids_a, ids_b, max_num_tokens, rng):
+    """Same result distribution as truncate_seq_pair: the longer side is trimmed one token at a
+    time, from the front or the back with equal probability; computed in closed form.
+    """
+    len_a, len_b = len(ids_a), len(ids_b)
+    if len_a + len_b <= max_num_tokens:
+        return ids_a, ids_b
+    # ties trim b, so when both are trimmed a keeps the extra token
+    short, long_is_a = (len_b, True) if len_a > len_b else (len_a, False)
+    if max_num_tokens - short >= short:
+        new_a, new_b = (max_num_tokens - short, short) if long_is_a else (short, max_num_tokens - short)
+    else:
+        new_a, new_b = (max_num_tokens + 1) // 2, max_num_tokens // 2
+    out = []
+    for ids, new_len in ((ids_a, new_a), (ids_b, new_b)):
+        trim = len(ids) - new_len
+        front = rng.binomial(trim, 0.5) if trim > 0 else 0
+        out.append(ids[front:front + new_len])
+    return out[0], out[1]
+
+
+def create_masked_lm_predictions_ids(token_ids, masked_lm_prob, max_predictions_per_seq, mlm_vocab, rng,
+                                     do_whole_word_mask=True):
+    """Vectorized version of create_masked_lm_predictions on ids.
+    Words are taken in random order while they fit into num_to_predict (the first word which does not
+    fit stops the selection instead of being skipped).
+    Returns (output_ids, masked_lm_positions, masked_lm_labels) as numpy arrays.
+    """
+    token_ids = np.asarray(token_ids)
+    candidate = (token_ids != mlm_vocab.cls_id) & (token_ids != mlm_vocab.sep_id)
+    word_start = candidate.copy()
+    if do_whole_word_mask:
+        prev_candidate = np.concatenate([[False], candidate[:-1]])
+        word_start &= ~(mlm_vocab.is_subword[token_ids] & prev_candidate)
+    word_id = np.cumsum(word_start) - 1
+    num_words = int(word_start.sum())
+    num_to_predict = min(max_predictions_per_seq, max(1, int(round(len(token_ids) * masked_lm_prob))))
+    output_ids = token_ids.copy()
+    if num_words == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return output_ids, empty, empty
+    word_len = np.bincount(word_id[candidate], minlength=num_words)
+    order = rng.permutation(num_words)
+    selected = order[np.cumsum(word_len[order]) <= num_to_predict]
+    is_selected = np.zeros(num_words, dtype=np.bool_)
+    is_selected[selected] = True
+    positions = np.nonzero(candidate & is_selected[word_id])[0]
+    labels = token_ids[positions]
+    # 80% [MASK], 10% original token, 10% random token
+    draw = rng.random(len(positions))
+    to_mask = draw < 0.8
+    to_random = draw >= 0.9
+    output_ids[positions[to_mask]] = mlm_vocab.mask_id
+    output_ids[positions[to_random]] = rng.integers(0, mlm_vocab.vocab_size, int(to_random.sum()))
+    return output_ids, positions, labels
+
+
+def create_instance_from_document_ids(all_documents, document_index, max_seq_length, short_seq_prob,
+                                      masked_lm_prob, max_predictions_per_seq, mlm_vocab, rng):
+    """Builds one MLM/NSP instance of the document, as create_instances_from_document followed by a
+    random choice, without creating the others.
+    all_documents[i] is a list of paragraphs, each an array of token ids.
+    Returns (token_ids, segment_ids, masked_lm_positions, masked_lm_labels, is_random_next).
+    """
+    document = all_documents[document_index]
+    # Account for [CLS], [SEP], [SEP]
+    max_num_tokens = max_seq_length - 3
+    target_seq_length = max_num_tokens
+    if rng.random() < short_seq_prob:
+        target_seq_length = int(rng.integers(2, max_num_tokens + 1))
+
+    # split the paragraphs into chunks of target_seq_length tokens and pick one of them
+    seg_lens = np.array([len(segment) for segment in document])
+    chunk_ends = []
+    current_length = 0
+    for i, seg_len in enumerate(seg_lens):
+        current_length += seg_len
+        if i == len(document) - 1 or current_length >= target_seq_length:
+            chunk_ends.append(i + 1)
+            current_length = 0
+    chunk = int(rng.integers(0, len(chunk_ends)))
+    chunk_start = 0 if chunk == 0 else chunk_ends[chunk - 1]
+    current_chunk = document[chunk_start:chunk_ends[chunk]]
+
+    a_end = 1
+    if len(current_chunk) >= 2:
+        a_end = int(rng.integers(1, len(current_chunk)))
+    ids_a = np.concatenate(current_chunk[:a_end])
+    is_random_next = len(current_chunk) == 1 or rng.random() < 0.5
+    if is_random_next:
+        target_b_length = target_seq_length - len(ids_a)
+        for _ in range(10):
+            random_document_index = int(rng.integers(0, len(all_documents)))
+            if random_document_index != document_index:
+                break
+        random_document = all_documents[random_document_index]
+        random_start = int(rng.integers(0, len(random_document)))
+        random_lens = np.cumsum([len(segment) for segment in random_document[random_start:]])
+        random_end = random_start + min(int(np.searchsorted(random_lens, target_b_length)) + 1, len(random_lens))
+        ids_b = np.concatenate(random_document[random_start:random_end])
+    else:
+        ids_b = np.concatenate(current_chunk[a_end:])
+    ids_a, ids_b = truncate_seq_pair_ids(ids_a, ids_b, max_num_tokens, rng)
+    assert len(ids_a) >= 1
+    assert len(ids_b) >= 1
+
+    token_ids = np.concatenate([[mlm_vocab.cls_id], ids_a, [mlm_vocab.sep_id], ids_b, [mlm_vocab.sep_id]]).astype(np.int64)
+    segment_ids = np.zeros(len(token_ids), dtype=np.int64)
+    segment_ids[len(ids_a) + 2:] = 1
+    token_ids, masked_lm_positions, masked_lm_labels = create_masked_lm_predictions_ids(
+        token_ids, masked_lm_prob, max_predictions_per_seq, mlm_vocab, rng)
+    return token_ids, segment_ids, masked_lm_positions, masked_lm_labels, is_random_next
@@ -456,65 +456,66 @@ def get_final_text(pred_text, orig_text, verbose_logging=False, do_lower_case=Fa
     output_text = orig_text[orig_start_position:(orig_end_position + 1)]
     return output_text
 
-def masking_score(mask, batch_meta, start, end, keep_first_token=False):
+# band masks of valid spans, start <= end < start + max_answer_len, keyed by (max_answer_len, device)
+# the mask is Toeplitz, so the largest one is kept and sliced for shorter sequences
+_SPAN_BAND_MASKS = {}
+
+def span_band_mask(seq_len, max_answer_len, device):
+    key = (max_answer_len, str(device))
+    band = _SPAN_BAND_MASKS.get(key, None)
+    if band is None or band.size(0) < seq_len:
+        idx = torch.arange(seq_len, device=device)
+        span_len = idx.unsqueeze(0) - idx.unsqueeze(1)
+        band = (span_len >= 0) & (span_len < max_answer_len)
+        _SPAN_BAND_MASKS[key] = band
+    return band[:seq_len, :seq_len]
+
+def masking_score(start, end, token_to_orig_map, token_is_max_context):
     """For MRC, e.g., SQuAD
+    Masks out the tokens which are not in the document (query, special and padding tokens)
+    and the starts without max context. Returns log probabilities of start/end.
     """
-    start = start.data.cpu()
-    end = end.data.cpu()
-    score_mask = start.new(mask.size()).zero_()
-    score_mask = score_mask.data.cpu()
-    token_is_max_contexts = batch_meta['token_is_max_context']
-    doc_offsets = batch_meta['doc_offset']
-    word_maps = batch_meta['token_to_orig_map']
-    batch_size = score_mask.size(0)
-    doc_len = score_mask.size(1)
-    for i in range(batch_size):
-        doc_offset = doc_offsets[i]
-        if keep_first_token:
-            score_mask[i][1:doc_offset] = 1.0
-        else:
-            score_mask[i][:doc_offset] = 1.0
-        for j in range(doc_len):
-            sj = str(j)
-            if mask[i][j] == 0:
-                score_mask[i][j] == 1.0
-            if sj in token_is_max_contexts[i] and (not token_is_max_contexts[i][sj]):
-                score_mask[i][j] == 1.0
-    score_mask = score_mask * LARGE_NEG_NUM
-    start = start + score_mask
-    end = end + score_mask
-    start = F.softmax(start, 1)
-    end = F.softmax(end, 1)
-    return start, end
-
-def extract_answer(batch_meta, batch_data, start, end, keep_first_token=False, max_len=5, do_lower_case=False):
-    doc_len = start.size(1)
-    pos_enc = position_encoding(doc_len, max_len)
-    token_is_max_contexts = batch_meta['token_is_max_context']
-    doc_offsets = batch_meta['doc_offset']
-    word_maps = batch_meta['token_to_orig_map']
-    tokens = batch_meta['tokens']
-    contexts = batch_meta['doc']
-    uids = batch_meta['uids']
-    mask = batch_data[batch_meta['mask']].data.cpu()
-    # need to fill mask
-    start, end = masking_score(mask, batch_meta, start, end)
-    #####
+    valid_end = token_to_orig_map >= 0
+    valid_start = valid_end & token_is_max_context
+    start = start.float().masked_fill(~valid_start, LARGE_NEG_NUM)
+    end = end.float().masked_fill(~valid_end, LARGE_NEG_NUM)
+    return F.log_softmax(start, 1), F.log_softmax(end, 1)
+
+def decode_spans(start, end, token_to_orig_map, token_is_max_context, max_answer_len=5, topk=1):
+    """Batched span decoding on the device of the logits.
+    :param start, end: start/end logits, batch_size x seq_len
+    :param token_to_orig_map: index of the original word of each token, -1 if not in the document
+    :param token_is_max_context: whether the token has its max context in this feature
+    :return: scores (start prob * end prob), start and end token index of the top-k spans, batch_size x topk
+    """
+    batch_size, seq_len = start.size()
+    start, end = masking_score(start, end, token_to_orig_map, token_is_max_context)
+    band = span_band_mask(seq_len, max_answer_len, start.device)
+    scores = start.unsqueeze(2) + end.unsqueeze(1)
+    scores = scores.masked_fill_(~band, -float('inf')).view(batch_size, -1)
+    top_scores, top_idx = scores.topk(min(topk, seq_len * seq_len), dim=1)
+    return top_scores.exp(), top_idx // seq_len, top_idx % seq_len
+
+def extract_answer(batch_meta, batch_data, start, end, max_len=5, do_lower_case=False):
+    token_to_orig_map = batch_meta['token_to_orig_map'].to(start.device)
+    token_is_max_context = batch_meta['token_is_max_context'].to(start.device)
+    doc_store = batch_meta.get('doc_store', None)
+    if doc_store is not None:
+        token_ids = batch_data[batch_meta['token_id']].cpu()
+    best_scores, s_idx, e_idx = decode_spans(start, end, token_to_orig_map, token_is_max_context, max_len)
+    word_start = token_to_orig_map.gather(1, s_idx)
+    word_end = token_to_orig_map.gather(1, e_idx)
+    # only the top spans are moved to host
+    best_scores, s_idx, e_idx, word_start, word_end = [t[:, 0].tolist() for t in (best_scores, s_idx, e_idx, word_start, word_end)]
     predictions = []
     answer_scores = []
-
-    for i in range(start.size(0)):
-        uid = uids[i]
-        scores = torch.ger(start[i], end[i])
-        scores = scores * pos_enc
-        scores.triu_()
-        scores = scores.numpy()
-        best_idx = np.argpartition(scores, -1, axis=None)[-1]
-        best_score = np.partition(scores, -1, axis=None)[-1]
-        s_idx, e_idx = np.unravel_index(best_idx, scores.shape)
-        s_idx, e_idx = int(s_idx), int(e_idx)
-        ###
-        tok_tokens = tokens[i][s_idx:(e_idx + 1)]
+    for i in range(len(best_scores)):
+        if doc_store is not None:
+            tok_tokens = doc_store.convert_ids_to_tokens(token_ids[i, s_idx[i]:(e_idx[i] + 1)].tolist())
+            context = doc_store.get_doc(batch_meta['store_index'][i]).split()
+        else:
+            tok_tokens = batch_meta['tokens'][i][s_idx[i]:(e_idx[i] + 1)]
+            context = batch_meta['doc'][i].split()
         tok_text = ' '.join(tok_tokens)
         # De-tokenize WordPieces that have been split off.
         tok_text = tok_text.replace(' ##', '')
@@ -523,14 +524,11 @@ def extract_answer(batch_meta, batch_data, start, end, keep_first_token=False, m
         tok_text = tok_text.strip()
         tok_text = ' '.join(tok_text.split())
         ###
-        context = contexts[i].split()
-        rs = word_maps[i][str(s_idx)]
-        re = word_maps[i][str(e_idx)]
-        raw_answer = ' '.join(context[rs:re+1])
+        raw_answer = ' '.join(context[word_start[i]:word_end[i]+1])
         # extract final answer
         answer = get_final_text(tok_text, raw_answer, False, do_lower_case=do_lower_case)
         predictions.append(answer)
-        answer_scores.append(float(best_score))
+        answer_scores.append(best_scores[i])
     return predictions, answer_scores
 
 def select_answers(ids, predictions, scores):
@@ -546,8 +544,8 @@ def select_answers(ids, predictions, scores):
     scores = {}
     for key, val in predictions_list.items():
         idx = np.argmax([v[1] for v in val])
-        final[key] = val[idx][1]
-        scores[key] = val[idx][0]
+        final[key] = val[idx][0]
+        scores[key] = val[idx][1]
     return final, scores
 
 def merge_answers(ids, golds):
@@ -1,18 +1,20 @@
 # coding=utf-8
 # Copyright (c) Microsoft. All rights reserved.
 """Extract feature vectors.
+
+The features of the selected layers are streamed batch by batch to a binary store, see
+data_utils/feature_store.py; --resume continues an interrupted export.
 """
 import os
 import argparse
 import torch
-import json
 from pytorch_pretrained_bert.tokenization import BertTokenizer
-from torch.utils.data import DataLoader
+from data_utils.feature_store import FeatureWriter, POOLING_MODES, DTYPES
 from data_utils.log_wrapper import create_logger
 from data_utils.utils import set_environment
-from mt_dnn.batcher import Collater, SingleTaskDataset
+from mt_dnn.batcher import Collater
+from mt_dnn.inference import pool_features
 from mt_dnn.model import MTDNNModel
-from prepro_std import _truncate_seq_pair
 from data_utils.task_def import DataFormat, EncoderModelType
 
 logger = create_logger(
@@ -21,12 +23,12 @@ logger = create_logger(
     log_file='mt_dnn_feature_extractor.log')
 
 
-def load_data(file):
-    rows = []
-    cnt = 0
-    is_single_sentence = False
+def load_data(file, skip=0):
+    """yields the samples of a '|||' separated file, one per line, after the first skip lines"""
     with open(file, encoding="utf8") as f:
-        for line in f:
+        for cnt, line in enumerate(f):
+            if cnt < skip:
+                continue
             blocks = line.strip().split('|||')
             if len(blocks) == 2:
                 sample = {
@@ -35,11 +37,17 @@ def load_data(file):
                     'hypothesis': blocks[1],
                     'label': 0}
             else:
-                is_single_sentence = True
                 sample = {'uid': str(cnt), 'premise': blocks[0], 'label': 0}
-            rows.append(sample)
-            cnt += 1
-    return rows, is_single_sentence
+            yield sample
+
+
+def _truncate_seq_pair(tokens_a, tokens_b, max_length):
+    """Truncates a sequence pair in place, the longer one first"""
+    while len(tokens_a) + len(tokens_b) > max_length:
+        if len(tokens_a) > len(tokens_b):
+            tokens_a.pop()
+        else:
+            tokens_b.pop()
 
 
 def build_data(data, max_seq_len, is_train=True, tokenizer=None):
@@ -157,7 +165,8 @@ def train_config(parser):
 
 def set_config(parser):
     parser.add_argument("--finput", default=None, type=str, required=True)
-    parser.add_argument("--foutput", default=None, type=str, required=True)
+    parser.add_argument("--foutput", default=None, type=str, required=True,
+        help='output directory, a feature store (data_utils/feature_store.py)')
     parser.add_argument("--bert_model", default=None, type=str, required=True,
         help='Bert model: bert-base-uncased')
     parser.add_argument( "--checkpoint", default=None, type=str, required=True,
@@ -167,28 +176,28 @@ def set_config(parser):
     parser.add_argument("--layers", default="10,11", type=str)
     parser.add_argument("--max_seq_length", default=512, type=int, help='')
     parser.add_argument("--batch_size", default=4, type=int)
+    parser.add_argument("--pooling", default='full', choices=POOLING_MODES,
+        help='cls: the first token, mean: the mean over the tokens, full: every token')
+    parser.add_argument("--dtype", default='float16', choices=DTYPES)
+    parser.add_argument("--resume", action='store_true',
+        help='append to the samples already in foutput instead of starting over')
+
+
+def batch_samples(args, tokenizer, skip=0):
+    """yields lists of tokenized samples; pairs and single sentences may be mixed"""
+    batch = []
+    for sample in load_data(args.finput, skip=skip):
+        if 'hypothesis' in sample:
+            batch.extend(build_data([sample], max_seq_len=args.max_seq_length, tokenizer=tokenizer))
+        else:
+            batch.extend(build_data_single([sample], max_seq_len=args.max_seq_length, tokenizer=tokenizer))
+        if len(batch) == args.batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
 
 
-def process_data(args):
-    tokenizer = BertTokenizer.from_pretrained(
-        args.bert_model, do_lower_case=args.do_lower_case)
-    path = args.finput
-    data, is_single_sentence = load_data(path)
-    if is_single_sentence:
-        tokened_data = build_data_single(
-            data, max_seq_len=args.max_seq_length, tokenizer=tokenizer)
-    else:
-        tokened_data = build_data(
-            data,
-            max_seq_len=args.max_seq_length,
-            tokenizer=tokenizer)
-    return tokened_data, is_single_sentence
-
-def dump_data(data, path):
-    with open(path, 'w', encoding='utf-8') as writer:
-        for sample in data:
-            writer.write('{}\n'.format(json.dumps(sample)))
-
 def main():
     parser = argparse.ArgumentParser()
     model_config(parser)
@@ -198,18 +207,11 @@ def main():
     encoder_type = args.encoder_type
     layer_indexes = [int(x) for x in args.layers.split(",")]
     set_environment(args.seed)
-    # process data
-    data, is_single_sentence = process_data(args)
-    data_type = DataFormat.PremiseOnly if is_single_sentence else DataFormat.PremiseAndOneHypothesis
-    fout_temp = '{}.tmp'.format(args.finput)
-    dump_data(data, fout_temp)
-    collater = Collater(is_train=False, encoder_type=encoder_type)
-    dataset = SingleTaskDataset(fout_temp, False, maxlen=args.max_seq_length, data_type=data_type)
-    batcher = DataLoader(dataset, batch_size=args.batch_size, collate_fn=collater.collate_fn, pin_memory=args.cuda)
     opt = vars(args)
     # load model
+    device = torch.device('cuda' if args.cuda else 'cpu')
     if os.path.exists(args.checkpoint):
-        state_dict = torch.load(args.checkpoint)
+        state_dict = torch.load(args.checkpoint, map_location=device)
         config = state_dict['config']
         config['dump_feature'] = True
         opt.update(config)
@@ -219,40 +221,31 @@ def main():
             'Could not find the init model!\n The parameters will be initialized randomly!')
         logger.error('#' * 20)
         return
-    num_all_batches = len(batcher)
     model = MTDNNModel(
         opt,
-        state_dict=state_dict,
-        num_train_step=num_all_batches)
-    if args.cuda:
-        model.cuda()
-
-    features_dict = {}
-    for batch_meta, batch_data in batcher:
-        batch_meta, batch_data = Collater.patch_data(args.cuda, batch_meta, batch_data)
-        all_encoder_layers, _ = model.extract(batch_meta, batch_data)
-        embeddings = [all_encoder_layers[idx].detach().cpu().numpy()
-                      for idx in layer_indexes]
-
-        #import pdb; pdb.set_trace()
-        uids = batch_meta['uids']
-        masks = batch_data[batch_meta['mask']].detach().cpu().numpy().tolist()
-        for idx, uid in enumerate(uids):
-            slen = sum(masks[idx])
-            features = {}
-            for yidx, layer in enumerate(layer_indexes):
-                features[layer] = str(embeddings[yidx][idx][:slen].tolist())
-            features_dict[uid] = features
+        device=device,
+        state_dict=state_dict)
 
-    # save features
-    with open(args.foutput, 'w', encoding='utf-8') as writer:
-        for sample in data:
-            uid = sample['uid']
-            tokens = sample['tokens']
-            feature = features_dict[uid]
-            feature['tokens'] = tokens
-            feature['uid'] = uid
-            writer.write('{}\n'.format(json.dumps(feature)))
+    writer = FeatureWriter(args.foutput, layer_indexes, model.network.bert.config.hidden_size,
+                           pooling=args.pooling, dtype=args.dtype, resume=args.resume)
+    if writer.num_samples > 0:
+        logger.info('Resuming after {} samples'.format(writer.num_samples))
+    tokenizer = BertTokenizer.from_pretrained(
+        args.bert_model, do_lower_case=args.do_lower_case)
+    collater = Collater(is_train=False, encoder_type=encoder_type)
+    dtype = torch.float16 if args.dtype == 'float16' else torch.float32
+    with torch.no_grad():
+        for batch in batch_samples(args, tokenizer, skip=writer.num_samples):
+            # only the token ids, segment ids and mask are used
+            batch_meta, batch_data = collater._prepare_model_input(batch, DataFormat.PremiseOnly)
+            batch_meta, batch_data = Collater.patch_data(device, batch_meta, batch_data)
+            all_encoder_layers, _ = model.extract(batch_meta, batch_data)
+            hidden_states = torch.stack([all_encoder_layers[idx] for idx in layer_indexes], dim=2)
+            features, lengths = pool_features(hidden_states, batch_data[batch_meta['mask']], args.pooling)
+            # converted on device, so only the stored precision is copied to the host
+            writer.write(features.to(dtype).cpu().numpy(), lengths.cpu().numpy(), [sample['uid'] for sample in batch])
+    writer.close()
+    logger.info('Wrote the features of {} samples to {}'.format(writer.num_samples, args.foutput))
 
 
 if __name__ == "__main__":
@@ -4,8 +4,8 @@ import filecmp
 import subprocess
 import glob
 import torch
-import json
-import numpy.ma as ma
+import numpy as np
+from data_utils.feature_store import FeatureStore
 
 ENCODE_CMD = """python train.py --train_datasets cola --test_datasets cola \
 --encode_mode \
@@ -22,28 +22,20 @@ def test_encoder(src_dir, checkpoint_path, encoder_type, target_dir, expected_di
     print(cmd)
     subprocess.call(cmd, shell=True, stdout=subprocess.DEVNULL)
 
-    # get masks from unit_test input file (cola_test.json)
-    input_lengths = []
-    with open(os.path.join(src_dir,'cola_test.json'),'r',encoding='utf-8') as fin:
-        for line in fin:
-            json_line = json.loads(line)
-            assert 'token_id' in json_line, "token_id is not in current test file, please check name of token ids in input json"
-            input_lengths.append(len(json_line['token_id']))
+    encoding_0 = FeatureStore(os.path.join(target_dir, "cola_encoding"))
+    encoding_1 = FeatureStore(os.path.join(expected_dir, "cola_encoding"))
+    assert encoding_0.uids == encoding_1.uids
 
-    encoding_0 = torch.load(os.path.join(target_dir, r"cola_encoding.pt"))
-    encoding_1 = torch.load(os.path.join(expected_dir, r"cola_encoding.pt"))
+    # the stores hold the unpadded rows of every sample
+    relative_diffs = []
+    for index in range(len(encoding_1)):
+        sample_0 = torch.from_numpy(np.array(encoding_0[index], dtype=np.float32))
+        sample_1 = torch.from_numpy(np.array(encoding_1[index], dtype=np.float32))
+        assert sample_0.size() == sample_1.size()
+        relative_diffs.append(((sample_0 - sample_1).abs() / ((sample_0 + sample_1) / 2).abs()).view(-1))
+    relative_diff = torch.cat(relative_diffs).mean()
 
-    abs_diff = (encoding_0 - encoding_1).abs()
-    abs_avg = ((encoding_0 + encoding_1)/2).abs()
-
-    tensor_mask = torch.LongTensor(len(input_lengths), max(input_lengths), encoding_0.size()[-1]).fill_(1)
-    for index, input_length in enumerate(input_lengths):
-        tensor_mask[index, :input_length,:] = torch.LongTensor(input_length, encoding_0.size()[-1]).fill_(0)
-
-    relative_diff = abs_diff/abs_avg
-    masked_array = ma.masked_array(relative_diff, mask=tensor_mask)
-
-    assert masked_array.mean() < 1e-4, "relative diff: %s" % masked_array.mean()
+    assert relative_diff < 1e-4, "relative diff: %s" % relative_diff
 
 src_dir = "int_test_data/glue/input/encoder/bert_uncased_lower"
 checkpoint_path = "mt_dnn_models/bert_model_base_uncased.pt"
@@ -1,16 +1,25 @@
 # coding=utf-8
 # Copyright (c) Microsoft. All rights reserved.
 import math
+from collections import OrderedDict
+from functools import lru_cache
 import torch
 from torch.optim import Optimizer
-from torch.nn.utils import clip_grad_norm_
 from pytorch_pretrained_bert.optimization import warmup_constant, warmup_cosine, warmup_linear
 
+# multi-tensor (foreach) kernels are only shipped with recent PyTorch releases,
+# on older ones we fall back to a per-tensor loop doing the same math.
+FOREACH_AVAILABLE = all(hasattr(torch, op) for op in ('_foreach_mul_', '_foreach_add_', '_foreach_add',
+                                                      '_foreach_abs', '_foreach_maximum_', '_foreach_norm',
+                                                      '_foreach_div', '_foreach_sqrt', '_foreach_addcmul_',
+                                                      '_foreach_addcdiv_'))
+
 def warmup_linear_xdl(x, warmup=0.002):
     if x < warmup:
         return x/warmup
     return (1.0 - x)/(1.0 - warmup)
 
+@lru_cache(maxsize=None)
 def schedule_func(sch):
     try:
         f = eval(sch)
@@ -18,6 +27,84 @@ def schedule_func(sch):
         f = warmup_linear
     return f
 
+def scheduled_lr(group, step):
+    if group['t_total'] != -1:
+        schedule_fct = schedule_func(group['schedule'])
+        return group['lr'] * schedule_fct(step/group['t_total'], group['warmup'])
+    return group['lr']
+
+def group_by_step(params, state):
+    """Buckets the parameters having a gradient by (step, device).
+    The schedule is evaluated once per bucket and each bucket is updated with multi-tensor ops.
+    Task heads which are not used in a step keep an older step, so there may be more than one bucket.
+    """
+    buckets = OrderedDict()
+    for p in params:
+        if p.grad is None:
+            continue
+        if p.grad.is_sparse:
+            raise RuntimeError('Sparse gradients are not supported, please consider SparseAdam instead')
+        key = (state[p]['step'], p.device)
+        buckets.setdefault(key, []).append(p)
+    return buckets
+
+def clip_grad_norm_per_tensor_(grads, max_norm):
+    """Same as calling clip_grad_norm_ on every single gradient."""
+    if not FOREACH_AVAILABLE:
+        for grad in grads:
+            clip_coef = max_norm / (grad.norm() + 1e-6)
+            if clip_coef < 1:
+                grad.mul_(clip_coef)
+        return
+    norms = torch.stack(torch._foreach_norm(grads))
+    clip_coefs = (max_norm / (norms + 1e-6)).clamp_(max=1.0)
+    torch._foreach_mul_(grads, clip_coefs.unbind(0))
+
+def adamax_update_(params, grads, exp_avgs, exp_infs, lr, beta1, beta2, eps, weight_decay):
+    if not FOREACH_AVAILABLE:
+        for p, grad, exp_avg, exp_inf in zip(params, grads, exp_avgs, exp_infs):
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            torch.max(exp_inf.mul_(beta2), grad.abs().add_(eps), out=exp_inf)
+            update = exp_avg / (exp_inf + eps)
+            if weight_decay > 0.0:
+                update.add_(p, alpha=weight_decay)
+            p.add_(update, alpha=-lr)
+        return
+    # Update biased first moment estimate.
+    torch._foreach_mul_(exp_avgs, beta1)
+    torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+    # Update the exponentially weighted infinity norm.
+    abs_grads = torch._foreach_abs(grads)
+    torch._foreach_add_(abs_grads, eps)
+    torch._foreach_mul_(exp_infs, beta2)
+    torch._foreach_maximum_(exp_infs, abs_grads)
+    del abs_grads
+    denoms = torch._foreach_add(exp_infs, eps)
+    updates = torch._foreach_div(exp_avgs, denoms)
+    if weight_decay > 0.0:
+        torch._foreach_add_(updates, params, alpha=weight_decay)
+    torch._foreach_add_(params, updates, alpha=-lr)
+
+def radam_update_(params, exp_avgs, exp_avg_sqs, step_size, N_sma, eps, decay):
+    if not FOREACH_AVAILABLE:
+        for p, exp_avg, exp_avg_sq in zip(params, exp_avgs, exp_avg_sqs):
+            if N_sma >= 5:
+                denom = exp_avg_sq.sqrt().add_(eps)
+                p.addcdiv_(exp_avg, denom, value=-step_size)
+            else:
+                p.add_(exp_avg, alpha=-step_size)
+            if decay != 0:
+                p.mul_(1 - decay)
+        return
+    if N_sma >= 5:
+        denoms = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denoms, eps)
+        torch._foreach_addcdiv_(params, exp_avgs, denoms, value=-step_size)
+    else:
+        torch._foreach_add_(params, exp_avgs, alpha=-step_size)
+    if decay != 0:
+        torch._foreach_mul_(params, 1 - decay)
+
 class Adamax(Optimizer):
     """Implements BERT version of Adam algorithm with weight decay fix (and no ).
     Params:
@@ -31,7 +118,8 @@ class Adamax(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
-    by xiaodl 
+    The update is applied with multi-tensor ops on all parameters sharing the same step.
+    by xiaodl
     """
     def __init__(self, params, lr, warmup=-1, t_total=-1, schedule='warmup_linear',
                  betas=(0.9, 0.999), eps=1e-6, weight_decay=0.01,
@@ -58,12 +146,7 @@ class Adamax(Optimizer):
                 state = self.state[p]
                 if len(state) == 0:
                     return [0]
-                if group['t_total'] != -1:
-                    schedule_fct = schedule_func(group['schedule'])
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-                lr.append(lr_scheduled)
+                lr.append(scheduled_lr(group, state['step']))
         return lr
 
     def to(self, device):
@@ -87,62 +170,47 @@ class Adamax(Optimizer):
                 # Exponential moving average of squared gradient values
                 state['exp_inf'] = torch.zeros_like(p.data)
 
+    @torch.no_grad()
     def step(self, closure=None):
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
         for group in self.param_groups:
             for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
-
                 state = self.state[p]
-
                 # State initialization
-                if len(state) == 0:
+                if p.grad is not None and len(state) == 0:
                     state['step'] = 0
                     # Exponential moving average of gradient values
                     state['exp_avg'] = torch.zeros_like(p.data)
                     state['exp_inf'] = torch.zeros_like(p.data)
 
-                exp_avg, exp_inf = state['exp_avg'], state['exp_inf']
-                beta1, beta2 = group['betas']
-                eps = group['eps']
+            beta1, beta2 = group['betas']
+            for (step, _), params in group_by_step(group['params'], self.state).items():
+                grads = [p.grad for p in params]
+                states = [self.state[p] for p in params]
                 # Add grad clipping
                 if group['max_grad_norm'] > 0:
-                    clip_grad_norm_(p, group['max_grad_norm'])
-
-                # Update biased first moment estimate.
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                # Update the exponentially weighted infinity norm.
-                norm_buf = torch.cat([
-                    exp_inf.mul_(beta2).unsqueeze(0),
-                    grad.abs().add_(eps).unsqueeze_(0)
-                ], 0)
-                torch.max(norm_buf, 0, keepdim=False, out=(exp_inf, exp_inf.new().long()))
-                update = exp_avg / (exp_inf + eps)
-
-                if group['weight_decay'] > 0.0:
-                    update += group['weight_decay'] * p.data
-
-                if group['t_total'] != -1:
-                    schedule_fct = schedule_func(group['schedule'])
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-
-                update_with_lr = lr_scheduled * update
-                p.data.add_(-update_with_lr)
-                state['step'] += 1
+                    clip_grad_norm_per_tensor_(grads, group['max_grad_norm'])
+
+                adamax_update_(params, grads,
+                               [state['exp_avg'] for state in states],
+                               [state['exp_inf'] for state in states],
+                               lr=scheduled_lr(group, step),
+                               beta1=beta1,
+                               beta2=beta2,
+                               eps=group['eps'],
+                               weight_decay=group['weight_decay'])
+                for state in states:
+                    state['step'] += 1
 
         return loss
 
 class RAdam(Optimizer):
     """Modified from: https://github.com/LiyuanLucasLiu/RAdam/blob/master/radam.py
+    The update is applied with multi-tensor ops on all parameters sharing the same step.
     """
     def __init__(self, params, lr, warmup=-1, t_total=-1, schedule='warmup_linear',
                  betas=(0.9, 0.999), eps=1e-6, weight_decay=0.001,
@@ -170,12 +238,7 @@ class RAdam(Optimizer):
                 state = self.state[p]
                 if len(state) == 0:
                     return [0]
-                if group['t_total'] != -1:
-                    schedule_fct = schedule_func(group['schedule'])
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-                lr.append(lr_scheduled)
+                lr.append(scheduled_lr(group, state['step']))
         return lr
 
     def to(self, device):
@@ -199,78 +262,80 @@ class RAdam(Optimizer):
                 # Exponential moving average of squared gradient values
                 state['exp_avg_sq'] = torch.zeros_like(p.data)
 
+    def _step_size(self, step, lr_scheduled, beta1, beta2):
+        buffered = self.buffer[int(step % 10)]
+        if step == buffered[0]:
+            N_sma, step_size = buffered[1], buffered[2]
+        else:
+            buffered[0] = step
+            beta2_t = beta2 ** step
+            N_sma_max = 2 / (1 - beta2) - 1
+            N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+            buffered[1] = N_sma
+
+            # more conservative since it's an approximated value
+            if N_sma >= 5:
+                step_size = lr_scheduled * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+            else:
+                step_size = lr_scheduled / (1 - beta1 ** step)
+            buffered[2] = step_size
+        return N_sma, step_size
+
+    @torch.no_grad()
     def step(self, closure=None):
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
-        # set_trace()
         for group in self.param_groups:
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data.float()
-                if grad.is_sparse:
-                    raise RuntimeError('RAdam does not support sparse gradients')
-
-                p_data_fp32 = p.data.float()
-
                 state = self.state[p]
-
                 # State initialization
                 if len(state) == 0:
                     state['step'] = 0
                     # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p_data_fp32)
-                    state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
-                else:
-                    state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
-                    state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
-                eps = group['eps']
+                    state['exp_avg'] = torch.zeros_like(p.data, dtype=torch.float)
+                    state['exp_avg_sq'] = torch.zeros_like(p.data, dtype=torch.float)
+                elif state['exp_avg'].dtype != torch.float:
+                    state['exp_avg'] = state['exp_avg'].float()
+                    state['exp_avg_sq'] = state['exp_avg_sq'].float()
+
+            beta1, beta2 = group['betas']
+            for (step, _), params in group_by_step(group['params'], self.state).items():
+                grads = [p.grad for p in params]
                 # Add grad clipping
                 if group['max_grad_norm'] > 0:
-                    clip_grad_norm_(p, group['max_grad_norm'])
-
-                # Update biased first moment estimate.
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                state['step'] += 1
-
-                if group['t_total'] != -1:
-                    schedule_fct = schedule_func(group['schedule'])
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-
-                buffered = self.buffer[int(state['step'] % 10)]
-                if state['step'] == buffered[0]:
-                    N_sma, step_size = buffered[1], buffered[2]
+                    clip_grad_norm_per_tensor_(grads, group['max_grad_norm'])
+                # the update is done in fp32, half precision tensors are copied
+                grads = [grad.float() for grad in grads]
+                params_fp32 = [p.float() for p in params]
+                states = [self.state[p] for p in params]
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+
+                if FOREACH_AVAILABLE:
+                    torch._foreach_mul_(exp_avgs, beta1)
+                    torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+                    torch._foreach_mul_(exp_avg_sqs, beta2)
+                    torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
                 else:
-                    buffered[0] = state['step']
-                    beta2_t = beta2 ** state['step']
-                    N_sma_max = 2 / (1 - beta2) - 1
-                    N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
-                    buffered[1] = N_sma
-
-                    # more conservative since it's an approximated value
-                    if N_sma >= 5:
-                        step_size = lr_scheduled * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])
-                    else:
-                        step_size = lr_scheduled / (1 - beta1 ** state['step'])
-                    buffered[2] = step_size
-
-                if N_sma >= 5:            
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size, exp_avg, denom)
-                else:
-                    p_data_fp32.add_(-step_size, exp_avg)
-                    
-                if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * lr_scheduled, p_data_fp32)
-
-                p.data.copy_(p_data_fp32)
+                    for grad, exp_avg, exp_avg_sq in zip(grads, exp_avgs, exp_avg_sqs):
+                        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                step += 1
+                for state in states:
+                    state['step'] = step
+
+                lr_scheduled = scheduled_lr(group, step)
+                N_sma, step_size = self._step_size(step, lr_scheduled, beta1, beta2)
+                radam_update_(params_fp32, exp_avgs, exp_avg_sqs, step_size, N_sma,
+                              eps=group['eps'],
+                              decay=group['weight_decay'] * lr_scheduled)
+                for p, p_fp32 in zip(params, params_fp32):
+                    if p is not p_fp32:
+                        p.copy_(p_fp32)
 
         return loss
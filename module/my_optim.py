@@ -6,35 +6,104 @@ from torch.nn import Parameter
 from functools import wraps
 
 class EMA:
-    def __init__(self, gamma, model):
+    """Exponential moving average of the trainable weights.
+    The shadow weights are detached and updated in place every `update_per_steps` calls of update().
+    With `offload` the shadow weights live in (pinned) host memory, so EMA does not cost any device memory.
+    """
+    def __init__(self, gamma, model, update_per_steps=1, offload=False):
         super(EMA, self).__init__()
         self.gamma = gamma
-        self.shadow = {}
+        self.update_per_steps = update_per_steps
         self.model = model
-        self.setup()
+        self.shadow = {}
+        self.num_calls = 0
+        self.swapped = False
+        self.setup(offload)
 
-    def setup(self):
+    def setup(self, offload=False):
+        self.names, self.params = [], []
         for name, para in self.model.named_parameters():
             if para.requires_grad:
-                self.shadow[name] = para.clone()
+                self.names.append(name)
+                self.params.append(para)
+        self.offload = offload and any(para.is_cuda for para in self.params)
+        self.staging = None
+        for name, para in zip(self.names, self.params):
+            if self.offload:
+                self.shadow[name] = self._host_buffer(para).copy_(para.detach())
+            else:
+                self.shadow[name] = para.detach().clone()
+        if self.offload:
+            # host copies of the weights, reused for every update/swap
+            self.staging = [self._host_buffer(para) for para in self.params]
+
+    @staticmethod
+    def _host_buffer(para):
+        return torch.empty(para.size(), dtype=para.dtype, pin_memory=torch.cuda.is_available())
+
     def cuda(self):
+        if self.offload:
+            return
         for k, v in self.shadow.items():
             self.shadow[k] = v.cuda()
 
-    def update(self):
-        for name,para in self.model.named_parameters():
-            if para.requires_grad:
-                self.shadow[name] = (1.0 - self.gamma) * para + self.gamma * self.shadow[name]
+    def _shadow_list(self):
+        return [self.shadow[name] for name in self.names]
 
+    @torch.no_grad()
+    def update(self):
+        self.num_calls += 1
+        if self.num_calls % self.update_per_steps != 0:
+            return
+        assert not self.swapped, "EMA weights are swapped in, swap them out before training"
+        if self.offload:
+            for buf, para in zip(self.staging, self.params):
+                buf.copy_(para.detach(), non_blocking=True)
+            torch.cuda.current_stream().synchronize()
+            weights = self.staging
+        else:
+            weights = [para.detach() for para in self.params]
+        shadow = self._shadow_list()
+        # shadow = gamma * shadow + (1 - gamma) * para
+        if hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(shadow, weights, 1.0 - self.gamma)
+        else:
+            for s, w in zip(shadow, weights):
+                s.lerp_(w, 1.0 - self.gamma)
+
+    @torch.no_grad()
     def swap_parameters(self):
-        for name, para in self.model.named_parameters():
-            if para.requires_grad:
+        """Swaps the model weights and the EMA weights.
+        Device resident shadows are swapped without any copy, offloaded ones through the host staging buffers.
+        """
+        for idx, (name, para) in enumerate(zip(self.names, self.params)):
+            if self.offload:
+                buf = self.staging[idx]
+                buf.copy_(para.data, non_blocking=True)
+                para.data.copy_(self.shadow[name], non_blocking=True)
+                self.staging[idx] = self.shadow[name]
+                self.shadow[name] = buf
+            else:
                 temp_data = para.data
-                para.data = self.shadow[name].data
-                self.shadow[name].data = temp_data
+                para.data = self.shadow[name]
+                self.shadow[name] = temp_data
+        if self.offload:
+            torch.cuda.current_stream().synchronize()
+        self.swapped = not self.swapped
 
     def state_dict(self):
-        return self.shadow
+        """EMA weights on cpu, whether they are swapped in or not"""
+        if self.swapped:
+            return dict((name, para.detach().cpu()) for name, para in zip(self.names, self.params))
+        return dict((name, v.cpu()) for name, v in self.shadow.items())
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        for name, para in zip(self.names, self.params):
+            if name not in state_dict:
+                continue
+            target = para.data if self.swapped else self.shadow[name]
+            target.copy_(state_dict[name])
 
 
 # Adapted from
@@ -121,7 +121,16 @@ class MaskLmHeader(nn.Module):
         self.decoder.weight = embedding_weights
         self.nsp = nn.Linear(embedding_weights.size(1), 2)
 
-    def forward(self, hidden_states):
-        mlm_out = self.decoder(hidden_states)
+    def forward(self, hidden_states, masked_positions=None):
+        """masked_positions: (batch, max_masked) positions of every sample, padded with -1; if given,
+        only those hidden states are projected onto the vocabulary (num_masked * vocab logits, in
+        sample order)
+        """
+        if masked_positions is not None:
+            masked = masked_positions >= 0
+            rows = torch.arange(masked_positions.size(0), device=masked_positions.device).unsqueeze(1).expand_as(masked_positions)
+            mlm_out = self.decoder(hidden_states[rows[masked], masked_positions[masked]])
+        else:
+            mlm_out = self.decoder(hidden_states)
         nsp_out = self.nsp(hidden_states[:, 0, :])
         return mlm_out, nsp_out
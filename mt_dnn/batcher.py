@@ -11,8 +11,10 @@ from data_utils.task_def import EncoderModelType
 import tasks
 from torch.utils.data import Dataset, DataLoader, BatchSampler, Sampler
 from experiments.exp_def import TaskDef
-from experiments.mlm.mlm_utils import truncate_seq_pair, load_loose_json
-from experiments.mlm.mlm_utils import create_instances_from_document, create_masked_lm_predictions
+from experiments.mlm.mlm_utils import truncate_seq_pair
+from experiments.mlm.mlm_utils import build_mlm_vocab, create_instance_from_document_ids
+from data_utils.mrc_store import MRCFeatureStore, mrc_store_path, is_mrc_store
+from data_utils.mlm_store import MLMCorpusStore, mlm_store_path, is_mlm_store
 
 UNK_ID=100
 BOS_ID=101
@@ -30,35 +32,68 @@ def create_bins(bin_size, maxlen):
     return [min(i+bin_size, maxlen) for i in range(0, maxlen, bin_size)]
 
 class DistMultiTaskBatchSampler(Sampler):
-    def __init__(self, datasets, batch_size, mix_opt, extra_task_ratio, rank=0, world_size=1, drop_last=False
-                 ):
+    """Multi-task batches of one rank.
+    By default every rank holds the full datasets and takes its slice of each global batch.
+    With sharded=True the datasets are the rank-local shards (see SingleTaskDataset shard_rank),
+    batches of ceil(batch_size / world_size) are drawn from the local shard, and the ranks agree
+    on the number of batches per task (shorter shards wrap around). The task order comes from an
+    own generator seeded alike on every rank, so all ranks train the same task in each step.
+    """
+    def __init__(self, datasets, batch_size, mix_opt, extra_task_ratio, rank=0, world_size=1, drop_last=False,
+                 sharded=False, seed=2018):
         self.rank = rank
         self.world_size = world_size
         self._datasets = datasets
         self._mix_opt = mix_opt
         self._extra_task_ratio = extra_task_ratio
         self.drop_last = drop_last
+        self.sharded = sharded
+        self._rng = random.Random(seed) if sharded else None
         train_data_list = []
-        for dataset in datasets:
-            train_data_list.append(self._get_shuffled_index_batches(len(dataset), batch_size))
+        if sharded:
+            local_batch_size = -(-batch_size // world_size)
+            num_batches = self._agree_num_batches([-(-len(dataset) // local_batch_size) for dataset in datasets])
+            for dataset, task_num_batches in zip(datasets, num_batches):
+                train_data_list.append(self._get_shuffled_index_batches(len(dataset), local_batch_size, task_num_batches, self._rng))
+        else:
+            for dataset in datasets:
+                train_data_list.append(self._get_shuffled_index_batches(len(dataset), batch_size))
         self._train_data_list = train_data_list
 
     @staticmethod
-    def _get_shuffled_index_batches(dataset_len, batch_size):
+    def _get_shuffled_index_batches(dataset_len, batch_size, num_batches=None, rng=None):
         index_batches = [list(range(i, min(i+batch_size, dataset_len))) for i in range(0, dataset_len, batch_size)]
-        random.shuffle(index_batches)
+        if num_batches is not None and len(index_batches) < num_batches:
+            if len(index_batches) == 0:
+                raise ValueError('empty data shard, there are fewer samples than ranks')
+            # other ranks have more batches of this task; repeat the local ones
+            index_batches = [index_batches[i % len(index_batches)] for i in range(num_batches)]
+        (rng or random).shuffle(index_batches)
         return index_batches
 
+    @staticmethod
+    def _agree_num_batches(num_batches):
+        """the largest number of batches per task over all ranks"""
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+            return num_batches
+        device = 'cuda' if torch.distributed.get_backend() == 'nccl' else 'cpu'
+        counts = torch.tensor(num_batches, dtype=torch.int64, device=device)
+        torch.distributed.all_reduce(counts, op=torch.distributed.ReduceOp.MAX)
+        return counts.tolist()
+
     def __len__(self):
         return sum(len(train_data) for train_data in self._train_data_list)
 
     def __iter__(self):
         all_iters = [iter(item) for item in self._train_data_list]
-        all_indices = self._gen_task_indices(self._train_data_list, self._mix_opt, self._extra_task_ratio)
+        all_indices = self._gen_task_indices(self._train_data_list, self._mix_opt, self._extra_task_ratio, rng=self._rng)
         for local_task_idx in all_indices:
             task_id = self._datasets[local_task_idx].get_task_id()
             batch = next(all_iters[local_task_idx])
             batch = [(task_id, sample_id) for sample_id in batch]
+            if self.sharded:
+                yield batch
+                continue
             if len(batch) % self.world_size != 0:
                 if self.drop_last:
                     break
@@ -70,7 +105,10 @@ class DistMultiTaskBatchSampler(Sampler):
             yield batch[self.rank * chunk_size: (self.rank+1) * chunk_size]
 
     @staticmethod
-    def _gen_task_indices(train_data_list, mix_opt, extra_task_ratio):
+    def _gen_task_indices(train_data_list, mix_opt, extra_task_ratio, rng=None):
+        """rng: random.Random used instead of the global generators"""
+        np_random = np.random if rng is None else np.random.RandomState(rng.randrange(2 ** 32))
+        rng = rng or random
         all_indices = []
         if len(train_data_list) > 1 and extra_task_ratio > 0:
             main_indices = [0] * len(train_data_list[0])
@@ -78,10 +116,10 @@ class DistMultiTaskBatchSampler(Sampler):
             for i in range(1, len(train_data_list)):
                 extra_indices += [i] * len(train_data_list[i])
             random_picks = int(min(len(train_data_list[0]) * extra_task_ratio, len(extra_indices)))
-            extra_indices = np.random.choice(extra_indices, random_picks, replace=False)
+            extra_indices = np_random.choice(extra_indices, random_picks, replace=False)
             if mix_opt > 0:
                 extra_indices = extra_indices.tolist()
-                random.shuffle(extra_indices)
+                rng.shuffle(extra_indices)
                 all_indices = extra_indices + main_indices
             else:
                 all_indices = main_indices + extra_indices.tolist()
@@ -90,42 +128,38 @@ class DistMultiTaskBatchSampler(Sampler):
             for i in range(1, len(train_data_list)):
                 all_indices += [i] * len(train_data_list[i])
             if mix_opt > 0:
-                random.shuffle(all_indices)
+                rng.shuffle(all_indices)
             all_indices += [0] * len(train_data_list[0])
         if mix_opt < 1:
-            random.shuffle(all_indices)
+            rng.shuffle(all_indices)
         return all_indices
 
 class DistSingleTaskBatchSampler(Sampler):
+    """Evaluation batches of one rank: the ranks get consecutive blocks of the data, which differ
+    in size by at most one sample. Nothing is padded or repeated, so gathering the outputs of the
+    ranks in rank order gives back every sample once in the data order.
+    """
     def __init__(self, dataset, batch_size, rank=0, world_size=1, drop_last=False):
         self.rank = rank
         self.world_size = world_size
         self._dataset = dataset
         self.drop_last = drop_last
-        self._data = self._get_index_batches(len(dataset), batch_size)
+        self._data = self._get_index_batches(len(dataset), batch_size, rank, world_size)
+        self.num_samples = sum(len(batch) for batch in self._data)
 
     @staticmethod
-    def _get_index_batches(dataset_len, batch_size):
-        index_batches = [list(range(i, min(i+batch_size, dataset_len))) for i in range(0, dataset_len, batch_size)]
+    def _get_index_batches(dataset_len, batch_size, rank=0, world_size=1):
+        start, end = dataset_len * rank // world_size, dataset_len * (rank + 1) // world_size
+        index_batches = [list(range(i, min(i+batch_size, end))) for i in range(start, end, batch_size)]
         return index_batches
 
     def __len__(self):
         return len(self._data) 
 
     def __iter__(self):
-        indices = iter(self._data)
-        for batch in indices:
-            task_id = self._dataset.get_task_id()
-            #batch = next(indices)
-            batch = [(task_id, sample_id) for sample_id in batch]
-            yield batch
-            #if len(batch) % self.world_size != 0:
-            #    if self.drop_last:
-            #        break
-            #    else:
-            #        batch.extend([batch[0] for _ in range(self.world_size-len(batch) % self.world_size)])
-            #chunk_size = len(batch) // self.world_size
-            #yield batch[self.rank * chunk_size: (self.rank+1) * chunk_size]
+        task_id = self._dataset.get_task_id()
+        for batch in self._data:
+            yield [(task_id, sample_id) for sample_id in batch]
 
 class MultiTaskBatchSampler(BatchSampler):
     def __init__(self, datasets, batch_size, mix_opt, extra_task_ratio, bin_size=64, bin_on=False, bin_grow_ratio=0.5):
@@ -256,8 +290,12 @@ class SingleTaskDataset(Dataset):
                  short_seq_prob=0.1,
                  max_seq_length=512,
                  max_predictions_per_seq=80,
-                 printable=True):
-        data, tokenizer = self.load(path, is_train, maxlen, factor, task_def, bert_model, do_lower_case, printable=printable)
+                 printable=True,
+                 shard_rank=0,
+                 num_shards=1):
+        """shard_rank/num_shards: only every num_shards-th sample, starting at shard_rank, is loaded"""
+        data, tokenizer = self.load(path, is_train, maxlen, factor, task_def, bert_model, do_lower_case, printable=printable,
+                                    shard_rank=shard_rank, num_shards=num_shards)
         self._data = data
         self._tokenizer = tokenizer
         self._task_id = task_id
@@ -265,44 +303,70 @@ class SingleTaskDataset(Dataset):
         # below is for MLM
         if self._task_def.task_type is TaskType.MaskLM:
             assert tokenizer is not None
-        # init vocab words
-        self._vocab_words = None if tokenizer is None else list(self._tokenizer.vocab.keys())
+        self._mlm_vocab = None if tokenizer is None else build_mlm_vocab(tokenizer)
         self._masked_lm_prob = masked_lm_prob
         self._seed = seed
         self._short_seq_prob = short_seq_prob
         self._max_seq_length = max_seq_length
         self._max_predictions_per_seq = max_predictions_per_seq
-        self._rng = random.Random(seed)
+        self._rng = None
+        self._rng_worker = None
         self.maxlen = maxlen
 
     def get_task_id(self):
         return self._task_id
 
     @staticmethod
-    def load(path, is_train=True, maxlen=512, factor=1.0, task_def=None, bert_model='bert-base-uncased', do_lower_case=True, printable=True):
+    def load(path, is_train=True, maxlen=512, factor=1.0, task_def=None, bert_model='bert-base-uncased', do_lower_case=True, printable=True,
+             shard_rank=0, num_shards=1):
         task_type = task_def.task_type
         assert task_type is not None
 
         if task_type == TaskType.MaskLM:
+            if is_mlm_store(mlm_store_path(path)):
+                # pre-tokenized by experiments/mlm/mlm_prepro.py; the store provides the vocab
+                data = MLMCorpusStore(mlm_store_path(path))
+                if num_shards > 1:
+                    data = data.select(np.arange(shard_rank, len(data), num_shards))
+                if printable:
+                    print('Loaded {} documents, {} tokens'.format(len(data), data.num_tokens))
+                return data, data
+
             def load_mlm_data(path):
                 from pytorch_pretrained_bert.tokenization import BertTokenizer
                 tokenizer = BertTokenizer.from_pretrained(bert_model,
                                                           do_lower_case=do_lower_case)
-                vocab_words = list(tokenizer.vocab.keys())
-                data = load_loose_json(path)
                 docs = []
+                with open(path, 'r', encoding='utf-8') as reader:
+                    data = [json.loads(line) for idx, line in enumerate(reader) if idx % num_shards == shard_rank]
                 for doc in data:
                     paras = doc['text'].split('\n\n')
                     paras = [para.strip() for para in paras if len(para.strip()) > 0]
-                    tokens = [tokenizer.tokenize(para) for para in paras]
-                    docs.append(tokens)
+                    # documents are kept as arrays of token ids
+                    ids = [np.array(tokenizer.convert_tokens_to_ids(tokenizer.tokenize(para)), dtype=np.int32) for para in paras]
+                    ids = [para for para in ids if len(para) > 0]
+                    if len(ids) > 0:
+                        docs.append(ids)
                 return docs, tokenizer
             return load_mlm_data(path)
 
+        if task_def.data_type == DataFormat.MRC and is_mrc_store(mrc_store_path(path)):
+            data = MRCFeatureStore(mrc_store_path(path))
+            cnt = len(data)
+            if is_train or num_shards > 1:
+                indices = np.nonzero(data.seq_lens() <= maxlen)[0] if is_train else np.arange(cnt)
+                data = data.select(indices[shard_rank::num_shards])
+            if printable:
+                print('Loaded {} samples out of {}'.format(len(data), cnt))
+            return data, None
+
         with open(path, 'r', encoding='utf-8') as reader:
             data = []
             cnt = 0
-            for line in reader:
+            for idx, line in enumerate(reader):
+                if idx % num_shards != shard_rank:
+                    # the line is not even parsed
+                    continue
                 sample = json.loads(line)
                 sample['factor'] = factor
                 cnt += 1
@@ -322,28 +386,37 @@ class SingleTaskDataset(Dataset):
     def __len__(self):
         return len(self._data)
 
+    def _get_rng(self):
+        """numpy generator of the current DataLoader worker, seeded from the dataset seed and the
+        worker seed (which torch changes every epoch)
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        worker_seed = None if worker_info is None else worker_info.seed
+        if self._rng is None or self._rng_worker != worker_seed:
+            seed = [self._seed] if worker_seed is None else [self._seed, worker_seed]
+            self._rng = np.random.default_rng(seed)
+            self._rng_worker = worker_seed
+        return self._rng
+
     def __getitem__(self, idx):
         if self._task_def.task_type == TaskType.MaskLM:
             # create a MLM instance
-            instances = create_instances_from_document(self._data,
-                                                       idx,
-                                                       self._max_seq_length,
-                                                       self._short_seq_prob,
-                                                       self._masked_lm_prob,
-                                                       self._max_predictions_per_seq,
-                                                       self._vocab_words,
-                                                       self._rng)
-            instance_ids = list(range(0, len(instances)))
-            choice = np.random.choice(instance_ids, 1)[0]
-            instance = instances[choice]
-            labels = self._tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
-            position = instance.masked_lm_positions
-            labels = [lab if idx in position else -1 for idx, lab in enumerate(labels)]
-            sample = {'token_id': self._tokenizer.convert_tokens_to_ids(instance.tokens),
-                      'type_id': instance.segment_ids,
-                      'nsp_lab': 1 if instance.is_random_next else 0,
-                      'position': instance.masked_lm_positions,
-                      'label': labels,
+            token_ids, segment_ids, position, masked_labels, is_random_next = create_instance_from_document_ids(
+                self._data,
+                idx,
+                self._max_seq_length,
+                self._short_seq_prob,
+                self._masked_lm_prob,
+                self._max_predictions_per_seq,
+                self._mlm_vocab,
+                self._get_rng())
+            labels = np.full(len(token_ids), -1, dtype=np.int64)
+            labels[position] = masked_labels
+            sample = {'token_id': token_ids.tolist(),
+                      'type_id': segment_ids.tolist(),
+                      'nsp_lab': 1 if is_random_next else 0,
+                      'position': position.tolist(),
+                      'label': labels.tolist(),
                       'uid': idx}
             return {"task": {"task_id": self._task_id, "task_def": self._task_def},
                     "sample": sample}
@@ -358,7 +431,9 @@ class Collater:
                  soft_label=False,
                  encoder_type=EncoderModelType.BERT,
                  max_seq_len=512,
-                 do_padding=False):
+                 do_padding=False,
+                 bi_encoder=False):
+        """bi_encoder: ranking pairs are split into premises and hypotheses, encoded separately"""
         self.is_train = is_train
         self.dropout_w = dropout_w
         self.soft_label_on = soft_label
@@ -366,6 +441,7 @@ class Collater:
         self.pairwise_size = 1
         self.max_seq_len = max_seq_len
         self.do_padding = do_padding 
+        self.bi_encoder = bi_encoder
 
     def __random_select__(self, arr):
         if self.dropout_w > 0:
@@ -374,21 +450,24 @@ class Collater:
 
     @staticmethod
     def patch_data(device, batch_info, batch_data):
-        if str(device) != "cpu":
+        """moves the batch to device; nothing is copied for the CPU"""
+        device = torch.device(device)
+        if device.type != "cpu":
+            def to_device(tensor):
+                return tensor.pin_memory().to(device, non_blocking=True)
             for i, part in enumerate(batch_data):
                 if part is None:
                     continue
                 if isinstance(part, torch.Tensor):
-                    batch_data[i] = part.pin_memory().to(device)
+                    batch_data[i] = to_device(part)
                 elif isinstance(part, tuple):
-                    batch_data[i] = tuple(sub_part.pin_memory().to(device) for sub_part in part)
+                    batch_data[i] = tuple(to_device(sub_part) for sub_part in part)
                 elif isinstance(part, list):
-                    batch_data[i] = [sub_part.pin_memory().to(device) for sub_part in part]
+                    batch_data[i] = [to_device(sub_part) for sub_part in part]
                 else:
                     raise TypeError("unknown batch data type at %s: %s" % (i, part))
-                    
-                if "soft_label" in batch_info:
-                    batch_info["soft_label"] = batch_info["soft_label"].pin_memory().to(device)
+            if "soft_label" in batch_info:
+                batch_info["soft_label"] = to_device(batch_info["soft_label"])
         return batch_info, batch_data
 
 
@@ -406,6 +485,30 @@ class Collater:
                 newbatch.append({'uid': uid, 'token_id': token_id, 'type_id': type_id, 'label':sample['label'], 'true_label': olab})
         return newbatch
 
+    @staticmethod
+    def split_pair(token_id):
+        """premise and hypothesis of a [CLS] premise [SEP] hypothesis [SEP] sequence (RoBERTa has two
+        separators in the middle), each as a single sequence with the first and last token
+        """
+        sep = token_id[-1]
+        end = token_id.index(sep) + 1
+        start = end
+        while start < len(token_id) - 1 and token_id[start] == sep:
+            start += 1
+        return token_id[:end], token_id[:1] + token_id[start:]
+
+    def split_pairs(self, batch):
+        """the premises (once per group of pairwise_size pairs) and all the hypotheses of a rebatched
+        ranking batch, as single sequences
+        """
+        premises, hypotheses = [], []
+        for idx, sample in enumerate(batch):
+            premise, hypothesis = self.split_pair(sample['token_id'])
+            if idx % self.pairwise_size == 0:
+                premises.append({'token_id': premise, 'type_id': [0] * len(premise)})
+            hypotheses.append({'token_id': hypothesis, 'type_id': [0] * len(hypothesis)})
+        return premises, hypotheses
+
     def __if_pair__(self, data_type):
         return data_type in [DataFormat.PremiseAndOneHypothesis, DataFormat.PremiseAndMultiHypothesis]
 
@@ -426,9 +529,17 @@ class Collater:
             batch = self.rebatch(batch)
 
         # prepare model input
-        batch_info, batch_data = self._prepare_model_input(batch, data_type)
+        if task_type == TaskType.Ranking and self.bi_encoder:
+            premises, hypotheses = self.split_pairs(batch)
+            batch_info, batch_data = self._prepare_model_input(premises, DataFormat.PremiseOnly)
+            candidates = self._prepare_model_input(hypotheses, DataFormat.PremiseOnly)[1]
+        else:
+            batch_info, batch_data = self._prepare_model_input(batch, data_type)
         batch_info['task_id'] = task_id  # used for select correct decoding head
         batch_info['input_len'] = len(batch_data)  # used to select model inputs
+        if task_type == TaskType.Ranking and self.bi_encoder:
+            batch_data.append(tuple(candidates))
+            batch_info['candidates'] = len(batch_data) - 1
         # select different loss function and other difference in training and testing
         # DataLoader will convert any unknown type objects to dict, 
         # the conversion logic also convert Enum to repr(Enum), which is a string and undesirable
@@ -464,14 +575,19 @@ class Collater:
                 batch_data.append(tlab)
                 batch_info['label'] = len(batch_data) - 1
             elif task_type == TaskType.MaskLM:
-                batch_size = self._get_batch_size(batch)
+                # only the masked positions are scored by the LM head; they are per sample, padded
+                # with -1, so that DataParallel splits them with the batch
                 tok_len = self._get_max_len(batch, key='token_id')
-                tlab = torch.LongTensor(batch_size, tok_len).fill_(-1)
-                for i, label in enumerate(labels):
-                    ll = len(label)
-                    tlab[i, : ll] = torch.LongTensor(label)
+                positions = [[pos for pos in sample['position'] if pos < tok_len] for sample in batch]
+                masked_positions = torch.LongTensor(len(batch), max([len(position) for position in positions] + [0])).fill_(-1)
+                mlm_labels = []
+                for i, (sample, position) in enumerate(zip(batch, positions)):
+                    masked_positions[i, :len(position)] = torch.LongTensor(position)
+                    mlm_labels.extend(sample['label'][pos] for pos in position)
+                batch_data.append(masked_positions)
+                batch_info['masked_positions'] = len(batch_data) - 1
                 labels = torch.LongTensor([sample['nsp_lab'] for sample in batch])
-                batch_data.append((tlab, labels))
+                batch_data.append((torch.LongTensor(mlm_labels), labels))
                 batch_info['label'] = len(batch_data) - 1
 
             # soft label generated by ensemble models for knowledge distillation
@@ -488,11 +604,17 @@ class Collater:
                 if task_type == TaskType.Ranking:
                     batch_info['true_label'] = [sample['true_label'] for sample in batch]
                 if task_type == TaskType.Span:
-                    batch_info['token_to_orig_map'] = [sample['token_to_orig_map'] for sample in batch]
-                    batch_info['token_is_max_context'] = [sample['token_is_max_context'] for sample in batch]
+                    token_to_orig_map, token_is_max_context = self._prepare_span_maps(batch)
+                    batch_info['token_to_orig_map'] = token_to_orig_map
+                    batch_info['token_is_max_context'] = token_is_max_context
                     batch_info['doc_offset'] = [sample['doc_offset'] for sample in batch]
-                    batch_info['doc'] = [sample['doc'] for sample in batch]
-                    batch_info['tokens'] = [sample['tokens'] for sample in batch]
+                    if 'doc_store' in batch[0]:
+                        # documents and tokens are fetched from the store for the predicted spans only
+                        batch_info['doc_store'] = batch[0]['doc_store']
+                        batch_info['store_index'] = [sample['store_index'] for sample in batch]
+                    else:
+                        batch_info['doc'] = [sample['doc'] for sample in batch]
+                        batch_info['tokens'] = [sample['tokens'] for sample in batch]
                     batch_info['answer'] = [sample['answer'] for sample in batch]
 
         batch_info['uids'] = [sample['uid'] for sample in batch]  # used in scoring
@@ -503,6 +625,26 @@ class Collater:
         tok_len = self.max_seq_len if self.do_padding else tok_len
         return tok_len
 
+    def _prepare_span_maps(self, batch):
+        """Token to original word index (-1 if the token is not in the document) and max context flag,
+        as batch_size x seq_len tensors for span decoding
+        """
+        batch_size = self._get_batch_size(batch)
+        tok_len = self._get_max_len(batch, key='token_id')
+        token_to_orig_map = torch.LongTensor(batch_size, tok_len).fill_(-1)
+        token_is_max_context = torch.BoolTensor(batch_size, tok_len).fill_(0)
+        for i, sample in enumerate(batch):
+            if isinstance(sample['token_to_orig_map'], np.ndarray):
+                select_len = min(len(sample['token_to_orig_map']), tok_len)
+                token_to_orig_map[i, :select_len] = torch.from_numpy(sample['token_to_orig_map'][:select_len].astype(np.int64))
+                token_is_max_context[i, :select_len] = torch.from_numpy(sample['token_is_max_context'][:select_len])
+                continue
+            positions = [int(pos) for pos in sample['token_to_orig_map'].keys()]
+            token_to_orig_map[i, positions] = torch.LongTensor(list(sample['token_to_orig_map'].values()))
+            positions = [int(pos) for pos in sample['token_is_max_context'].keys()]
+            token_is_max_context[i, positions] = torch.BoolTensor(list(sample['token_is_max_context'].values()))
+        return token_to_orig_map, token_is_max_context
+
     def _get_batch_size(self, batch):
         return len(batch)
 
@@ -0,0 +1,108 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Confidence-gated cascade of a small and a large checkpoint of a classification task: every
+batch is scored by the small model, and only its samples with a confidence below the threshold
+are scored again by the large model, as a smaller batch cut to their longest sequence.
+CascadeModel has the predict of MTDNNModel, so it goes to eval_model as is.
+"""
+import torch
+import torch.nn.functional as F
+from data_utils.task_def import TaskType
+from mt_dnn.batcher import Collater
+
+CONFIDENCE_MODES = ('prob', 'margin')
+
+
+def confidence(logits, mode='prob'):
+    """prob: the probability of the predicted class; margin: its difference to the runner-up"""
+    prob = F.softmax(logits.float(), dim=-1)
+    if mode == 'prob':
+        return prob.max(-1)[0]
+    if mode == 'margin':
+        top = prob.topk(2, dim=-1)[0]
+        return top[:, 0] - top[:, 1]
+    raise ValueError('unknown confidence {}, expected one of {}'.format(mode, CONFIDENCE_MODES))
+
+
+def select_rows(batch_meta, batch_data, rows):
+    """the model inputs of the given rows of a batch, without the padding none of them needs"""
+    inputs = batch_data[:batch_meta['input_len']]
+    length = int(inputs[batch_meta['mask']][rows].sum(1).max())
+    return dict(batch_meta), [part[rows][:, :length] for part in inputs]
+
+
+def score_dev(small, large, data, device, mode='prob'):
+    """the confidences of the small model on labelled batches and whether each model is right"""
+    confidences, small_correct, large_correct = [], [], []
+    for batch_meta, batch_data in data:
+        batch_meta, batch_data = Collater.patch_data(device, batch_meta, batch_data)
+        label = torch.tensor(batch_meta['label'], device=device)
+        small_logits = small.predict_logits(batch_meta, batch_data)
+        confidences.append(confidence(small_logits, mode))
+        small_correct.append(small_logits.argmax(-1) == label)
+        large_correct.append(large.predict_logits(batch_meta, batch_data).argmax(-1) == label)
+    return torch.cat(confidences).cpu(), torch.cat(small_correct).cpu(), torch.cat(large_correct).cpu()
+
+
+def calibrate_threshold(confidences, small_correct, large_correct, max_drop=0.0):
+    """The threshold with the fewest deferrals whose cascade accuracy is at most max_drop below
+    the one of the large model, from the dev set confidences of the small model and whether each
+    model is right on every sample. Returns the threshold and the dev deferral rate.
+    """
+    num_samples = confidences.numel()
+    order = torch.argsort(confidences, descending=True)
+    small_correct = small_correct[order].float()
+    large_correct = large_correct[order].float()
+    # with the first k samples kept by the small model, for k = 0 .. n
+    kept = torch.cat([small_correct.new_zeros(1), small_correct.cumsum(0)])
+    deferred = torch.cat([large_correct.flip(0).cumsum(0).flip(0), large_correct.new_zeros(1)])
+    accuracy = (kept + deferred) / num_samples
+    target = large_correct.mean() - max_drop
+    # ties keep or defer together
+    sorted_confidences = confidences[order]
+    valid = torch.ones(num_samples + 1, dtype=torch.bool)
+    valid[1:-1] = sorted_confidences[1:] < sorted_confidences[:-1]
+    candidates = ((accuracy >= target - 1e-12) & valid).nonzero().squeeze(1)
+    num_kept = int(candidates.max())
+    if num_kept == num_samples:
+        threshold = float('-inf')
+    elif num_kept == 0:
+        threshold = float('inf')
+    else:
+        threshold = (sorted_confidences[num_kept - 1].item() + sorted_confidences[num_kept].item()) / 2
+    return threshold, 1.0 - num_kept / num_samples
+
+
+class CascadeModel(object):
+    """small, large: MTDNNModels of the same task; samples whose small model confidence
+    (CONFIDENCE_MODES) is below threshold go to the large model.
+    stats counts the samples and the deferred ones since reset_stats.
+    """
+    def __init__(self, small, large, threshold, mode='prob'):
+        if mode not in CONFIDENCE_MODES:
+            raise ValueError('unknown confidence {}, expected one of {}'.format(mode, CONFIDENCE_MODES))
+        self.small = small
+        self.large = large
+        self.threshold = threshold
+        self.mode = mode
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = [0, 0]
+
+    @property
+    def deferral_rate(self):
+        return self.stats[1] / self.stats[0] if self.stats[0] > 0 else 0.0
+
+    def predict(self, batch_meta, batch_data, score_mode='full'):
+        task_type = TaskType(batch_meta['task_def']['task_type'])
+        if task_type != TaskType.Classification:
+            raise ValueError('a cascade needs a classification task, not {}'.format(task_type.name))
+        logits = self.small.predict_logits(batch_meta, batch_data)
+        deferred = (confidence(logits, self.mode) < self.threshold).nonzero().squeeze(1)
+        self.stats[0] += logits.size(0)
+        self.stats[1] += deferred.numel()
+        if deferred.numel() > 0:
+            logits = logits.clone()
+            logits[deferred] = self.large.predict_logits(*select_rows(batch_meta, batch_data, deferred)).to(logits.dtype)
+        return self.small.decode(batch_meta, batch_data, logits, score_mode)
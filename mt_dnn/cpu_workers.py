@@ -0,0 +1,84 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Multi-process CPU inference with one copy of the weights.
+
+The model is loaded once, without the optimizer state, and its tensors are moved to shared
+memory; the workers are forked from that process, so they map the same weights instead of each
+loading a checkpoint. Every worker is pinned to its own block of cores with one intra-op thread
+per core, and the workers form a gloo process group: with the data split by
+DistSingleTaskBatchSampler, eval_model(dist_gather=True) gathers the outputs to worker 0.
+"""
+import os
+import socket
+import torch
+import torch.multiprocessing as mp
+from multiprocessing.connection import wait
+from data_utils.utils import init_distributed
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_groups(num_workers, cores=None):
+    """consecutive blocks of cores, one per worker; with more workers than cores they share them"""
+    cores = cores or available_cores()
+    if num_workers >= len(cores):
+        return [[cores[rank % len(cores)]] for rank in range(num_workers)]
+    return [cores[len(cores) * rank // num_workers:len(cores) * (rank + 1) // num_workers] for rank in range(num_workers)]
+
+
+def share_weights(*models):
+    """moves the weights of MTDNNModels to shared memory, before the workers are forked"""
+    for model in models:
+        model.network.share_memory()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _worker(fn, rank, world_size, cores, num_threads, port, pin_cores):
+    if pin_cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    # init_distributed keeps the thread count when OMP_NUM_THREADS is set
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    init_distributed(rank, rank, world_size, world_size, use_cuda=False)
+    try:
+        fn(rank, world_size)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def run_workers(fn, num_workers, num_threads=None, pin_cores=True):
+    """Forks num_workers processes which run fn(rank, world_size) in a gloo process group and
+    waits for them. num_threads: intra-op threads per worker, by default the cores it is given.
+    If a worker fails, the others are stopped and RuntimeError is raised.
+    """
+    context = mp.get_context('fork')
+    port = _free_port()
+    processes = []
+    for rank, cores in enumerate(core_groups(num_workers)):
+        process = context.Process(target=_worker, args=(fn, rank, num_workers, cores, num_threads or len(cores), port,
+                                                        pin_cores))
+        process.start()
+        processes.append(process)
+    running = list(processes)
+    while running:
+        for sentinel in wait([process.sentinel for process in running]):
+            process = next(process for process in running if process.sentinel == sentinel)
+            process.join()
+            running.remove(process)
+            if process.exitcode != 0:
+                for other in running:
+                    other.terminate()
+                    other.join()
+                raise RuntimeError('inference worker {} exited with {}'.format(processes.index(process),
+                                                                               process.exitcode))
@@ -0,0 +1,152 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Ensembles of checkpoints scored in a single pass over the data: every batch is collated once,
+scored by all the models, in this process or in worker processes, and the outputs are averaged
+on the fly. EnsembleModel has the predict of MTDNNModel, so it goes to eval_model as is.
+"""
+import os
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from data_utils.task_def import TaskType
+from mt_dnn.batcher import Collater
+from mt_dnn.model import MTDNNModel
+
+AVERAGE_MODES = ('prob', 'logit')
+
+
+def load_model(checkpoint, task_def, device, use_ema=False, config_updates=None):
+    """a checkpoint set up for predicting task_def, as predict.py does"""
+    state_dict = torch.load(checkpoint, map_location=device)
+    config = state_dict['config']
+    config['cuda'] = device.type == 'cuda'
+    config['task_def_list'] = [task_def]
+    ## temp fix
+    config['fp16'] = False
+    config['answer_opt'] = 0
+    config['adv_train'] = False
+    if use_ema and 'ema' in state_dict:
+        state_dict['state'].update(state_dict['ema'])
+    config['ema_opt'] = 0
+    config.update(config_updates or {})
+    state_dict.pop('ema', None)
+    state_dict.pop('optimizer', None)
+    return MTDNNModel(config, device=device, state_dict=state_dict)
+
+
+def combine_logits(logits, weights, average, task_type, pairwise_size=1):
+    """Weighted average of the task head outputs of the models. With average 'prob', class
+    distributions (classification, ranking groups, tags) are averaged and their log is returned,
+    which the softmax of MTDNNModel.decode turns back into the averaged probabilities.
+    Regression outputs and span logits are always averaged as they are.
+    """
+    total = float(sum(weights))
+    if task_type == TaskType.Span:
+        return tuple(sum(w * logit[i] for w, logit in zip(weights, logits)) / total for i in range(2))
+    if average == 'logit' or task_type == TaskType.Regression:
+        return sum(w * logit for w, logit in zip(weights, logits)) / total
+    shape = logits[0].shape
+    if task_type == TaskType.Ranking:
+        logits = [logit.reshape(-1, pairwise_size) for logit in logits]
+    prob = sum(w * F.softmax(logit.float(), dim=-1) for w, logit in zip(weights, logits)) / total
+    return torch.log(prob.clamp(min=1e-12)).reshape(shape)
+
+
+def _to_device(logits, device):
+    if isinstance(logits, (tuple, list)):
+        return tuple(logit.to(device) for logit in logits)
+    return logits.to(device)
+
+
+def _worker_loop(conn, checkpoints, task_def, device, use_ema, config_updates, num_threads):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    models = [load_model(checkpoint, task_def, device, use_ema, config_updates) for checkpoint in checkpoints]
+    conn.send(len(models))
+    with torch.no_grad():
+        while True:
+            batch = conn.recv()
+            if batch is None:
+                break
+            batch_meta, batch_data = Collater.patch_data(device, *batch)
+            conn.send([_to_device(model.predict_logits(batch_meta, batch_data), 'cpu') for model in models])
+    conn.close()
+
+
+class EnsembleWorker(object):
+    """a process scoring every batch with its own models"""
+    def __init__(self, checkpoints, task_def, device, use_ema=False, config_updates=None, num_threads=0):
+        context = mp.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_loop,
+                                       args=(child_conn, checkpoints, task_def, device, use_ema, config_updates, num_threads),
+                                       daemon=True)
+        self.process.start()
+        self.num_models = self.conn.recv()
+
+    def send(self, batch_meta, batch_data):
+        self.conn.send((batch_meta, batch_data))
+
+    def receive(self):
+        return self.conn.recv()
+
+    def close(self):
+        self.conn.send(None)
+        self.process.join()
+
+
+class EnsembleModel(object):
+    """models: MTDNNModels run in this process, the first one decodes the averaged output;
+    workers: EnsembleWorkers, which score a batch while this process runs its own models;
+    weights: one per model, the models of this process first, then those of the workers in order
+    """
+    def __init__(self, models, workers=(), weights=None, average='prob'):
+        if average not in AVERAGE_MODES:
+            raise ValueError('unknown average {}, expected one of {}'.format(average, AVERAGE_MODES))
+        self.models = models
+        self.workers = list(workers)
+        num_models = len(models) + sum(worker.num_models for worker in self.workers)
+        self.weights = weights or [1.0] * num_models
+        if len(self.weights) != num_models:
+            raise ValueError('{} weights for {} models'.format(len(self.weights), num_models))
+        self.average = average
+
+    def predict(self, batch_meta, batch_data, score_mode='full'):
+        for worker in self.workers:
+            worker.send(batch_meta, batch_data)
+        logits = [model.predict_logits(batch_meta, batch_data) for model in self.models]
+        device = batch_data[batch_meta['token_id']].device
+        for worker in self.workers:
+            logits.extend(_to_device(logit, device) for logit in worker.receive())
+        task_type = TaskType(batch_meta['task_def']['task_type'])
+        logits = combine_logits(logits, self.weights, self.average, task_type, batch_meta.get('pairwise_size', 1))
+        return self.models[0].decode(batch_meta, batch_data, logits, score_mode)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+def build_ensemble(checkpoints, task_def, device, weights=None, average='prob', num_workers=0, use_ema=False,
+                   config_updates=None):
+    """The first checkpoint is run in this process; with num_workers, the others are split over
+    that many worker processes (on GPU, one per device in turn), else run here as well.
+    """
+    models = [load_model(checkpoints[0], task_def, device, use_ema, config_updates)]
+    rest = checkpoints[1:]
+    num_workers = min(num_workers, len(rest))
+    if num_workers == 0:
+        models.extend(load_model(checkpoint, task_def, device, use_ema, config_updates) for checkpoint in rest)
+        return EnsembleModel(models, weights=weights, average=average)
+    workers = []
+    num_threads = max(1, (os.cpu_count() or 1) // (num_workers + 1)) if device.type == 'cpu' else 0
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    for idx in range(num_workers):
+        worker_device = device
+        if device.type == 'cuda':
+            worker_device = torch.device('cuda', (idx + 1) % torch.cuda.device_count())
+        # contiguous parts keep the weights in checkpoint order
+        part = rest[len(rest) * idx // num_workers:len(rest) * (idx + 1) // num_workers]
+        workers.append(EnsembleWorker(part, task_def, worker_device, use_ema, config_updates, num_threads))
+    return EnsembleModel(models, workers, weights=weights, average=average)
@@ -1,48 +1,175 @@
 # coding=utf-8
 # Copyright (c) Microsoft. All rights reserved.
-from data_utils.metrics import calc_metrics
+from data_utils.metrics import calc_metrics, StreamingMetrics, Metric
 from mt_dnn.batcher import Collater
 from data_utils.task_def import TaskType
 import torch
 from tqdm import tqdm
 
-def extract_encoding(model, data, use_cuda=True):
-    if use_cuda:
-        model.cuda()
-    sequence_outputs = []
-    max_seq_len = 0
-    for idx, (batch_info, batch_data) in enumerate(data):
-        batch_info, batch_data = Collater.patch_data(use_cuda, batch_info, batch_data)
+def extract_encoding(model, data, writer):
+    """writes the unpadded last layer output of every sample to writer, a FeatureWriter,
+    batch by batch
+    """
+    dtype = getattr(torch, writer.meta['dtype'])
+    for batch_info, batch_data in data:
+        batch_info, batch_data = Collater.patch_data(model.device, batch_info, batch_data)
         sequence_output = model.encode(batch_info, batch_data)
-        sequence_outputs.append(sequence_output)
-        max_seq_len = max(max_seq_len, sequence_output.shape[1])
-    
-    new_sequence_outputs = []
-    for sequence_output in sequence_outputs:
-        new_sequence_output = torch.zeros(sequence_output.shape[0], max_seq_len, sequence_output.shape[2])
-        new_sequence_output[:, :sequence_output.shape[1], :] = sequence_output
-        new_sequence_outputs.append(new_sequence_output)
-
-    return torch.cat(new_sequence_outputs)
-
-def eval_model(model, data, metric_meta, device, with_label=True, label_mapper=None, task_type=TaskType.Classification):
+        rows, lengths = pool_features(sequence_output.unsqueeze(2), batch_data[batch_info['mask']], 'full')
+        writer.write(rows.to(dtype).cpu().numpy(), lengths.cpu().numpy(), batch_info['uids'])
+    return writer.num_samples
+
+def pool_features(hidden_states, mask, pooling):
+    """hidden_states: (batch, len, n_layers, hidden_size); returns the rows to store,
+    (n_rows, n_layers, hidden_size), and the number of rows of every sample
+    """
+    lengths = mask.sum(1)
+    if pooling == 'cls':
+        return hidden_states[:, 0], torch.ones_like(lengths)
+    if pooling == 'mean':
+        weights = mask.to(hidden_states.dtype)[:, :, None, None]
+        pooled = (hidden_states * weights).sum(1) / lengths.clamp(min=1).to(hidden_states.dtype)[:, None, None]
+        return pooled, torch.ones_like(lengths)
+    # full sequence without the padding, the samples one after the other
+    return hidden_states[mask.bool()], lengths
+
+class OutputBuffer(object):
+    """Flat CPU tensor the per batch outputs are copied into. It is preallocated from the
+    expected number of rows once the per row width is known, and doubled if it runs out.
+    """
+    def __init__(self, num_rows=0):
+        self.num_rows = num_rows
+        self.data = None
+        self.size = 0
+
+    def append(self, batch, rows):
+        batch = batch.reshape(-1)
+        if self.data is None:
+            width = batch.numel() // max(rows, 1)
+            self.data = batch.new_empty(max(self.num_rows * width, batch.numel()))
+        if self.size + batch.numel() > self.data.numel():
+            data = self.data.new_empty(max(2 * self.data.numel(), self.size + batch.numel()))
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:self.size + batch.numel()] = batch
+        self.size += batch.numel()
+
+    def tolist(self):
+        return [] if self.data is None else self.data[:self.size].tolist()
+
+
+def _num_rows(data):
+    num_samples = getattr(getattr(data, 'batch_sampler', None), 'num_samples', None)
+    if num_samples is not None:
+        return num_samples
+    try:
+        return len(data.dataset)
+    except (AttributeError, TypeError):
+        return 0
+
+
+def eval_model(model, data, metric_meta, device, with_label=True, label_mapper=None, task_type=TaskType.Classification,
+               keep_predictions=True, rank_sample_size=0, prediction_writer=None, score_mode='full', dist_gather=False):
+    """Metrics are accumulated batch by batch; set keep_predictions=False to not collect the
+    predictions/scores/golds/uids (they are returned as empty lists).
+    If prediction_writer (data_utils.prediction_store.PredictionWriter) is given, predictions are
+    streamed to it; the caller closes it.
+    score_mode ('full', 'top1' or 'none') selects the returned scores; metrics computed from scores
+    (Pearson, Spearman, AUC) always get the full ones.
+    MRC (Span) answers are merged over doc strides, so they are always collected.
+    Models with early exit heads add the average exit layer and the speedup in encoder layers
+    over the full model to the metrics (exit_layer, exit_speedup).
+    With dist_gather, data is the shard of this rank (DistSingleTaskBatchSampler): the metric states
+    and, with keep_predictions, the outputs are gathered to rank 0, which returns the results of the
+    whole data. The other ranks return empty results. Every rank streams its own outputs to its
+    prediction_writer (data_utils.prediction_store.prediction_shard_path), to be merged with
+    merge_predictions once all are closed; MRC answers are written by rank 0 only.
+    """
     predictions = []
     golds = []
     scores = []
     ids = []
     metrics = {}
+    rank = torch.distributed.get_rank() if dist_gather else 0
+    streaming = with_label and task_type != TaskType.Span
+    if streaming:
+        accumulator = StreamingMetrics(metric_meta, label_mapper, rank_sample_size=rank_sample_size, seed=2018 + rank)
+        if any(mm in (Metric.Pearson, Metric.Spearman, Metric.AUC) for mm in metric_meta):
+            score_mode = 'full'
+    keep_predictions = keep_predictions or task_type == TaskType.Span
+    num_rows = _num_rows(data)
+    predict_buffer, score_buffer = OutputBuffer(num_rows), OutputBuffer(num_rows)
+
+    def write(pred, score, uids):
+        if prediction_writer is not None and task_type != TaskType.Span:
+            prediction_writer.write(pred.numpy() if torch.is_tensor(pred) else pred,
+                                    score.numpy() if torch.is_tensor(score) else score, uids)
+
+    def collect(pred, score, gold, uids):
+        if keep_predictions:
+            rows = len(uids)
+            if torch.is_tensor(pred):
+                predict_buffer.append(pred, rows)
+            else:
+                predictions.extend(pred)
+            if torch.is_tensor(score):
+                score_buffer.append(score, rows)
+            else:
+                scores.extend(score)
+            golds.extend(gold)
+            ids.extend(uids)
+
+    reset_exit_stats = getattr(model, 'reset_exit_stats', None)
+    if reset_exit_stats is not None:
+        reset_exit_stats()
+    local_batches = []
     for (batch_info, batch_data) in data:
         batch_info, batch_data = Collater.patch_data(device, batch_info, batch_data)
-        score, pred, gold = model.predict(batch_info, batch_data)
-        predictions.extend(pred)
-        golds.extend(gold)
-        scores.extend(score)
-        ids.extend(batch_info['uids'])
+        score, pred, gold = model.predict(batch_info, batch_data, score_mode=score_mode)
+        if streaming:
+            accumulator.update(pred.numpy() if torch.is_tensor(pred) else pred, gold,
+                               score.numpy() if torch.is_tensor(score) else score)
+        write(pred, score, batch_info['uids'])
+        if not dist_gather:
+            collect(pred, score, gold, batch_info['uids'])
+        elif keep_predictions:
+            local_batches.append((pred, score, gold, batch_info['uids']))
+
+    exit_stats = getattr(model, 'exit_stats', None)
+    if exit_stats is not None:
+        exit_stats = exit_stats.tolist()
+    if dist_gather:
+        from data_utils.utils import gather_to_rank0
+        shards = gather_to_rank0((accumulator if streaming else None, local_batches, exit_stats))
+        if rank != 0:
+            return {}, [], [], [], []
+        # rank order is the data order
+        for shard_accumulator, _, shard_exit_stats in shards[1:]:
+            if streaming:
+                accumulator.merge(shard_accumulator)
+            if exit_stats is not None:
+                exit_stats = [total + count for total, count in zip(exit_stats, shard_exit_stats)]
+        for _, batches, _ in shards:
+            for batch in batches:
+                collect(*batch)
+
+    if predict_buffer.size > 0:
+        predictions = predict_buffer.tolist()
+    if score_buffer.size > 0:
+        scores = score_buffer.tolist()
 
     if task_type == TaskType.Span:
         from experiments.squad import squad_utils
         golds = squad_utils.merge_answers(ids, golds)
         predictions, scores = squad_utils.select_answers(ids, predictions, scores)
-    if with_label:
+        if prediction_writer is not None:
+            uids = list(predictions.keys())
+            prediction_writer.write([predictions[uid] for uid in uids], [scores[uid] for uid in uids], uids)
+    if streaming:
+        metrics = accumulator.compute()
+    elif with_label:
         metrics = calc_metrics(metric_meta, golds, predictions, scores, label_mapper)
+    if exit_stats is not None and exit_stats[0] > 0:
+        num_samples, exit_layers, computed, full = exit_stats
+        metrics['exit_layer'] = exit_layers / num_samples
+        metrics['exit_speedup'] = full / computed
     return metrics, predictions, scores, golds, ids
@@ -227,7 +227,9 @@ class MlmCriterion(Criterion):
         self.name = name
 
     def forward(self, input, target, weight=None, ignore_index=-1):
-        """TODO: support sample weight, xiaodl
+        """MLM logits/labels are either batch * len * vocab / batch * len (ignore_index at unmasked
+        positions) or the compact num_masked * vocab / num_masked of the masked positions only.
+        TODO: support sample weight, xiaodl
         """
         mlm_y, y = target
         mlm_p, nsp_p = input
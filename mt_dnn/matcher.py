@@ -3,12 +3,11 @@
 import os
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from pretrained_models import MODEL_CLASSES
-from transformers import BertConfig
 
 from module.dropout_wrapper import DropoutWrapper
 from module.san import SANClassifier, MaskLmHeader
-from module.san_model import SanModel
 from torch.nn.modules.normalization import LayerNorm
 from data_utils.task_def import EncoderModelType, TaskType
 import tasks
@@ -26,6 +25,22 @@ class LinearPooler(nn.Module):
         pooled_output = self.activation(pooled_output)
         return pooled_output
 
+class ExitHead(nn.Module):
+    """internal classifier on the first token of one encoder layer, for early exit"""
+    def __init__(self, hidden_size, lab, dropout):
+        super(ExitHead, self).__init__()
+        self.pooler = LinearPooler(hidden_size)
+        self.dropout = dropout
+        self.proj = nn.Linear(hidden_size, lab)
+
+    def forward(self, hidden_states):
+        return self.proj(self.dropout(self.pooler(hidden_states)))
+
+EXIT_TASK_TYPES = (TaskType.Classification, TaskType.Regression)
+EXIT_CRITERIA = ('entropy', 'patience', 'none')
+# encoders with embeddings and encoder.layer, which early exit and pruning run layer by layer
+LAYERED_ENCODER_TYPES = (EncoderModelType.BERT, EncoderModelType.ROBERTA)
+
 def generate_decoder_opt(enable_san, max_opt):
     opt_v = 0
     if enable_san and max_opt < 2:
@@ -36,10 +51,14 @@ class SANBertNetwork(nn.Module):
     def __init__(self, opt, bert_config=None, initial_from_local=False):
         super(SANBertNetwork, self).__init__()
         self.dropout_list = nn.ModuleList()
+        self.exit_list = nn.ModuleList()
 
         if opt['encoder_type'] not in EncoderModelType._value2member_map_:
             raise ValueError("encoder_type is out of pre-defined types")
         self.encoder_type = opt['encoder_type']
+        if opt.get('early_exit', False) and self.encoder_type not in LAYERED_ENCODER_TYPES:
+            raise ValueError('early exit needs a BERT or RoBERTa encoder, not {}'.format(
+                EncoderModelType(self.encoder_type).name))
         self.preloaded_config = None
 
         literal_encoder_type = EncoderModelType(self.encoder_type).name.lower()
@@ -47,6 +66,8 @@ class SANBertNetwork(nn.Module):
         self.preloaded_config = config_class.from_dict(opt)  # load config from opt
         self.preloaded_config.output_hidden_states = True # return all hidden states
         self.bert = model_class(self.preloaded_config)
+        # heads pruned by mt_dnn/pruning.py are rebuilt by transformers from config.pruned_heads
+        self._resize_intermediate(opt.get('intermediate_sizes'))
         hidden_size = self.bert.config.hidden_size
 
         if opt.get('dump_feature', False):
@@ -96,12 +117,34 @@ class SANBertNetwork(nn.Module):
                     out_proj = nn.Linear(hidden_size, lab)
             self.scoring_list.append(out_proj)
 
+        # exit heads on every encoder layer but the last one, whose output goes to the task head
+        if opt.get('early_exit', False):
+            for task_id, task_def in enumerate(task_def_list):
+                exits = nn.ModuleList()
+                if task_def.task_type in EXIT_TASK_TYPES:
+                    for _ in range(self.bert.config.num_hidden_layers - 1):
+                        exits.append(ExitHead(hidden_size, task_def.n_class, self.dropout_list[task_id]))
+                self.exit_list.append(exits)
+
+        # ranking tasks score the cosine of separately encoded premise and hypothesis
+        self.bi_encoder_temperature = opt.get('bi_encoder_temperature', 0.05)
+
         self.opt = opt
         self._my_init()
         # if not loading from local, loading model weights from pre-trained model, after initialization
         if not initial_from_local:
             config_class, model_class, tokenizer_class = MODEL_CLASSES[literal_encoder_type]
             self.bert = model_class.from_pretrained(opt['init_checkpoint'], config=self.preloaded_config)
+            self._resize_intermediate(opt.get('intermediate_sizes'))
+
+    def _resize_intermediate(self, intermediate_sizes):
+        """FFN width of every layer, as left by mt_dnn/pruning.py; None keeps intermediate_size"""
+        if intermediate_sizes is None:
+            return
+        for layer, size in zip(self.bert.encoder.layer, intermediate_sizes):
+            if size != layer.intermediate.dense.out_features:
+                layer.intermediate.dense = nn.Linear(layer.intermediate.dense.in_features, size)
+                layer.output.dense = nn.Linear(size, layer.output.dense.out_features)
 
     def _my_init(self):
         def init_weights(module):
@@ -195,19 +238,124 @@ class SANBertNetwork(nn.Module):
         outputs = sequence_output, pooled_output
         return outputs
 
-    def forward(self, input_ids, token_type_ids, attention_mask, premise_mask=None, hyp_mask=None, task_id=0, fwd_type=0, embed=None):
+    def embed(self, input_ids, token_type_ids, attention_mask):
+        """L2 normalized bi-encoder embeddings of single sequences, from the pooled output"""
+        pooled_output = self.encode(input_ids, token_type_ids, attention_mask)[1]
+        return F.normalize(pooled_output, dim=-1)
+
+    def bi_forward(self, input_ids, token_type_ids, attention_mask, candidates):
+        """Ranking logits of a bi-encoder, (batch * pairwise_size, 1) like the cross-encoder ones:
+        the inputs are the premises, candidates the (input_ids, token_type_ids, attention_mask) of
+        their hypotheses, pairwise_size per premise one after the other
+        """
+        query = self.embed(input_ids, token_type_ids, attention_mask)
+        candidate = self.embed(*candidates)
+        candidate = candidate.view(query.size(0), -1, candidate.size(-1))
+        logits = torch.bmm(candidate, query.unsqueeze(2)) / self.bi_encoder_temperature
+        return logits.view(-1, 1)
+
+    def has_exits(self, task_id):
+        return len(self.exit_list) > 0 and len(self.exit_list[task_id]) > 0
+
+    def exit_forward(self, input_ids, token_type_ids, attention_mask, premise_mask=None, hyp_mask=None, task_id=0,
+                     criterion='entropy', entropy=0.3, patience=3, tolerance=0.01, compact=False):
+        """Inference which stops running the encoder layers for a sample once an exit head is confident:
+        'entropy', the entropy of its class distribution is below entropy; 'patience', the prediction
+        is the same for patience more exits (regression tasks, which always use it: changes by less
+        than tolerance). compact drops the finished samples from the batch, otherwise the whole batch
+        runs until every sample is finished.
+        Returns the logits, the exit layer of every sample (num_hidden_layers for the task head) and
+        the number of (sample, layer) pairs computed.
+        """
+        exits = self.exit_list[task_id]
+        regression = self.task_types[task_id] == TaskType.Regression
+        if regression:
+            criterion = 'patience'
+        layers = self.bert.encoder.layer
+        batch_size = input_ids.size(0)
+        device = input_ids.device
+        hidden_states = self.bert.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+        extended_mask = attention_mask[:, None, None, :].to(dtype=hidden_states.dtype)
+        extended_mask = (1.0 - extended_mask) * -10000.0
+        logits = None
+        exit_layer = torch.full((batch_size,), len(layers), dtype=torch.long, device=device)
+        # rows of the batch which are still in the encoder
+        active = torch.arange(batch_size, device=device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        streak = torch.zeros(batch_size, dtype=torch.long, device=device)
+        last_predict = None
+        computed = 0
+        for idx in range(len(layers) - 1):
+            hidden_states = layers[idx](hidden_states, attention_mask=extended_mask)[0]
+            computed += hidden_states.size(0)
+            layer_logits = exits[idx](hidden_states)
+            if logits is None:
+                logits = layer_logits.new_zeros(batch_size, layer_logits.size(-1))
+            if criterion == 'entropy':
+                prob = F.softmax(layer_logits, dim=-1)
+                done = -(prob * torch.log(prob.clamp(min=1e-12))).sum(-1) < entropy
+            else:
+                predict = layer_logits[:, 0] if regression else layer_logits.argmax(-1)
+                if last_predict is not None:
+                    same = (predict - last_predict).abs() < tolerance if regression else predict == last_predict
+                    streak = torch.where(same, streak + 1, torch.zeros_like(streak))
+                last_predict = predict
+                done = streak >= patience
+            if not compact:
+                done = done & ~finished
+            logits[active[done]] = layer_logits[done]
+            exit_layer[active[done]] = idx + 1
+            if compact:
+                keep = ~done
+                active, hidden_states, extended_mask, streak = active[keep], hidden_states[keep], extended_mask[keep], streak[keep]
+                if last_predict is not None:
+                    last_predict = last_predict[keep]
+                if active.numel() == 0:
+                    return logits, exit_layer, computed
+            else:
+                finished = finished | done
+                if bool(finished.all()):
+                    return logits, exit_layer, computed
+        hidden_states = layers[-1](hidden_states, attention_mask=extended_mask)[0]
+        computed += hidden_states.size(0)
+        rows = active
+        if not compact:
+            rows = (~finished).nonzero().squeeze(1)
+            hidden_states = hidden_states[rows]
+        if premise_mask is not None:
+            premise_mask, hyp_mask = premise_mask[rows], hyp_mask[rows]
+        pooled_output = self.bert.pooler(hidden_states)
+        task_obj = tasks.get_task_obj(self.task_def_list[task_id])
+        final_logits = task_obj.train_forward(hidden_states, pooled_output, premise_mask, hyp_mask, self.decoder_opt[task_id],
+                                              self.dropout_list[task_id], self.scoring_list[task_id])
+        if logits is None:
+            logits = final_logits.new_zeros(batch_size, final_logits.size(-1))
+        logits[rows] = final_logits
+        return logits, exit_layer, computed
+
+    def forward(self, input_ids, token_type_ids, attention_mask, premise_mask=None, hyp_mask=None, task_id=0, fwd_type=0, embed=None, masked_positions=None, with_exits=False,
+                candidates=None):
+        """with_exits: also returns the logits of the exit heads, lowest layer first;
+        candidates: hypothesis inputs of a bi-encoder ranking batch, see bi_forward
+        """
+        if candidates is not None:
+            return self.bi_forward(input_ids, token_type_ids, attention_mask, candidates)
         if fwd_type == 2:
             assert embed is not None
             sequence_output, pooled_output = self.embed_forward(embed, attention_mask) 
         elif fwd_type == 1:
             return self.embed_encode(input_ids, token_type_ids, attention_mask)
         else:
-            sequence_output, pooled_output, _ = self.encode(input_ids, token_type_ids, attention_mask)
+            sequence_output, pooled_output, all_hidden_states = self.encode(input_ids, token_type_ids, attention_mask)
         decoder_opt = self.decoder_opt[task_id]
         task_type = self.task_types[task_id]
         task_obj = tasks.get_task_obj(self.task_def_list[task_id])
         if task_obj is not None:
             logits = task_obj.train_forward(sequence_output, pooled_output, premise_mask, hyp_mask, decoder_opt, self.dropout_list[task_id], self.scoring_list[task_id])
+            if with_exits:
+                # all_hidden_states[0] is the embedding output, the last layer is scored by the task head
+                exit_logits = [exit_head(hidden) for exit_head, hidden in zip(self.exit_list[task_id], all_hidden_states[1:-1])]
+                return logits, exit_logits
             return logits
         elif task_type == TaskType.Span:
             assert decoder_opt != 1
@@ -225,7 +373,7 @@ class SANBertNetwork(nn.Module):
             return logits
         elif task_type == TaskType.MaskLM:
             sequence_output = self.dropout_list[task_id](sequence_output)
-            logits = self.scoring_list[task_id](sequence_output)
+            logits = self.scoring_list[task_id](sequence_output, masked_positions)
             return logits
         else:
             if decoder_opt == 1:
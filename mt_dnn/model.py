@@ -1,6 +1,6 @@
 # coding=utf-8
 # Copyright (c) Microsoft. All rights reserved.
-import copy
+import os
 import sys
 import torch
 import tasks
@@ -10,9 +10,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim.lr_scheduler import *
-from data_utils.utils import AverageMeter
-from pytorch_pretrained_bert import BertAdam as Adam
-from module.bert_optim import Adamax, RAdam
+from data_utils.utils import DeviceMeters
+from module.bert_optim import Adamax, RAdam, FOREACH_AVAILABLE
+from module.my_optim import EMA
 from mt_dnn.loss import LOSS_REGISTRY
 from mt_dnn.matcher import SANBertNetwork
 from mt_dnn.perturbation import SmartPerturbation
@@ -29,18 +29,19 @@ class MTDNNModel(object):
         self.updates = state_dict['updates'] if state_dict and 'updates' in state_dict else 0
         self.local_updates = 0
         self.device = device
-        self.train_loss = AverageMeter()
-        self.adv_loss = AverageMeter()
-        self.emb_val =  AverageMeter()
-        self.eff_perturb = AverageMeter()
+        # statistics are accumulated on device and reduced at logging time, see sync_meters
+        self.meters = DeviceMeters(['train_loss', 'adv_loss', 'emb_val', 'eff_perturb'], len(opt['task_def_list']), device=device)
+        self.train_loss = self.meters.meters['train_loss']
+        self.adv_loss = self.meters.meters['adv_loss']
+        self.emb_val = self.meters.meters['emb_val']
+        self.eff_perturb = self.meters.meters['eff_perturb']
+        # early exit counts (see reset_exit_stats), None when they are not counted
+        self.exit_stats = None
         self.initial_from_local = True if state_dict else False
         model = SANBertNetwork(opt, initial_from_local=self.initial_from_local)
         self.total_param = sum([p.nelement() for p in model.parameters() if p.requires_grad])
         if opt['cuda']:
-            if self.config['local_rank'] != -1:
-                model = model.to(self.device)
-            else:
-                model = model.to(self.device)
+            model = model.to(self.device)
         self.network = model
         if state_dict:
             missing_keys, unexpected_keys = self.network.load_state_dict(state_dict['state'], strict=False)
@@ -48,12 +49,19 @@ class MTDNNModel(object):
         optimizer_parameters = self._get_param_groups()
         self._setup_optim(optimizer_parameters, state_dict, num_train_step)
         self.optimizer.zero_grad()
+        self._setup_ema(state_dict)
 
         #if self.config["local_rank"] not in [-1, 0]:
         #    torch.distributed.barrier()
 
+        self._ddp_idle_params = []
         if self.config['local_rank'] != -1:
-            self.mnetwork = torch.nn.parallel.DistributedDataParallel(self.network, device_ids=[self.config["local_rank"]], output_device=self.config["local_rank"], find_unused_parameters=True)
+            find_unused = self.config.get('ddp_find_unused', False)
+            device_ids = [self.config["local_rank"]] if self.config['cuda'] else None
+            output_device = self.config["local_rank"] if self.config['cuda'] else None
+            self.mnetwork = torch.nn.parallel.DistributedDataParallel(self.network, device_ids=device_ids, output_device=output_device, find_unused_parameters=find_unused)
+            if not find_unused:
+                self._ddp_idle_params = self._maybe_unused_parameters()
         elif self.config['multi_gpu_on']:
             self.mnetwork = nn.DataParallel(self.network)
         else:
@@ -64,6 +72,34 @@ class MTDNNModel(object):
         self._setup_adv_training(self.config)
 
 
+    def _maybe_unused_parameters(self):
+        """Parameters outside the embeddings and the transformer layers (task heads, pooler) which
+        may get no gradient in a step. A zero valued term of them is added to the loss, so that
+        every parameter gets a (zero) gradient and DDP does not need find_unused_parameters.
+        """
+        always_used = set()
+        for name in ('embeddings', 'encoder'):
+            module = getattr(self.network.bert, name, None)
+            if module is not None:
+                always_used.update(id(p) for p in module.parameters())
+        return [p for p in self.network.parameters() if p.requires_grad and id(p) not in always_used]
+
+    def _drop_idle_grads(self):
+        """Without DDP, the parameters no task of the step used have no gradient and the optimizers
+        skip them. The zero gradients they got from the term of _maybe_unused_parameters are dropped
+        again, unless another rank used them: their gradient is all-reduced then.
+        """
+        params = [p for p in self._ddp_idle_params if p.grad is not None]
+        if not params:
+            return
+        if FOREACH_AVAILABLE:
+            norms = torch.stack(torch._foreach_norm([p.grad for p in params])).tolist()
+        else:
+            norms = torch.stack([p.grad.norm() for p in params]).tolist()
+        for p, norm in zip(params, norms):
+            if norm == 0:
+                p.grad = None
+
     def _setup_adv_training(self, config):
         self.adv_teacher = None
         if config.get('adv_train', False):
@@ -116,6 +152,7 @@ class MTDNNModel(object):
             # The current radam does not support FP16.
             self.config['fp16'] = False
         elif self.config['optimizer'] == 'adam':
+            from pytorch_pretrained_bert import BertAdam as Adam
             self.optimizer = Adam(optimizer_parameters,
                                   lr=self.config['learning_rate'],
                                   warmup=self.config['warmup'],
@@ -151,6 +188,30 @@ class MTDNNModel(object):
         else:
             self.scheduler = None
 
+    def _setup_ema(self, state_dict=None):
+        self.ema = None
+        if self.config.get('ema_opt', 0) > 0:
+            self.ema = EMA(self.config.get('ema_gamma', 0.995),
+                           self.network,
+                           update_per_steps=self.config.get('ema_per_updates', 1),
+                           offload=self.config.get('ema_offload', False))
+            if state_dict and 'ema' in state_dict:
+                self.ema.load_state_dict(state_dict['ema'])
+
+    def update_ema(self):
+        if self.ema is not None:
+            self.ema.update()
+
+    def ema_eval(self):
+        """Swaps in the EMA weights (if any) before evaluation"""
+        if self.ema is not None and not self.ema.swapped:
+            self.ema.swap_parameters()
+
+    def ema_train(self):
+        """Swaps back the training weights after evaluation"""
+        if self.ema is not None and self.ema.swapped:
+            self.ema.swap_parameters()
+
     def _setup_lossmap(self, config):
         task_def_list: List[TaskDef] = config['task_def_list']
         self.task_loss_criterion = []
@@ -194,6 +255,15 @@ class MTDNNModel(object):
         return y
 
     def update(self, batch_meta, batch_data):
+        if isinstance(self.mnetwork, torch.nn.parallel.DistributedDataParallel) and \
+                (self.local_updates + 1) % self.config.get('grad_accumulation_step', 1) != 0:
+            # gradients are only all-reduced in the micro-step which steps the optimizer
+            with self.mnetwork.no_sync():
+                self._update(batch_meta, batch_data)
+        else:
+            self._update(batch_meta, batch_data)
+
+    def _update(self, batch_meta, batch_data):
         self.network.train()
         y = batch_data[batch_meta['label']]
         y = self._to_cuda(y) if self.config['cuda'] else y
@@ -207,12 +277,20 @@ class MTDNNModel(object):
         weight = None
         if self.config.get('weighted_on', False):
             if self.config['cuda']:
-                weight = batch_data[batch_meta['factor']].cuda(non_blocking=True)
+                weight = batch_data[batch_meta['factor']].to(self.device, non_blocking=True)
             else:
                 weight = batch_data[batch_meta['factor']]
 
         # fw to get logits
-        logits = self.mnetwork(*inputs)
+        exit_logits = None
+        if 'candidates' in batch_meta:
+            logits = self.mnetwork(*inputs, candidates=batch_data[batch_meta['candidates']])
+        elif 'masked_positions' in batch_meta:
+            logits = self.mnetwork(*inputs, masked_positions=batch_data[batch_meta['masked_positions']])
+        elif self.network.has_exits(task_id):
+            logits, exit_logits = self.mnetwork(*inputs, with_exits=True)
+        else:
+            logits = self.mnetwork(*inputs)
 
         # compute loss
         loss = 0
@@ -224,6 +302,9 @@ class MTDNNModel(object):
             else:
                 loss = self.task_loss_criterion[task_id](logits, y, weight, ignore_index=-1)
 
+        if exit_logits:
+            loss = loss + self._exit_loss(exit_logits, logits, y, weight, task_id)
+
         # compute kd loss
         if self.config.get('mkd_opt', 0) > 0 and ('soft_label' in batch_meta):
             soft_labels = batch_meta['soft_label']
@@ -244,35 +325,14 @@ class MTDNNModel(object):
         # rescale loss as dynamic batching
         if self.config['bin_on']:
             loss = loss * (1.0 * batch_size / self.config['batch_size'])
-        if self.config['local_rank'] != -1:
-            #print('Rank ', self.config['local_rank'], ' loss ', loss)
-            copied_loss = copy.deepcopy(loss.data)
-            torch.distributed.all_reduce(copied_loss)
-            copied_loss = copied_loss / self.config['world_size']
-            self.train_loss.update(copied_loss.item(), batch_size)
-        else:
-            self.train_loss.update(loss.item(), batch_size)
-            
+        self.meters.update('train_loss', loss, batch_size, task_id)
         if self.config.get('adv_train', False) and self.adv_teacher:
-            if self.config['local_rank'] != -1:
-                copied_adv_loss = copy.deepcopy(adv_loss.data)
-                torch.distributed.all_reduce(copied_adv_loss)
-                copied_adv_loss = copied_adv_loss / self.config['world_size']
-                self.adv_loss.update(copied_adv_loss.item(), batch_size)
-
-                copied_emb_val = copy.deepcopy(emb_val.data)
-                torch.distributed.all_reduce(copied_emb_val)
-                copied_emb_val = copied_emb_val / self.config["world_size"]
-                self.emb_val.update(copied_emb_val.item(), batch_size)               
-
-                copied_eff_perturb = copy.deepcopy(eff_perturb.data)
-                torch.distributed.all_reduce(copied_eff_perturb)
-                copied_eff_perturb = copied_eff_perturb / self.config["world_size"]
-                self.eff_perturb.update(copied_eff_perturb.item(), batch_size)               
-            else:
-                self.adv_loss.update(adv_loss.item(), batch_size)
-                self.emb_val.update(emb_val.item(), batch_size)
-                self.eff_perturb.update(eff_perturb.item(), batch_size)
+            self.meters.update('adv_loss', adv_loss, batch_size, task_id)
+            self.meters.update('emb_val', emb_val, batch_size, task_id)
+            self.meters.update('eff_perturb', eff_perturb, batch_size, task_id)
+
+        if self._ddp_idle_params:
+            loss = loss + 0.0 * sum(p.view(-1)[0] for p in self._ddp_idle_params)
 
         # scale loss
         loss = loss / self.config.get('grad_accumulation_step', 1)
@@ -283,6 +343,8 @@ class MTDNNModel(object):
             loss.backward()
         self.local_updates += 1
         if self.local_updates % self.config.get('grad_accumulation_step', 1) == 0:
+            if self._ddp_idle_params:
+                self._drop_idle_grads()
             if self.config['global_grad_clipping'] > 0:
                 if self.config['fp16']:
                     torch.nn.utils.clip_grad_norm_(amp.master_params(self.optimizer),
@@ -294,6 +356,29 @@ class MTDNNModel(object):
             # reset number of the grad accumulation
             self.optimizer.step()
             self.optimizer.zero_grad()
+            self.update_ema()
+
+    def _exit_loss(self, exit_logits, logits, y, weight, task_id):
+        """Loss of the exit heads: their average with weight i for the exit on layer i, so the deeper
+        exits count more. With exit_distill they fit the task head output instead of the labels.
+        """
+        if self.config.get('exit_distill', False):
+            if self.network.task_types[task_id] == TaskType.Regression:
+                criterion, target = MseCriterion(), logits.detach().squeeze(-1)
+            else:
+                criterion, target = KlCriterion(), logits.detach()
+        else:
+            criterion, target = self.task_loss_criterion[task_id], y
+        loss = sum((idx + 1) * criterion(exit_logit, target, weight, ignore_index=-1) for idx, exit_logit in enumerate(exit_logits))
+        num_exits = len(exit_logits)
+        return self.config.get('exit_loss_weight', 1.0) * loss / (num_exits * (num_exits + 1) / 2)
+
+    def sync_meters(self):
+        """Reduces the training statistics accumulated since the last call (one all_reduce in
+        distributed training) into train_loss/adv_loss/emb_val/eff_perturb and meters.task_meters.
+        Must be called by all ranks at the same update.
+        """
+        self.meters.sync(distributed=self.config['local_rank'] != -1)
 
     def encode(self, batch_meta, batch_data):
         self.network.eval()
@@ -301,66 +386,105 @@ class MTDNNModel(object):
         sequence_output = self.network.encode(*inputs)[0]
         return sequence_output
 
+    def embed(self, batch_meta, batch_data):
+        """bi-encoder embeddings of the single sequences of a batch"""
+        self.network.eval()
+        return self.network.embed(*batch_data[:3])
+
     # TODO: similar as function extract, preserve since it is used by extractor.py
     # will remove after migrating to transformers package
     def extract(self, batch_meta, batch_data):
         self.network.eval()
         # 'token_id': 0; 'segment_id': 1; 'mask': 2
         inputs = batch_data[:3]
-        all_encoder_layers, pooled_output = self.mnetwork.bert(*inputs)
-        return all_encoder_layers, pooled_output
-
-    def predict(self, batch_meta, batch_data):
+        _, pooled_output, all_hidden_states = self.network.encode(*inputs)
+        # all_hidden_states[0] is the embedding output, layer i is all_encoder_layers[i]
+        return all_hidden_states[1:], pooled_output
+
+    def predict(self, batch_meta, batch_data, score_mode='full'):
+        """Post-processing runs on device; predictions (and for non span tasks the scores) are
+        returned as CPU tensors. score_mode selects the scores to return (tasks.SCORE_MODES).
+        """
+        score = self.predict_logits(batch_meta, batch_data)
+        return self.decode(batch_meta, batch_data, score, score_mode)
+
+    def predict_logits(self, batch_meta, batch_data):
+        """the output of the task head, on device; (start, end) logits for span tasks"""
         self.network.eval()
         task_id = batch_meta['task_id']
-        task_def = TaskDef.from_dict(batch_meta['task_def'])
-        task_type = task_def.task_type
-        task_obj = tasks.get_task_obj(task_def)
         inputs = batch_data[:batch_meta['input_len']]
         if len(inputs) == 3:
             inputs.append(None)
             inputs.append(None)
         inputs.append(task_id)
-        score = self.mnetwork(*inputs)
+        # with DDP the ranks may score different numbers of batches, which must not synchronize
+        network = self.network if isinstance(self.mnetwork, torch.nn.parallel.DistributedDataParallel) else self.mnetwork
+        if 'candidates' in batch_meta:
+            score = network(*inputs, candidates=batch_data[batch_meta['candidates']])
+        elif self.network.has_exits(task_id) and self.config.get('exit_criterion', 'entropy') != 'none':
+            score, exit_layer, computed = self.network.exit_forward(*inputs, **self._exit_options())
+            if self.exit_stats is not None:
+                self.exit_stats[0] += exit_layer.numel()
+                self.exit_stats[1] += exit_layer.sum()
+                self.exit_stats[2] += computed
+                self.exit_stats[3] += exit_layer.numel() * self.network.bert.config.num_hidden_layers
+        else:
+            score = network(*inputs)
+        return score
+
+    def decode(self, batch_meta, batch_data, score, score_mode='full'):
+        """predictions and scores (see predict) from the output of the task head"""
+        task_def = TaskDef.from_dict(batch_meta['task_def'])
+        task_type = task_def.task_type
+        task_obj = tasks.get_task_obj(task_def)
         if task_obj is not None:
-            score, predict = task_obj.test_predict(score)
+            score, predict = task_obj.test_predict(score, score_mode)
         elif task_type == TaskType.Ranking:
-            score = score.contiguous().view(-1, batch_meta['pairwise_size'])
-            assert task_type == TaskType.Ranking
+            score = score.detach().contiguous().view(-1, batch_meta['pairwise_size'])
             score = F.softmax(score, dim=1)
-            score = score.data.cpu()
-            score = score.numpy()
-            predict = np.zeros(score.shape, dtype=int)
-            positive = np.argmax(score, axis=1)
-            for idx, pos in enumerate(positive):
-                predict[idx, pos] = 1
-            predict = predict.reshape(-1).tolist()
-            score = score.reshape(-1).tolist()
-            return score, predict, batch_meta['true_label']
+            positive = torch.argmax(score, dim=1)
+            predict = torch.zeros_like(score, dtype=torch.int).scatter_(1, positive.unsqueeze(1), 1)
+            return tasks.select_scores(score, positive, score_mode), predict.reshape(-1).cpu(), batch_meta['true_label']
         elif task_type == TaskType.SeqenceLabeling:
             mask = batch_data[batch_meta['mask']]
-            score = score.contiguous()
-            score = score.data.cpu()
-            score = score.numpy()
-            predict = np.argmax(score, axis=1).reshape(mask.size()).tolist()
-            valied_lenght = mask.sum(1).tolist()
-            final_predict = []
-            for idx, p in enumerate(predict):
-                final_predict.append(p[: valied_lenght[idx]])
-            score = score.reshape(-1).tolist()
-            return score, final_predict, batch_meta['label']
+            score = score.detach().contiguous()
+            predict = torch.argmax(score, dim=1)
+            # only the first valid_length predictions of each sequence are moved to host
+            valid_length = mask.sum(1)
+            valid = torch.arange(mask.size(1), device=mask.device).unsqueeze(0) < valid_length.unsqueeze(1)
+            valid_predict = predict.view(mask.size())[valid].int().cpu()
+            final_predict = [p.tolist() for p in torch.split(valid_predict, valid_length.tolist())]
+            return tasks.select_scores(score, predict, score_mode), final_predict, batch_meta['label']
         elif task_type == TaskType.Span:
             start, end = score
             predictions = []
             if self.config['encoder_type'] == EncoderModelType.BERT:
                 import experiments.squad.squad_utils as mrc_utils
-                scores, predictions = mrc_utils.extract_answer(batch_meta, batch_data, start, end, self.config.get('max_answer_len', 5), do_lower_case=self.config.get('do_lower_case', False))
+                predictions, scores = mrc_utils.extract_answer(batch_meta, batch_data, start, end, max_len=self.config.get('max_answer_len', 5), do_lower_case=self.config.get('do_lower_case', False))
             return scores, predictions, batch_meta['answer']
         else:
             raise ValueError("Unknown task_type: %s" % task_type)
         return score, predict, batch_meta['label']
 
+    def _exit_options(self):
+        return {'criterion': self.config.get('exit_criterion', 'entropy'),
+                'entropy': self.config.get('exit_entropy', 0.3),
+                'patience': self.config.get('exit_patience', 3),
+                'tolerance': self.config.get('exit_tolerance', 0.01),
+                'compact': self.config.get('exit_compact', False)}
+
+    def reset_exit_stats(self):
+        """Starts counting, in predict, the samples, the sum of their exit layers, the (sample, layer)
+        pairs computed and those the full encoder computes; nothing is counted without exit heads.
+        """
+        if len(self.network.exit_list) > 0 and self.config.get('exit_criterion', 'entropy') != 'none':
+            self.exit_stats = torch.zeros(4, dtype=torch.long, device=self.device)
+        else:
+            self.exit_stats = None
+
     def save(self, filename):
+        # always save the training weights under 'state'
+        self.ema_train()
         if isinstance(self.mnetwork, torch.nn.parallel.DistributedDataParallel):
             model = self.mnetwork.module
         else:
@@ -372,7 +496,11 @@ class MTDNNModel(object):
             'optimizer': self.optimizer.state_dict(),
             'config': self.config,
         }
-        torch.save(params, filename)
+        if self.ema is not None:
+            params['ema'] = self.ema.state_dict()
+        # readers (eval_worker.py) never see a partly written file
+        torch.save(params, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
         logger.info('model saved to {}'.format(filename))
 
     def load(self, checkpoint):
@@ -381,8 +509,12 @@ class MTDNNModel(object):
             self.network.load_state_dict(model_state_dict['state'], strict=False)
         if 'optimizer' in model_state_dict:
             self.optimizer.load_state_dict(model_state_dict['optimizer'])
+        if 'ema' in model_state_dict and self.ema is not None:
+            self.ema.load_state_dict(model_state_dict['ema'])
         if 'config' in model_state_dict:
             self.config.update(model_state_dict['config'])
 
     def cuda(self):
         self.network.cuda()
+        self.device = torch.device('cuda', torch.cuda.current_device())
+        self.meters.to(self.device)
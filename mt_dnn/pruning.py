@@ -0,0 +1,140 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Structured pruning of the encoder of a SANBertNetwork for one task.
+
+Attention heads and FFN neurons are scored by |activation x gradient| of the task loss, summed per
+sample (Michel et al., 2019; Molchanov et al., 2017), and the lowest scoring ones are cut out of
+the weight matrices. The new shapes go to the config: pruned_heads, which transformers applies
+when it builds the encoder, and intermediate_sizes, see SANBertNetwork._resize_intermediate,
+so pruned checkpoints load like any other one.
+"""
+import torch
+from transformers.modeling_utils import prune_linear_layer
+from mt_dnn.batcher import Collater
+from mt_dnn.loss import RankCeCriterion
+from mt_dnn.matcher import LAYERED_ENCODER_TYPES
+from data_utils.task_def import EncoderModelType
+
+
+def _check_encoder(network):
+    if network.encoder_type not in LAYERED_ENCODER_TYPES:
+        raise ValueError('pruning needs a BERT or RoBERTa encoder, not {}'.format(
+            EncoderModelType(network.encoder_type).name))
+
+
+def _task_loss(model, batch_meta, batch_data):
+    task_id = batch_meta['task_id']
+    inputs = batch_data[:batch_meta['input_len']]
+    if len(inputs) == 3:
+        inputs = inputs + [None, None]
+    logits = model.network(*inputs, task_id)
+    criterion = model.task_loss_criterion[task_id]
+    label = batch_data[batch_meta['label']]
+    if isinstance(criterion, RankCeCriterion) and batch_meta['pairwise_size'] > 1:
+        return criterion(logits, label, ignore_index=-1, pairwise_size=batch_meta['pairwise_size'])
+    return criterion(logits, label, ignore_index=-1)
+
+
+def importance_scores(model, data, max_batches=None):
+    """Scores of the attention heads and of the FFN neurons of every layer, on training batches
+    (with labels) of one task. Returns two lists with a CPU tensor per layer.
+    """
+    network = model.network
+    _check_encoder(network)
+    layers = network.bert.encoder.layer
+    outputs = {}
+
+    def keep_output(key):
+        def hook(module, inputs, output):
+            output = output[0] if isinstance(output, tuple) else output
+            output.retain_grad()
+            outputs[key] = output
+        return hook
+
+    hooks = []
+    for idx, layer in enumerate(layers):
+        hooks.append(layer.attention.self.register_forward_hook(keep_output(('head', idx))))
+        hooks.append(layer.intermediate.register_forward_hook(keep_output(('ffn', idx))))
+    head_scores = [torch.zeros(layer.attention.self.num_attention_heads, device=model.device) for layer in layers]
+    ffn_scores = [torch.zeros(layer.intermediate.dense.out_features, device=model.device) for layer in layers]
+    # no dropout, the scores are those of the deployed model
+    network.eval()
+    try:
+        for idx, (batch_meta, batch_data) in enumerate(data):
+            if max_batches is not None and idx >= max_batches:
+                break
+            batch_meta, batch_data = Collater.patch_data(model.device, batch_meta, batch_data)
+            network.zero_grad()
+            _task_loss(model, batch_meta, batch_data).backward()
+            for layer_idx, layer in enumerate(layers):
+                # per sample sums over the tokens, [batch, heads * head_size] and [batch, neurons]
+                context = outputs[('head', layer_idx)]
+                context = (context * context.grad).sum(1)
+                context = context.view(context.size(0), layer.attention.self.num_attention_heads, -1)
+                head_scores[layer_idx] += context.sum(-1).abs().sum(0).detach()
+                ffn = outputs[('ffn', layer_idx)]
+                ffn_scores[layer_idx] += (ffn * ffn.grad).sum(1).abs().sum(0).detach()
+            outputs.clear()
+    finally:
+        for hook in hooks:
+            hook.remove()
+        network.zero_grad()
+    return [score.cpu() for score in head_scores], [score.cpu() for score in ffn_scores]
+
+
+def select_pruned(scores, ratio, min_keep=1):
+    """Indices to remove per layer: the ratio of all units with the lowest scores, the scores of
+    each layer normalized by their L2 norm first; at least min_keep units stay in every layer
+    """
+    normalized = [score / score.norm().clamp(min=1e-12) for score in scores]
+    flat = torch.cat(normalized)
+    num_pruned = int(len(flat) * ratio)
+    pruned = [[] for _ in scores]
+    if num_pruned == 0:
+        return pruned
+    layer_of = torch.cat([torch.full((len(score),), idx, dtype=torch.long) for idx, score in enumerate(scores)])
+    unit_of = torch.cat([torch.arange(len(score)) for score in scores])
+    for flat_idx in torch.argsort(flat).tolist():
+        layer_idx = layer_of[flat_idx].item()
+        if len(scores[layer_idx]) - len(pruned[layer_idx]) <= min_keep:
+            continue
+        pruned[layer_idx].append(unit_of[flat_idx].item())
+        num_pruned -= 1
+        if num_pruned == 0:
+            break
+    return pruned
+
+
+def prune_heads(network, pruned):
+    """pruned: heads to remove per layer, indexed among the heads the layer still has"""
+    _check_encoder(network)
+    heads_to_prune = {}
+    for layer_idx, (layer, heads) in enumerate(zip(network.bert.encoder.layer, pruned)):
+        if len(heads) == 0:
+            continue
+        # transformers counts heads in the unpruned layer
+        num_heads = layer.attention.self.num_attention_heads + len(layer.attention.pruned_heads)
+        remaining = [head for head in range(num_heads) if head not in layer.attention.pruned_heads]
+        heads_to_prune[layer_idx] = [remaining[head] for head in heads]
+    network.bert.prune_heads(heads_to_prune)
+
+
+def prune_ffn(network, pruned):
+    """pruned: FFN neurons to remove per layer"""
+    _check_encoder(network)
+    for layer, neurons in zip(network.bert.encoder.layer, pruned):
+        if len(neurons) == 0:
+            continue
+        keep = torch.ones(layer.intermediate.dense.out_features, dtype=torch.bool)
+        keep[neurons] = False
+        index = keep.nonzero().squeeze(1)
+        layer.intermediate.dense = prune_linear_layer(layer.intermediate.dense, index, dim=0)
+        layer.output.dense = prune_linear_layer(layer.output.dense, index, dim=1)
+
+
+def pruned_config(config, network):
+    """the config of the pruned network, from which SANBertNetwork builds the same shapes"""
+    config = dict(config)
+    config['pruned_heads'] = dict((layer, sorted(heads)) for layer, heads in network.bert.config.pruned_heads.items())
+    config['intermediate_sizes'] = [layer.intermediate.dense.out_features for layer in network.bert.encoder.layer]
+    return config
@@ -0,0 +1,203 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Candidate retrieval with the bi-encoder of a ranking task (train.py --bi_encoder).
+
+The candidates are encoded once into a feature store (data_utils/feature_store.py), one pooled
+row per candidate. CandidateIndex searches it exhaustively, in chunks, or with an inverted file
+(IVF) index built by build_ivf: k-means lists of the candidates, of which only the nprobe
+closest to a query are scanned. The shortlist may then be re-ranked by a cross-encoder.
+"""
+import json
+import os
+import numpy as np
+import torch
+from data_utils.feature_store import FeatureWriter, FeatureStore
+from data_utils.task_def import DataFormat, EncoderModelType
+from mt_dnn.batcher import Collater
+
+IVF_FILES = ('ivf_centroids.bin', 'ivf_vectors.bin', 'ivf_rows.bin', 'ivf_offsets.bin')
+
+
+def load_sequences(path):
+    """prepared single sequence samples (uid, token_id, type_id), one json per line"""
+    with open(path, encoding='utf-8') as reader:
+        return [json.loads(line) for line in reader]
+
+
+def sequence_batches(samples, batch_size, encoder_type=EncoderModelType.BERT):
+    """yields (batch_meta, batch_data) of single sequences, with the uids in batch_meta"""
+    collater = Collater(is_train=False, encoder_type=encoder_type)
+    for start in range(0, len(samples), batch_size):
+        batch = samples[start:start + batch_size]
+        batch_meta, batch_data = collater._prepare_model_input(batch, DataFormat.PremiseOnly)
+        batch_meta['uids'] = [sample['uid'] for sample in batch]
+        yield batch_meta, batch_data
+
+
+def encode_candidates(model, data, writer):
+    """writes the bi-encoder embedding of every candidate to writer, a FeatureWriter with
+    pooling 'cls'; returns the number of candidates in the store
+    """
+    dtype = getattr(torch, writer.meta['dtype'])
+    for batch_meta, batch_data in data:
+        batch_meta, batch_data = Collater.patch_data(model.device, batch_meta, batch_data)
+        embeddings = model.embed(batch_meta, batch_data)
+        writer.write(embeddings.unsqueeze(1).to(dtype).cpu().numpy(), np.ones(len(batch_meta['uids'])),
+                     batch_meta['uids'])
+    return writer.num_samples
+
+
+def candidate_writer(path, hidden_size, dtype='float32', shard_rows=None):
+    """a new candidate store at path; an IVF index of the previous candidates is removed"""
+    for name in IVF_FILES:
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+    return FeatureWriter(path, [-1], hidden_size, pooling='cls', dtype=dtype, shard_rows=shard_rows)
+
+
+def _topk(scores, rows, top_k):
+    top_k = min(top_k, scores.size(1))
+    scores, idx = scores.topk(top_k, dim=1)
+    return scores, rows.gather(1, idx)
+
+
+class CandidateIndex(object):
+    """index.search(queries, top_k): scores and candidate rows, (n_queries, top_k), of the top_k
+    candidates of every L2 normalized query by cosine; index.uids[row] is the uid of a row.
+    Queries are scanned against chunk_rows candidates at a time, on device.
+    """
+    def __init__(self, path, device='cpu', chunk_rows=65536):
+        self.path = path
+        self.store = FeatureStore(path)
+        self.device = torch.device(device)
+        self.chunk_rows = chunk_rows
+        self.num_shards = int(self.store.index[-1, 0]) + 1 if len(self.store) > 0 else 0
+        self.ivf = None
+        if all(os.path.exists(os.path.join(path, name)) for name in IVF_FILES):
+            centroids = np.array(self.store._memmap('ivf_centroids.bin', np.float32))
+            self.ivf = {'centroids': torch.from_numpy(centroids).view(-1, self.store.hidden_size),
+                        'vectors': self.store._memmap('ivf_vectors.bin', self.store.dtype).reshape(-1, self.store.hidden_size),
+                        'rows': self.store._memmap('ivf_rows.bin', np.int64),
+                        'offsets': self.store._memmap('ivf_offsets.bin', np.int64)}
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def uids(self):
+        return self.store.uids
+
+    def _tensor(self, rows):
+        return torch.from_numpy(np.array(rows, dtype=np.float32)).to(self.device)
+
+    def chunks(self):
+        """(first row, embeddings) of chunk_rows candidates at a time, in row order"""
+        start = 0
+        for shard in range(self.num_shards):
+            matrix = self.store.shard(shard)[:, 0]
+            for offset in range(0, len(matrix), self.chunk_rows):
+                chunk = matrix[offset:offset + self.chunk_rows]
+                yield start + offset, self._tensor(chunk)
+            start += len(matrix)
+
+    def search(self, queries, top_k, nprobe=None):
+        """nprobe: lists of the IVF index scanned per query; None scans every candidate"""
+        queries = queries.to(self.device, torch.float32)
+        if nprobe is not None and self.ivf is not None:
+            return self._search_ivf(queries, top_k, nprobe)
+        scores = queries.new_empty(queries.size(0), 0)
+        rows = torch.empty(queries.size(0), 0, dtype=torch.long, device=self.device)
+        for start, chunk in self.chunks():
+            chunk_rows = torch.arange(start, start + chunk.size(0), device=self.device).expand(queries.size(0), -1)
+            scores, rows = _topk(torch.cat([scores, queries @ chunk.t()], 1), torch.cat([rows, chunk_rows], 1), top_k)
+        return scores, rows
+
+    def _search_ivf(self, queries, top_k, nprobe):
+        centroids = self.ivf['centroids'].to(self.device)
+        offsets = self.ivf['offsets']
+        probes = (queries @ centroids.t()).topk(min(nprobe, centroids.size(0)), dim=1)[1].tolist()
+        scores = queries.new_full((queries.size(0), top_k), float('-inf'))
+        rows = torch.full((queries.size(0), top_k), -1, dtype=torch.long, device=self.device)
+        for idx, probe in enumerate(probes):
+            positions = np.concatenate([np.arange(offsets[l], offsets[l + 1]) for l in probe])
+            if len(positions) == 0:
+                continue
+            vectors = self._tensor(self.ivf['vectors'][positions])
+            candidate_rows = torch.from_numpy(np.asarray(self.ivf['rows'][positions])).to(self.device)
+            score, row = _topk((vectors @ queries[idx]).unsqueeze(0), candidate_rows.unsqueeze(0), top_k)
+            scores[idx, :score.size(1)] = score[0]
+            rows[idx, :row.size(1)] = row[0]
+        return scores, rows
+
+
+def build_ivf(index, num_lists, iterations=10, sample_rows=None, seed=2018):
+    """Spherical k-means lists of the candidates of index, a CandidateIndex, trained on
+    sample_rows random candidates (256 per list by default); every candidate goes to the list of
+    its closest centroid. The candidates are copied list by list, so a list is read in one go.
+    """
+    num_rows = len(index)
+    num_lists = min(num_lists, num_rows)
+    sample_rows = min(sample_rows or 256 * num_lists, num_rows)
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(num_rows, sample_rows, replace=False))
+    vectors = torch.cat([chunk[torch.from_numpy(sample[(sample >= start) & (sample < start + chunk.size(0))] - start)]
+                         for start, chunk in index.chunks()])
+    centroids = vectors[torch.from_numpy(rng.choice(sample_rows, num_lists, replace=False))]
+    for _ in range(iterations):
+        assign = (vectors @ centroids.t()).argmax(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, vectors)
+        filled = torch.bincount(assign, minlength=num_lists) > 0
+        # an empty list keeps its centroid
+        centroids[filled] = torch.nn.functional.normalize(sums[filled], dim=-1)
+    assign = torch.cat([(chunk @ centroids.t()).argmax(1) for _, chunk in index.chunks()]).cpu().numpy()
+    order = np.argsort(assign, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=num_lists))])
+    path = index.path
+    centroids.cpu().numpy().astype(np.float32).tofile(os.path.join(path, 'ivf_centroids.bin'))
+    with open(os.path.join(path, 'ivf_vectors.bin'), 'wb') as writer:
+        for start in range(0, num_rows, index.chunk_rows):
+            rows = order[start:start + index.chunk_rows]
+            writer.write(np.ascontiguousarray(_gather(index.store, rows), dtype=index.store.dtype).tobytes())
+    order.astype(np.int64).tofile(os.path.join(path, 'ivf_rows.bin'))
+    offsets.astype(np.int64).tofile(os.path.join(path, 'ivf_offsets.bin'))
+    return CandidateIndex(path, index.device, index.chunk_rows)
+
+
+def _gather(store, rows):
+    """embeddings of the given candidate rows, (len(rows), hidden_size)"""
+    index = store.index[rows]
+    out = np.empty((len(rows), store.hidden_size), dtype=store.dtype)
+    for shard in np.unique(index[:, 0]):
+        selected = index[:, 0] == shard
+        out[selected] = store.shard(int(shard))[index[selected, 1], 0]
+    return out
+
+
+def join_pair(premise, hypothesis, encoder_type=EncoderModelType.BERT, max_seq_len=512):
+    """the cross-encoder input of two single sequences, as prepared for pair tasks"""
+    if encoder_type == EncoderModelType.ROBERTA:
+        token_id = premise + premise[-1:] + hypothesis[1:]
+        type_id = [0] * len(token_id)
+    else:
+        token_id = premise + hypothesis[1:]
+        type_id = [0] * len(premise) + [1] * (len(hypothesis) - 1)
+    if len(token_id) > max_seq_len:
+        token_id = token_id[:max_seq_len - 1] + token_id[-1:]
+        type_id = type_id[:max_seq_len - 1] + type_id[-1:]
+    return {'token_id': token_id, 'type_id': type_id}
+
+
+def rerank(model, query, candidates, task_id=0, batch_size=32, max_seq_len=512):
+    """cross-encoder ranking logits of the (query, candidate) pairs of prepared samples"""
+    task_def = model.config['task_def_list'][0]
+    encoder_type = model.config.get('encoder_type', EncoderModelType.BERT)
+    collater = Collater(is_train=False, encoder_type=encoder_type)
+    pairs = [join_pair(query['token_id'], candidate['token_id'], encoder_type, max_seq_len) for candidate in candidates]
+    scores = []
+    for start in range(0, len(pairs), batch_size):
+        batch_meta, batch_data = collater._prepare_model_input(pairs[start:start + batch_size], task_def.data_type)
+        batch_meta['task_id'] = task_id
+        batch_meta['input_len'] = len(batch_data)
+        batch_meta, batch_data = Collater.patch_data(model.device, batch_meta, batch_data)
+        scores.append(model.predict_logits(batch_meta, batch_data).view(-1))
+    return torch.cat(scores) if scores else torch.zeros(0)
@@ -1,16 +1,22 @@
 import argparse
 import json
 import os
+import time
 import torch
 from torch.utils.data import DataLoader
 
 from data_utils.task_def import TaskType
 from experiments.exp_def import TaskDefs, EncoderModelType
 from torch.utils.data import Dataset, DataLoader, BatchSampler
-from mt_dnn.batcher import SingleTaskDataset, Collater
-from mt_dnn.model import MTDNNModel
+from mt_dnn.batcher import SingleTaskDataset, Collater, DistTaskDataset, DistSingleTaskBatchSampler
+from mt_dnn.matcher import EXIT_CRITERIA
+from mt_dnn.cpu_workers import run_workers, share_weights
+from mt_dnn.cascade import CONFIDENCE_MODES, CascadeModel, calibrate_threshold, score_dev
+from mt_dnn.ensemble import AVERAGE_MODES, build_ensemble, load_model
 from data_utils.metrics import calc_metrics
 from mt_dnn.inference import eval_model
+from data_utils.prediction_store import PredictionWriter, prediction_shard_path, merge_predictions
+from data_utils.utils import gather_to_rank0
 
 def dump(path, data):
     with open(path, 'w') as f:
@@ -24,57 +30,171 @@ parser.add_argument("--task_id", type=int, help="the id of this task when traini
 parser.add_argument("--prep_input", type=str)
 parser.add_argument("--with_label", action="store_true")
 parser.add_argument("--score", type=str, help="score output path")
+parser.add_argument("--prediction_format", type=str, default="json", choices=["json", "binary"],
+                    help="binary streams predictions to a memory-mappable directory at the --score path")
+
+parser.add_argument("--score_mode", type=str, default="full", choices=["full", "top1", "none"],
+                    help="scores kept in the output: all classes, the predicted class or none")
 
 parser.add_argument('--max_seq_len', type=int, default=512)
 parser.add_argument('--batch_size_eval', type=int, default=8)
 parser.add_argument('--cuda', type=bool, default=torch.cuda.is_available(),
                     help='whether to use GPU acceleration.')
 
-parser.add_argument("--checkpoint", default='mt_dnn_models/bert_model_base_uncased.pt', type=str)
-
-args = parser.parse_args()
-
-# load task info
-task = args.task
-task_defs = TaskDefs(args.task_def)
-assert args.task in task_defs._task_type_map
-assert args.task in task_defs._data_type_map
-assert args.task in task_defs._metric_meta_map
-prefix = task.split('_')[0]
-task_def = task_defs.get_task_def(prefix)
-data_type = task_defs._data_type_map[args.task]
-task_type = task_defs._task_type_map[args.task]
-metric_meta = task_defs._metric_meta_map[args.task]
-# load model
-checkpoint_path = args.checkpoint
-assert os.path.exists(checkpoint_path)
-if args.cuda:
-    state_dict = torch.load(checkpoint_path)
-else:
-    state_dict = torch.load(checkpoint_path, map_location="cpu")
-config = state_dict['config']
-config["cuda"] = args.cuda
-task_def = task_defs.get_task_def(prefix)
-task_def_list = [task_def]
-config['task_def_list'] = task_def_list
-## temp fix
-config['fp16'] = False
-config['answer_opt'] = 0
-config['adv_train'] = False
-del state_dict['optimizer']
-model = MTDNNModel(config, state_dict=state_dict)
-encoder_type = config.get('encoder_type', EncoderModelType.BERT)
-# load data
-test_data_set = SingleTaskDataset(args.prep_input, False, maxlen=args.max_seq_len, task_id=args.task_id, task_def=task_def)
-collater = Collater(is_train=False, encoder_type=encoder_type)
-test_data = DataLoader(test_data_set, batch_size=args.batch_size_eval, collate_fn=collater.collate_fn, pin_memory=args.cuda)
-
-with torch.no_grad():
-    test_metrics, test_predictions, scores, golds, test_ids = eval_model(model, test_data,
-                                                                         metric_meta=metric_meta,
-                                                                         use_cuda=args.cuda, with_label=args.with_label)
-
-    results = {'metrics': test_metrics, 'predictions': test_predictions, 'uids': test_ids, 'scores': scores}
-    dump(args.score, results)
-    if args.with_label:
-        print(test_metrics)
+parser.add_argument("--checkpoint", default='mt_dnn_models/bert_model_base_uncased.pt', type=str,
+                    help="a checkpoint, or comma separated checkpoints scored as an ensemble in one pass")
+parser.add_argument("--use_ema", action="store_true", help="predict with the EMA weights saved in the checkpoint")
+
+# early exit, for checkpoints trained with --early_exit; the training values are used by default
+parser.add_argument("--exit_criterion", type=str, default=None, choices=EXIT_CRITERIA)
+parser.add_argument("--exit_entropy", type=float, default=None)
+parser.add_argument("--exit_patience", type=int, default=None)
+parser.add_argument("--exit_tolerance", type=float, default=None)
+parser.add_argument("--exit_compact", type=int, default=None, choices=[0, 1],
+                    help="1 drops the finished samples from the batch, 0 runs the whole batch")
+
+# ensembles, see mt_dnn/ensemble.py
+parser.add_argument("--ensemble_weights", type=str, default=None,
+                    help="comma separated weights of the checkpoints, equal by default")
+parser.add_argument("--ensemble_average", type=str, default="prob", choices=AVERAGE_MODES,
+                    help="average the class probabilities or the logits of the checkpoints")
+parser.add_argument("--ensemble_workers", type=int, default=0,
+                    help="worker processes the checkpoints after the first one are split over; 0 runs them all here")
+
+# cascades, see mt_dnn/cascade.py; --checkpoint is the small model
+parser.add_argument("--cascade_checkpoint", type=str, default=None,
+                    help="large checkpoint the samples --checkpoint is not confident about go to")
+parser.add_argument("--cascade_confidence", type=str, default="prob", choices=CONFIDENCE_MODES)
+parser.add_argument("--cascade_threshold", type=float, default=0.9, help="lowest confidence kept by the small model")
+parser.add_argument("--cascade_calibrate", type=str, default=None,
+                    help="prepared dev data with labels, the threshold is calibrated on instead")
+parser.add_argument("--cascade_max_drop", type=float, default=0.0,
+                    help="calibration: dev accuracy of the cascade allowed below the one of the large model")
+parser.add_argument("--cascade_report", action="store_true",
+                    help="also predict with the large model alone and report its metrics and time")
+
+# CPU inference workers, see mt_dnn/cpu_workers.py
+parser.add_argument("--cpu_workers", type=int, default=0,
+                    help="forked worker processes sharing the weights, each predicting a block of the data")
+parser.add_argument("--worker_threads", type=int, default=None,
+                    help="intra-op threads per worker, by default the number of cores it is pinned to")
+parser.add_argument("--no_pin_cores", action="store_true", help="do not pin the workers to their cores")
+
+
+def main():
+    args = parser.parse_args()
+
+    # load task info
+    task = args.task
+    task_defs = TaskDefs(args.task_def)
+    assert args.task in task_defs._task_type_map
+    assert args.task in task_defs._data_type_map
+    assert args.task in task_defs._metric_meta_map
+    prefix = task.split('_')[0]
+    task_def = task_defs.get_task_def(prefix)
+    task_type = task_defs._task_type_map[args.task]
+    metric_meta = task_defs._metric_meta_map[args.task]
+    device = torch.device("cuda" if args.cuda else "cpu")
+    # load model(s)
+    checkpoints = args.checkpoint.split(',')
+    for checkpoint_path in checkpoints:
+        assert os.path.exists(checkpoint_path)
+    config_updates = {}
+    for key in ('exit_criterion', 'exit_entropy', 'exit_patience', 'exit_tolerance', 'exit_compact'):
+        if getattr(args, key) is not None:
+            config_updates[key] = getattr(args, key)
+    weights = [float(weight) for weight in args.ensemble_weights.split(',')] if args.ensemble_weights else None
+    ensemble = build_ensemble(checkpoints, task_def, device, weights=weights, average=args.ensemble_average,
+                              num_workers=args.ensemble_workers, use_ema=args.use_ema, config_updates=config_updates)
+    # a single checkpoint is predicted by its model
+    model = ensemble.models[0] if len(checkpoints) == 1 else ensemble
+    encoder_type = ensemble.models[0].config.get('encoder_type', EncoderModelType.BERT)
+    # load data
+    collater = Collater(is_train=False, encoder_type=encoder_type, bi_encoder=ensemble.models[0].config.get('bi_encoder', False))
+
+    def data_loader(path):
+        data_set = SingleTaskDataset(path, False, maxlen=args.max_seq_len, task_id=args.task_id, task_def=task_def)
+        return DataLoader(data_set, batch_size=args.batch_size_eval, collate_fn=collater.collate_fn, pin_memory=args.cuda)
+    test_data = data_loader(args.prep_input)
+
+    if args.cascade_checkpoint:
+        assert len(checkpoints) == 1, "a cascade starts from a single checkpoint"
+        large = load_model(args.cascade_checkpoint, task_def, device, args.use_ema, config_updates)
+        threshold = args.cascade_threshold
+        if args.cascade_calibrate:
+            with torch.no_grad():
+                dev_scores = score_dev(model, large, data_loader(args.cascade_calibrate), device, args.cascade_confidence)
+            threshold, dev_rate = calibrate_threshold(*dev_scores, max_drop=args.cascade_max_drop)
+            print('calibrated cascade threshold {:.4f}, dev deferral rate {:.4f}'.format(threshold, dev_rate))
+        model = CascadeModel(model, large, threshold, args.cascade_confidence)
+
+    def predict(rank=0, world_size=1):
+        """predicts test_data; with several workers, those of this rank, gathered to rank 0"""
+        data = test_data
+        if world_size > 1:
+            data_set = DistTaskDataset(test_data.dataset, args.task_id)
+            batch_sampler = DistSingleTaskBatchSampler(data_set, args.batch_size_eval, rank=rank, world_size=world_size)
+            data = DataLoader(data_set, batch_sampler=batch_sampler, collate_fn=collater.collate_fn)
+        prediction_writer = None
+        if args.prediction_format == "binary":
+            # with several workers, each writes its outputs and rank 0 merges them
+            prediction_writer = PredictionWriter(prediction_shard_path(args.score, rank) if world_size > 1 else args.score)
+        keep_predictions = args.prediction_format != "binary"
+        start = time.perf_counter()
+        with torch.no_grad():
+            test_metrics, test_predictions, scores, golds, test_ids = eval_model(model, data,
+                                                                                 metric_meta=metric_meta,
+                                                                                 device=device,
+                                                                                 with_label=args.with_label,
+                                                                                 label_mapper=task_def.label_vocab,
+                                                                                 task_type=task_type,
+                                                                                 keep_predictions=keep_predictions,
+                                                                                 prediction_writer=prediction_writer,
+                                                                                 score_mode=args.score_mode,
+                                                                                 dist_gather=world_size > 1)
+        if args.cascade_checkpoint:
+            stats = model.stats
+            if world_size > 1:
+                shards = gather_to_rank0(stats)
+                stats = [sum(counts) for counts in zip(*shards)] if rank == 0 else stats
+            model.stats = stats
+            test_metrics['deferral_rate'] = model.deferral_rate
+            test_metrics['seconds'] = time.perf_counter() - start
+            if args.cascade_report:
+                start = time.perf_counter()
+                with torch.no_grad():
+                    large_metrics = eval_model(large, data, metric_meta=metric_meta, device=device, with_label=args.with_label,
+                                               label_mapper=task_def.label_vocab, task_type=task_type, keep_predictions=False,
+                                               dist_gather=world_size > 1)[0]
+                large_metrics['seconds'] = time.perf_counter() - start
+                for key, val in large_metrics.items():
+                    test_metrics['large_{}'.format(key)] = val
+        metrics = dict((key, val if isinstance(val, (str, float)) else str(val)) for key, val in test_metrics.items())
+        if prediction_writer is not None:
+            prediction_writer.close(metrics if world_size == 1 else None)
+            if world_size > 1:
+                torch.distributed.barrier()
+        if rank != 0:
+            return
+
+        if prediction_writer is not None:
+            if world_size > 1:
+                merge_predictions(args.score, world_size, metrics)
+        else:
+            results = {'metrics': test_metrics, 'predictions': test_predictions, 'uids': test_ids, 'scores': scores}
+            dump(args.score, results)
+        if test_metrics:
+            print(test_metrics)
+
+    try:
+        if args.cpu_workers > 0:
+            assert not args.cuda and len(checkpoints) == 1, "CPU workers run a single checkpoint (or a cascade) on the CPU"
+            share_weights(*([model.small, model.large] if args.cascade_checkpoint else [model]))
+            run_workers(predict, args.cpu_workers, num_threads=args.worker_threads, pin_cores=not args.no_pin_cores)
+        else:
+            predict()
+    finally:
+        ensemble.close()
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@ parser.add_argument("--add_soft_label", action="store_true",
                     help="without this option, we replace hard label with soft label")
 
 parser.add_argument("--std_input", type=str)
-parser.add_argument("--score", type=str)
+parser.add_argument("--score", type=str, help="JSON score file or binary prediction store (.pred)")
 parser.add_argument("--std_output", type=str)
 
 args = parser.parse_args()
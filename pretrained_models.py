@@ -1,10 +1,53 @@
-from transformers import *
-from module.san_model import SanModel
-MODEL_CLASSES = {
-    "bert": (BertConfig, BertModel, BertTokenizer),
-    "xlnet": (XLNetConfig, XLNetModel, XLNetTokenizer),
-    "roberta": (RobertaConfig, RobertaModel, RobertaTokenizer),
-    "albert": (AlbertConfig, AlbertModel, AlbertTokenizer),
-    "xlm": (XLMRobertaConfig, XLMRobertaModel, XLMRobertaTokenizer),
-    "san": (BertConfig, SanModel, BertTokenizer),
-}
\ No newline at end of file
+# Copyright (c) Microsoft. All rights reserved.
+"""MODEL_CLASSES: encoder type -> (config class, model class, tokenizer class).
+The classes are imported on the first lookup of their encoder type, so importing this module
+loads neither transformers nor the encoders which are not used.
+"""
+import importlib
+from collections.abc import Mapping
+
+_MODEL_CLASS_PATHS = {
+    "bert": ("transformers.configuration_bert.BertConfig",
+             "transformers.modeling_bert.BertModel",
+             "transformers.tokenization_bert.BertTokenizer"),
+    "xlnet": ("transformers.configuration_xlnet.XLNetConfig",
+              "transformers.modeling_xlnet.XLNetModel",
+              "transformers.tokenization_xlnet.XLNetTokenizer"),
+    "roberta": ("transformers.configuration_roberta.RobertaConfig",
+                "transformers.modeling_roberta.RobertaModel",
+                "transformers.tokenization_roberta.RobertaTokenizer"),
+    "albert": ("transformers.configuration_albert.AlbertConfig",
+               "transformers.modeling_albert.AlbertModel",
+               "transformers.tokenization_albert.AlbertTokenizer"),
+    "xlm": ("transformers.configuration_xlm_roberta.XLMRobertaConfig",
+            "transformers.modeling_xlm_roberta.XLMRobertaModel",
+            "transformers.tokenization_xlm_roberta.XLMRobertaTokenizer"),
+    "san": ("transformers.configuration_bert.BertConfig",
+            "module.san_model.SanModel",
+            "transformers.tokenization_bert.BertTokenizer"),
+}
+
+
+def _import_class(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class LazyModelClasses(Mapping):
+    def __init__(self, class_paths):
+        self._class_paths = class_paths
+        self._classes = {}
+
+    def __getitem__(self, encoder_type):
+        if encoder_type not in self._classes:
+            self._classes[encoder_type] = tuple(_import_class(path) for path in self._class_paths[encoder_type])
+        return self._classes[encoder_type]
+
+    def __iter__(self):
+        return iter(self._class_paths)
+
+    def __len__(self):
+        return len(self._class_paths)
+
+
+MODEL_CLASSES = LazyModelClasses(_MODEL_CLASS_PATHS)
@@ -0,0 +1,131 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Prunes attention heads and FFN neurons of a trained checkpoint for one task, see mt_dnn/pruning.py,
+and optionally fine-tunes the pruned model for a short while to recover. The output checkpoint has
+smaller weight matrices and loads with predict.py.
+
+python prune.py --checkpoint checkpoints/mnli/model_2.pt --task mnli --task_id 0 \
+    --train_data data/canonical_data/bert_uncased_lower/mnli_train.json \
+    --dev_data data/canonical_data/bert_uncased_lower/mnli_matched_dev.json \
+    --head_ratio 0.3 --ffn_ratio 0.3 --recovery_epochs 1 --output checkpoints/mnli/model_2_pruned.pt
+"""
+import argparse
+import os
+import time
+import torch
+from torch.utils.data import DataLoader
+from data_utils.log_wrapper import create_logger
+from data_utils.utils import set_environment
+from experiments.exp_def import TaskDefs
+from mt_dnn.batcher import SingleTaskDataset, Collater
+from mt_dnn.inference import eval_model
+from mt_dnn.model import MTDNNModel
+from mt_dnn.pruning import importance_scores, select_pruned, prune_heads, prune_ffn, pruned_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--task_def', type=str, default='experiments/glue/glue_task_def.yml')
+    parser.add_argument('--task', type=str, required=True)
+    parser.add_argument('--task_id', type=int, default=0, help='the id of this task when training')
+    parser.add_argument('--train_data', type=str, required=True,
+                        help='prepared training data, for the importance scores and the recovery fine-tune')
+    parser.add_argument('--dev_data', type=str, default=None,
+                        help='prepared dev data, scored (and timed) before and after pruning')
+    parser.add_argument('--max_seq_len', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--batch_size_eval', type=int, default=8)
+    parser.add_argument('--score_batches', type=int, default=200, help='training batches the importance is summed over')
+    parser.add_argument('--head_ratio', type=float, default=0.3, help='share of the attention heads to remove')
+    parser.add_argument('--ffn_ratio', type=float, default=0.3, help='share of the FFN neurons to remove')
+    parser.add_argument('--recovery_epochs', type=int, default=0)
+    parser.add_argument('--learning_rate', type=float, default=2e-5)
+    parser.add_argument('--use_ema', action='store_true', help='prune the EMA weights saved in the checkpoint')
+    parser.add_argument('--cuda', type=bool, default=torch.cuda.is_available(),
+                        help='whether to use GPU acceleration.')
+    parser.add_argument('--seed', type=int, default=2018)
+    parser.add_argument('--log_file', default='mt-dnn-prune.log')
+    return parser.parse_args()
+
+
+def load_model(config, state, device, num_train_step=-1):
+    return MTDNNModel(config, device=device, state_dict={'state': state}, num_train_step=num_train_step)
+
+
+def evaluate(model, data, task_def, device):
+    start = time.perf_counter()
+    with torch.no_grad():
+        metrics = eval_model(model, data, metric_meta=task_def.metric_meta, device=device,
+                             label_mapper=task_def.label_vocab, task_type=task_def.task_type, keep_predictions=False)[0]
+    return metrics, time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    logger = create_logger(__name__, to_disk=True, log_file=args.log_file)
+    set_environment(args.seed, args.cuda)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    task_def = TaskDefs(args.task_def).get_task_def(args.task.split('_')[0])
+
+    state_dict = torch.load(args.checkpoint, map_location=device)
+    config = state_dict['config']
+    config['cuda'] = args.cuda
+    config['local_rank'] = -1
+    config['multi_gpu_on'] = False
+    config['fp16'] = False
+    config['adv_train'] = False
+    config['ema_opt'] = 0
+    config['learning_rate'] = args.learning_rate
+    if args.use_ema and 'ema' in state_dict:
+        state_dict['state'].update(state_dict['ema'])
+    model = load_model(config, state_dict['state'], device)
+
+    collater = Collater(is_train=True, dropout_w=0, encoder_type=config['encoder_type'], max_seq_len=args.max_seq_len)
+    train_set = SingleTaskDataset(args.train_data, True, maxlen=args.max_seq_len, task_id=args.task_id, task_def=task_def)
+    train_data = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, collate_fn=collater.collate_fn,
+                            pin_memory=args.cuda)
+    dev_data = None
+    if args.dev_data:
+        dev_collater = Collater(is_train=False, encoder_type=config['encoder_type'], max_seq_len=args.max_seq_len)
+        dev_set = SingleTaskDataset(args.dev_data, False, maxlen=args.max_seq_len, task_id=args.task_id, task_def=task_def)
+        dev_data = DataLoader(dev_set, batch_size=args.batch_size_eval, collate_fn=dev_collater.collate_fn,
+                              pin_memory=args.cuda)
+        metrics, seconds = evaluate(model, dev_data, task_def, device)
+        logger.info('Before pruning: {} in {:.2f}s'.format(metrics, seconds))
+        full_seconds = seconds
+
+    head_scores, ffn_scores = importance_scores(model, train_data, max_batches=args.score_batches)
+    pruned_heads = select_pruned(head_scores, args.head_ratio)
+    pruned_neurons = select_pruned(ffn_scores, args.ffn_ratio)
+    prune_heads(model.network, pruned_heads)
+    prune_ffn(model.network, pruned_neurons)
+    num_params = sum(p.nelement() for p in model.network.parameters())
+    logger.info('Removed {} heads and {} FFN neurons, {} parameters left'.format(
+        sum(len(heads) for heads in pruned_heads), sum(len(neurons) for neurons in pruned_neurons), num_params))
+
+    # built again from the pruned config, as predict.py does
+    config = pruned_config(config, model.network)
+    model = load_model(config, model.network.state_dict(), device,
+                       num_train_step=args.recovery_epochs * len(train_data))
+    if dev_data is not None:
+        metrics, seconds = evaluate(model, dev_data, task_def, device)
+        logger.info('After pruning: {} in {:.2f}s ({:.2f}x)'.format(metrics, seconds, full_seconds / seconds))
+
+    for epoch in range(args.recovery_epochs):
+        for batch_meta, batch_data in train_data:
+            batch_meta, batch_data = Collater.patch_data(device, batch_meta, batch_data)
+            model.update(batch_meta, batch_data)
+        model.sync_meters()
+        logger.info('Recovery epoch {}: train loss {:.4f}'.format(epoch, model.train_loss.avg))
+        if dev_data is not None:
+            metrics, seconds = evaluate(model, dev_data, task_def, device)
+            logger.info('After recovery epoch {}: {} in {:.2f}s'.format(epoch, metrics, seconds))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    model.save(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Retrieves the top candidates of every query with a bi-encoder ranking checkpoint (train.py
+--bi_encoder), see mt_dnn/retrieval.py. The candidates are encoded into --index_dir unless it
+already holds them; --ivf_lists adds an approximate index, searched with --nprobe. The
+shortlist can be re-ranked by a cross-encoder ranking checkpoint.
+
+Queries and candidates are prepared single sequence data (uid, token_id, type_id per line).
+
+python retrieve.py --checkpoint checkpoints/qnli_bi/model_2.pt --task qnli \
+    --candidates data/passages.json --index_dir data/passages_index --ivf_lists 1024 --nprobe 16 \
+    --queries data/questions.json --top_k 100 \
+    --rerank_checkpoint checkpoints/qnli/model_2.pt --rerank_k 20 --output retrieved.json
+"""
+import argparse
+import json
+import time
+import torch
+from data_utils.feature_store import DTYPES, is_feature_store
+from data_utils.log_wrapper import create_logger
+from experiments.exp_def import TaskDefs, EncoderModelType
+from mt_dnn.batcher import Collater
+from mt_dnn.ensemble import load_model
+from mt_dnn.retrieval import (CandidateIndex, build_ivf, candidate_writer, encode_candidates, load_sequences,
+                              rerank, sequence_batches)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True, help='bi-encoder ranking checkpoint')
+    parser.add_argument('--task_def', type=str, default='experiments/glue/glue_task_def.yml')
+    parser.add_argument('--task', type=str, required=True)
+    parser.add_argument('--task_id', type=int, default=0, help='the id of this task when training')
+    parser.add_argument('--candidates', type=str, default=None, help='prepared candidates, encoded into --index_dir')
+    parser.add_argument('--index_dir', type=str, required=True)
+    parser.add_argument('--rebuild', action='store_true', help='encode the candidates again')
+    parser.add_argument('--dtype', type=str, default='float16', choices=DTYPES)
+    parser.add_argument('--shard_rows', type=int, default=1000000)
+    parser.add_argument('--ivf_lists', type=int, default=0, help='k-means lists of an IVF index, 0 for none')
+    parser.add_argument('--nprobe', type=int, default=None, help='IVF lists scanned per query; all candidates by default')
+    parser.add_argument('--queries', type=str, required=True)
+    parser.add_argument('--top_k', type=int, default=100)
+    parser.add_argument('--rerank_checkpoint', type=str, default=None, help='cross-encoder ranking checkpoint')
+    parser.add_argument('--rerank_k', type=int, default=20, help='candidates of the shortlist re-ranked')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--max_seq_len', type=int, default=512)
+    parser.add_argument('--cuda', type=bool, default=torch.cuda.is_available(),
+                        help='whether to use GPU acceleration.')
+    parser.add_argument('--log_file', default='mt-dnn-retrieve.log')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logger = create_logger(__name__, to_disk=True, log_file=args.log_file)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    task_def = TaskDefs(args.task_def).get_task_def(args.task.split('_')[0])
+    model = load_model(args.checkpoint, task_def, device)
+    encoder_type = model.config.get('encoder_type', EncoderModelType.BERT)
+
+    if args.rebuild or not is_feature_store(args.index_dir):
+        assert args.candidates is not None, 'no candidates in {}, --candidates is needed'.format(args.index_dir)
+        start = time.perf_counter()
+        writer = candidate_writer(args.index_dir, model.network.bert.config.hidden_size, args.dtype, args.shard_rows)
+        with torch.no_grad():
+            num_candidates = encode_candidates(model, sequence_batches(load_sequences(args.candidates), args.batch_size,
+                                                                       encoder_type), writer)
+        writer.close()
+        logger.info('Encoded {} candidates in {:.2f}s'.format(num_candidates, time.perf_counter() - start))
+    index = CandidateIndex(args.index_dir, device)
+    if args.ivf_lists > 0 and (index.ivf is None or index.ivf['centroids'].size(0) != args.ivf_lists):
+        start = time.perf_counter()
+        index = build_ivf(index, args.ivf_lists)
+        logger.info('Built {} IVF lists in {:.2f}s'.format(args.ivf_lists, time.perf_counter() - start))
+
+    queries = load_sequences(args.queries)
+    cross_model = None
+    candidates = None
+    if args.rerank_checkpoint:
+        cross_model = load_model(args.rerank_checkpoint, task_def, device)
+        assert args.candidates is not None, 're-ranking needs the --candidates tokens'
+        candidates = dict((str(sample['uid']), sample) for sample in load_sequences(args.candidates))
+
+    start = time.perf_counter()
+    results = []
+    with torch.no_grad():
+        offset = 0
+        for batch_meta, batch_data in sequence_batches(queries, args.batch_size, encoder_type):
+            batch_meta, batch_data = Collater.patch_data(device, batch_meta, batch_data)
+            scores, rows = index.search(model.embed(batch_meta, batch_data), args.top_k, nprobe=args.nprobe)
+            for query, score, row in zip(queries[offset:offset + len(rows)], scores.tolist(), rows.tolist()):
+                uids = [index.uids[r] for r in row if r >= 0]
+                result = {'uid': query['uid'], 'candidates': uids, 'scores': score[:len(uids)]}
+                if cross_model is not None:
+                    shortlist = uids[:args.rerank_k]
+                    cross_scores = rerank(cross_model, query, [candidates[uid] for uid in shortlist], args.task_id,
+                                          args.batch_size, args.max_seq_len)
+                    order = torch.argsort(cross_scores, descending=True).tolist()
+                    result['reranked'] = [shortlist[i] for i in order]
+                    result['rerank_scores'] = [cross_scores[i].item() for i in order]
+                results.append(result)
+            offset += len(rows)
+    logger.info('Retrieved for {} queries from {} candidates in {:.2f}s'.format(
+        len(results), len(index), time.perf_counter() - start))
+    with open(args.output, 'w', encoding='utf-8') as writer:
+        for result in results:
+            writer.write('{}\n'.format(json.dumps(result)))
+
+
+if __name__ == '__main__':
+    main()
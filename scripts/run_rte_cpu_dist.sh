@@ -0,0 +1,30 @@
+#!/bin/bash
+# distributed training on CPU nodes with the gloo backend; run it on every node with its node rank
+if [[ $# -lt 3 ]]; then
+  echo "run_rte_cpu_dist.sh <batch_size> <procs_per_node> <num_nodes> [node_rank] [master_addr]"
+  exit 1
+fi
+prefix="mt-dnn-rte-cpu"
+BATCH_SIZE=$1
+NPROC=$2
+NNODES=$3
+NODE_RANK=${4:-0}
+MASTER_ADDR=${5:-localhost}
+export CUDA_VISIBLE_DEVICES=""
+tstr=$(date +"%FT%H%M")
+
+train_datasets="rte"
+test_datasets="rte"
+BERT_PATH="../mt_dnn_models/mt_dnn_base_uncased.pt"
+DATA_DIR="../data/canonical_data/bert_base_uncased_lower"
+
+answer_opt=0
+optim="adamax"
+grad_clipping=0
+global_grad_clipping=1
+lr="2e-5"
+
+model_dir="checkpoints/${prefix}_${optim}_answer_opt${answer_opt}_gc${grad_clipping}_ggc${global_grad_clipping}_${tstr}"
+log_file="${model_dir}/log.log"
+torchrun --nproc_per_node ${NPROC} --nnodes ${NNODES} --node_rank ${NODE_RANK} --master_addr ${MASTER_ADDR} --master_port 6600 \
+  ../train.py --backend gloo --task_def ../experiments/glue/glue_task_def.yml --data_dir ${DATA_DIR} --init_checkpoint ${BERT_PATH} --batch_size ${BATCH_SIZE} --output_dir ${model_dir} --log_file ${log_file} --answer_opt ${answer_opt} --optimizer ${optim} --train_datasets ${train_datasets} --test_datasets ${test_datasets} --grad_clipping ${grad_clipping} --global_grad_clipping ${global_grad_clipping} --learning_rate ${lr}
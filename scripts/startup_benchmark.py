@@ -0,0 +1,56 @@
+"""Startup time of the command line entry points: the median wall time of `python <script> --help`,
+which parses the arguments right after the imports, and optionally the slowest imports.
+
+python scripts/startup_benchmark.py --repeat 5 --importtime
+"""
+import os
+import argparse
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = ['train.py', 'predict.py', 'prepro_std.py', 'calc_metrics.py', 'eval_worker.py', 'extractor.py']
+
+
+def time_startup(script, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, '--help'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def slowest_imports(script, top):
+    """(cumulative microseconds, module) of the top-level imports of script"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', script, '--help'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # only the imports done by the script itself
+        if not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scripts', type=str, default=','.join(ENTRY_POINTS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--importtime', action='store_true', help='also list the slowest imports of each script')
+    parser.add_argument('--top', type=int, default=5)
+    args = parser.parse_args()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(root)
+    for script in args.scripts.split(','):
+        print('{:<20} {:6.2f}s'.format(script, time_startup(script, args.repeat)))
+        if args.importtime:
+            for cumulative, name in slowest_imports(script, args.top):
+                print('    {:<40} {:6.2f}s'.format(name, cumulative / 1e6))
+
+
+if __name__ == '__main__':
+    main()
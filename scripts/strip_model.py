@@ -21,7 +21,7 @@ def main():
         state_dict = torch.load(model_path)
         config = state_dict['config']
         opt.update(config)
-        if state_dict['config']['ema_opt'] > 0:
+        if state_dict['config'].get('ema_opt', 0) > 0 and 'ema' in state_dict:
             new_state_dict = {'state': state_dict['ema'], 'config': state_dict['config']}
         else:
             new_state_dict = {'state': state_dict['state'], 'config': state_dict['config']}
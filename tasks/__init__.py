@@ -7,6 +7,23 @@ from module.san import SANClassifier
 
 TASK_REGISTRY = {}
 TASK_CLASS_NAMES = set()
+SCORE_MODES = ('full', 'top1', 'none')
+
+
+def select_scores(score, predict, score_mode='full'):
+    """Picks on device the scores which are moved to host: all of them (batch x n_class),
+    the score of the predicted class (top1) or nothing (none); returned flattened on CPU
+    """
+    if score_mode == 'full':
+        score = score.reshape(-1)
+    elif score_mode == 'top1':
+        score = score.gather(-1, predict.unsqueeze(-1)).reshape(-1)
+    elif score_mode == 'none':
+        score = score.new_zeros(0)
+    else:
+        raise ValueError('Unknown score_mode: {}, should be one of {}'.format(score_mode, SCORE_MODES))
+    return score.cpu()
+
 
 class MTDNNTask:
     def __init__(self, task_def):
@@ -56,7 +73,8 @@ class MTDNNTask:
         batch_info['label'] = labels
     
     @staticmethod
-    def test_predict(score):
+    def test_predict(score, score_mode='full'):
+        """returns the selected scores and the int predictions as flat CPU tensors"""
         raise NotImplementedError()
 
 
@@ -113,12 +131,10 @@ class RegressionTask(MTDNNTask):
         return torch.FloatTensor(softlabels)
 
     @staticmethod
-    def test_predict(score):
-        score = score.data.cpu()
-        score = score.numpy()
-        predict = np.argmax(score, axis=1).tolist()
-        score = score.reshape(-1).tolist()
-        return score, predict
+    def test_predict(score, score_mode='full'):
+        score = score.detach()
+        predict = torch.argmax(score, dim=1)
+        return select_scores(score, predict, score_mode), predict.int().cpu()
 
 @register_task('Classification')
 class ClassificationTask(MTDNNTask):
@@ -141,10 +157,7 @@ class ClassificationTask(MTDNNTask):
         return torch.FloatTensor(softlabels)
 
     @staticmethod
-    def test_predict(score):
-        score = F.softmax(score, dim=1)
-        score = score.data.cpu()
-        score = score.numpy()
-        predict = np.argmax(score, axis=1).tolist()
-        score = score.reshape(-1).tolist()
-        return score, predict
\ No newline at end of file
+    def test_predict(score, score_mode='full'):
+        score = F.softmax(score.detach(), dim=1)
+        predict = torch.argmax(score, dim=1)
+        return select_scores(score, predict, score_mode), predict.int().cpu()
\ No newline at end of file
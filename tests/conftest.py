@@ -0,0 +1,97 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Shared helpers of the tests: a tiny MT-DNN model on two GLUE tasks and its batches, and the
+features of squad doc spans.
+
+The fixtures return the helper functions themselves, so that tests may build several models or
+batches and pass the helpers on to spawned workers.
+"""
+import random
+import pytest
+import torch
+
+
+def _tiny_opt(**kw):
+    """the config of a 2 layer BERT with a small vocabulary, trained on mnli and stsb"""
+    from experiments.exp_def import TaskDefs
+    task_defs = TaskDefs('experiments/glue/glue_task_def.yml')
+    opt = {'vocab_size': 128, 'hidden_size': 16, 'num_hidden_layers': 2, 'num_attention_heads': 2,
+           'intermediate_size': 32, 'hidden_act': 'gelu', 'hidden_dropout_prob': 0.1,
+           'attention_probs_dropout_prob': 0.1, 'max_position_embeddings': 64, 'type_vocab_size': 2,
+           'initializer_range': 0.02, 'encoder_type': 1, 'update_bert_opt': 0, 'answer_opt': 0,
+           'dropout_p': 0.1, 'vb_dropout': True, 'init_ratio': 1, 'cuda': False,
+           'local_rank': -1, 'world_size': 1, 'multi_gpu_on': False,
+           'optimizer': 'adamax', 'learning_rate': 5e-5, 'warmup': 0.1, 'grad_clipping': 0,
+           'warmup_schedule': 'warmup_linear', 'weight_decay': 0, 'fp16': False,
+           'have_lr_scheduler': False, 'global_grad_clipping': 1.0, 'bin_on': False,
+           'batch_size': 4, 'grad_accumulation_step': 1, 'adam_eps': 1e-6,
+           'task_def_list': [task_defs.get_task_def('mnli'), task_defs.get_task_def('stsb')]}
+    opt.update(kw)
+    return opt
+
+
+def _tiny_model(seed=0, state=None, **kw):
+    """an MTDNNModel of _tiny_opt(**kw), initialized from seed or loaded from state"""
+    from mt_dnn.model import MTDNNModel
+    torch.manual_seed(seed)
+    return MTDNNModel(_tiny_opt(**kw), device=torch.device('cpu'), state_dict={'state': state or {}}, num_train_step=10)
+
+
+def _tiny_batch(task_id, task_def, seed):
+    """a training batch of 4 random pairs"""
+    from mt_dnn.batcher import Collater
+    rnd = random.Random(seed)
+    batch = []
+    for i in range(4):
+        length = rnd.randint(4, 10)
+        label = rnd.randint(0, task_def.n_class - 1) if task_def.n_class > 1 else rnd.random()
+        sample = {'uid': str(i), 'label': label,
+                  'token_id': [101] + [rnd.randint(5, 99) for _ in range(length - 2)] + [102],
+                  'type_id': [0] * (length // 2) + [1] * (length - length // 2)}
+        batch.append({'task': {'task_id': task_id, 'task_def': task_def}, 'sample': sample})
+    return Collater(is_train=True).collate_fn(batch)
+
+
+def _tiny_eval_batch(task_def, seed):
+    """the batch of _tiny_batch as eval_model gets it: the inputs, and the labels in batch_meta"""
+    batch_meta, batch_data = _tiny_batch(0, task_def, seed)
+    batch_meta['label'] = batch_data[batch_meta['label']].tolist()
+    return batch_meta, batch_data[:3]
+
+
+def _mrc_feature(example_index, doc_span_index, doc_offset, words):
+    """the InputFeatures of a squad doc span: question q, then the words from doc_offset on"""
+    from experiments.squad.squad_utils import InputFeatures
+    tokens = ['[CLS]', 'q', '[SEP]'] + ['w%d' % w for w in words] + ['[SEP]']
+    token_to_orig_map = dict((doc_offset + i, w) for i, w in enumerate(words))
+    token_is_max_context = dict((doc_offset + i, i % 2 == 0) for i in range(len(words)))
+    return InputFeatures(1000, example_index, doc_span_index, tokens, token_to_orig_map, token_is_max_context,
+                         input_ids=list(range(len(tokens))), input_mask=[1] * len(tokens),
+                         segment_ids=[0] * doc_offset + [1] * (len(tokens) - doc_offset),
+                         start_position=doc_offset, end_position=doc_offset + 1, is_impossible=False,
+                         doc_offset=doc_offset)
+
+
+@pytest.fixture
+def tiny_opt():
+    return _tiny_opt
+
+
+@pytest.fixture
+def tiny_model():
+    return _tiny_model
+
+
+@pytest.fixture
+def tiny_batch():
+    return _tiny_batch
+
+
+@pytest.fixture
+def tiny_eval_batch():
+    return _tiny_eval_batch
+
+
+@pytest.fixture
+def mrc_feature():
+    return _mrc_feature
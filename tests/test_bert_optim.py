@@ -0,0 +1,103 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import math
+import pytest
+import torch
+from torch.nn.utils import clip_grad_norm_
+import module.bert_optim as bert_optim
+from module.bert_optim import Adamax, RAdam, scheduled_lr
+
+
+def reference_adamax_step(group, params, state):
+    """per-parameter Adamax update as implemented before the multi-tensor version"""
+    beta1, beta2 = group['betas']
+    for p in params:
+        if p.grad is None:
+            continue
+        st = state.setdefault(p, {'step': 0, 'exp_avg': torch.zeros_like(p), 'exp_inf': torch.zeros_like(p)})
+        if group['max_grad_norm'] > 0:
+            clip_grad_norm_(p, group['max_grad_norm'])
+        grad = p.grad
+        st['exp_avg'].mul_(beta1).add_(grad, alpha=1 - beta1)
+        norm_buf = torch.cat([st['exp_inf'].mul_(beta2).unsqueeze(0), grad.abs().add_(group['eps']).unsqueeze_(0)], 0)
+        st['exp_inf'] = torch.max(norm_buf, 0)[0]
+        update = st['exp_avg'] / (st['exp_inf'] + group['eps'])
+        if group['weight_decay'] > 0.0:
+            update += group['weight_decay'] * p.data
+        p.data.add_(-scheduled_lr(group, st['step']) * update)
+        st['step'] += 1
+
+
+def reference_radam_step(group, params, state):
+    beta1, beta2 = group['betas']
+    for p in params:
+        if p.grad is None:
+            continue
+        st = state.setdefault(p, {'step': 0, 'exp_avg': torch.zeros_like(p), 'exp_avg_sq': torch.zeros_like(p)})
+        if group['max_grad_norm'] > 0:
+            clip_grad_norm_(p, group['max_grad_norm'])
+        grad = p.grad
+        st['exp_avg'].mul_(beta1).add_(grad, alpha=1 - beta1)
+        st['exp_avg_sq'].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        st['step'] += 1
+        step = st['step']
+        lr = scheduled_lr(group, step)
+        beta2_t = beta2 ** step
+        N_sma_max = 2 / (1 - beta2) - 1
+        N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+        if N_sma >= 5:
+            step_size = lr * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+            p.data.addcdiv_(st['exp_avg'], st['exp_avg_sq'].sqrt().add_(group['eps']), value=-step_size)
+        else:
+            p.data.add_(st['exp_avg'], alpha=-lr / (1 - beta1 ** step))
+        if group['weight_decay'] != 0:
+            p.data.add_(p.data, alpha=-group['weight_decay'] * lr)
+
+
+def make_params(seed=0):
+    torch.manual_seed(seed)
+    return [torch.nn.Parameter(torch.randn(*shape)) for shape in [(7, 5), (5,), (3, 4, 2), (1,)]]
+
+
+def run_compare(optim_cls, reference_step, steps=12, **kwargs):
+    params = make_params()
+    ref_params = [p.detach().clone().requires_grad_() for p in params]
+    optimizer = optim_cls(params, lr=1e-2, warmup=0.1, t_total=steps, max_grad_norm=0.5, **kwargs)
+    ref_state = {}
+    for i in range(steps):
+        torch.manual_seed(100 + i)
+        grads = [torch.randn_like(p) * 3 for p in params]
+        for idx, (p, rp, g) in enumerate(zip(params, ref_params, grads)):
+            # the last parameter is a task head which is only used every other step
+            if idx == len(params) - 1 and i % 2 == 1:
+                p.grad, rp.grad = None, None
+            else:
+                p.grad, rp.grad = g.clone(), g.clone()
+        optimizer.step()
+        reference_step(optimizer.param_groups[0], ref_params, ref_state)
+    for p, rp in zip(params, ref_params):
+        assert torch.allclose(p, rp, atol=1e-6), (p, rp)
+    return optimizer
+
+
+@pytest.mark.parametrize("foreach", [True, False])
+def test_adamax_matches_reference(monkeypatch, foreach):
+    monkeypatch.setattr(bert_optim, 'FOREACH_AVAILABLE', foreach and bert_optim.FOREACH_AVAILABLE)
+    run_compare(Adamax, reference_adamax_step, weight_decay=0.01)
+
+
+@pytest.mark.parametrize("foreach", [True, False])
+def test_radam_matches_reference(monkeypatch, foreach):
+    monkeypatch.setattr(bert_optim, 'FOREACH_AVAILABLE', foreach and bert_optim.FOREACH_AVAILABLE)
+    run_compare(RAdam, reference_radam_step, weight_decay=0.01)
+
+
+def test_state_dict_layout():
+    optimizer = run_compare(Adamax, reference_adamax_step)
+    state = optimizer.state_dict()['state']
+    assert set(state[0].keys()) == {'step', 'exp_avg', 'exp_inf'}
+    assert state[0]['step'] == 12 and state[3]['step'] == 6
+    params = make_params()
+    reloaded = Adamax(params, lr=1e-2)
+    reloaded.load_state_dict(optimizer.state_dict())
+    assert reloaded.get_lr() == optimizer.get_lr()
@@ -0,0 +1,47 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import torch
+from mt_dnn.cascade import CascadeModel, calibrate_threshold, confidence
+
+
+def test_calibrate_threshold():
+    confidences = torch.tensor([0.9, 0.8, 0.7, 0.6, 0.5])
+    small_correct = torch.tensor([True, True, False, True, False])
+    large_correct = torch.tensor([True, True, True, True, False])
+    # keeping 2 is as accurate as the large model, keeping 3 or more is not
+    threshold, rate = calibrate_threshold(confidences, small_correct, large_correct)
+    assert abs(threshold - 0.75) < 1e-6 and abs(rate - 0.6) < 1e-6
+    # one error more is allowed: all samples but the last one, which both models get wrong
+    threshold, rate = calibrate_threshold(confidences, small_correct, large_correct, max_drop=0.2)
+    assert threshold == float('-inf') and rate == 0.0
+    # ties go together
+    threshold, rate = calibrate_threshold(torch.tensor([0.9, 0.8, 0.8, 0.6, 0.5]), small_correct, large_correct)
+    assert abs(threshold - 0.85) < 1e-6 and abs(rate - 0.8) < 1e-6
+
+
+def test_cascade_defers_the_low_confidence_samples(tiny_model, tiny_eval_batch):
+    small = tiny_model(0)
+    # a different architecture, as a distilled model and its teacher
+    large = tiny_model(1, num_hidden_layers=3)
+    task_def = small.config['task_def_list'][0]
+    batch_meta, batch_data = tiny_eval_batch(task_def, seed=0)
+    with torch.no_grad():
+        small_logits = small.predict_logits(batch_meta, batch_data)
+        large_logits = large.predict_logits(batch_meta, batch_data)
+        conf = confidence(small_logits)
+        threshold = conf.median().item()
+        cascade = CascadeModel(small, large, threshold)
+        score = cascade.predict(batch_meta, batch_data)[0].view(4, -1)
+    deferred = conf < threshold
+    assert 0 < deferred.sum() < 4
+    assert cascade.deferral_rate == deferred.float().mean().item()
+    # the deferred samples are run as a smaller batch with less padding
+    expected = torch.where(deferred.unsqueeze(1), large_logits, small_logits).softmax(-1)
+    assert torch.allclose(score, expected, atol=1e-5)
+
+    cascade.reset_stats()
+    with torch.no_grad():
+        assert torch.allclose(CascadeModel(small, large, float('-inf')).predict(batch_meta, batch_data)[0],
+                              small.predict(batch_meta, batch_data)[0])
+        assert torch.allclose(CascadeModel(small, large, float('inf'), mode='margin').predict(batch_meta, batch_data)[0],
+                              large.predict(batch_meta, batch_data)[0], atol=1e-5)
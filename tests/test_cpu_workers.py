@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import json
+import os
+import tempfile
+import pytest
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from mt_dnn.batcher import Collater, DistTaskDataset, DistSingleTaskBatchSampler
+from mt_dnn.cpu_workers import core_groups, run_workers, share_weights
+from mt_dnn.inference import eval_model
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason='torch.distributed is not available')
+
+
+def test_core_groups():
+    assert core_groups(2, [0, 1, 2, 3, 4]) == [[0, 1], [2, 3, 4]]
+    assert core_groups(3, [4, 5]) == [[4], [5], [4]]
+
+
+def _dataset(task_def):
+    samples = []
+    for i in range(10):
+        length = 4 + i % 5
+        samples.append({'task': {'task_id': 0, 'task_def': task_def},
+                        'sample': {'uid': str(i), 'label': i % 3, 'token_id': [101] + [5 + i] * (length - 2) + [102],
+                                   'type_id': [0] * (length // 2) + [1] * (length - length // 2)}})
+
+    class Samples(list):
+        def get_task_id(self):
+            return 0
+    return Samples(samples)
+
+
+def test_workers_share_the_weights_and_gather_the_outputs(tiny_model):
+    model = tiny_model()
+    task_def = model.config['task_def_list'][0]
+    dataset = _dataset(task_def)
+    collater = Collater(is_train=False)
+    with torch.no_grad():
+        expected = eval_model(model, DataLoader(dataset, batch_size=3, collate_fn=collater.collate_fn),
+                              task_def.metric_meta, 'cpu', label_mapper=task_def.label_vocab)
+    share_weights(model)
+    assert all(param.is_shared() for param in model.network.parameters())
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def predict(rank, world_size):
+            assert torch.get_num_threads() == 1
+            data_set = DistTaskDataset(dataset, 0)
+            batch_sampler = DistSingleTaskBatchSampler(data_set, 3, rank=rank, world_size=world_size)
+            with torch.no_grad():
+                metrics, predictions, scores, golds, uids = eval_model(
+                    model, DataLoader(data_set, batch_sampler=batch_sampler, collate_fn=collater.collate_fn),
+                    task_def.metric_meta, 'cpu', label_mapper=task_def.label_vocab, dist_gather=True)
+            if rank == 0:
+                with open(os.path.join(tmp_dir, 'out.json'), 'w') as writer:
+                    json.dump([metrics, predictions, scores, uids], writer)
+
+        run_workers(predict, 2, num_threads=1)
+        with open(os.path.join(tmp_dir, 'out.json')) as reader:
+            metrics, predictions, scores, uids = json.load(reader)
+    assert uids == expected[4] and predictions == expected[1]
+    assert metrics['ACC'] == expected[0]['ACC']
+    assert max(abs(a - b) for a, b in zip(scores, expected[2])) < 1e-6
+
+
+def test_failed_worker_stops_the_others():
+    def fail(rank, world_size):
+        if rank == 1:
+            raise ValueError('worker failure')
+        # would wait for rank 1 forever
+        dist.barrier()
+
+    with pytest.raises(RuntimeError):
+        run_workers(fail, 2)
@@ -0,0 +1,273 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+"""Multi-process tests on CPU with the gloo backend"""
+import os
+import random
+import socket
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from data_utils.utils import DeviceMeters, distributed_env, init_distributed
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason='torch.distributed is not available')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_workers(fn, world_size, *args):
+    port = free_port()
+    mp.spawn(_init_worker, args=(world_size, port, fn) + args, nprocs=world_size, join=True)
+
+
+def _init_worker(rank, world_size, port, fn, *args):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def _meters_worker(rank, world_size):
+    meters = DeviceMeters(['train_loss', 'adv_loss'], num_tasks=2)
+    # rank 0 sees task 0 only, rank 1 sees both tasks
+    meters.update('train_loss', torch.tensor(1.0 + rank), n=2, task_id=0)
+    if rank == 1:
+        meters.update('train_loss', torch.tensor(5.0), n=4, task_id=1)
+    meters.sync(distributed=True)
+    # (1 * 2 + 2 * 2 + 5 * 4) / 8
+    assert abs(meters.meters['train_loss'].avg - 26.0 / 8) < 1e-6
+    assert abs(meters.task_meters['train_loss'][0].avg - 1.5) < 1e-6
+    assert meters.task_meters['train_loss'][1].count == 4
+    assert meters.meters['adv_loss'].count == 0
+    assert meters.buffer.abs().sum().item() == 0
+
+
+def _gather_worker(rank, world_size):
+    from data_utils.utils import gather_to_rank0, _gather_pickled_to_rank0
+    # the ranks send objects of different sizes
+    obj = {'rank': rank, 'values': list(range(rank * 5))}
+    for gather in (gather_to_rank0, _gather_pickled_to_rank0):
+        gathered = gather(obj)
+        if rank == 0:
+            assert gathered == [{'rank': r, 'values': list(range(r * 5))} for r in range(world_size)]
+        else:
+            assert gathered is None
+
+
+def test_gather_to_rank0():
+    run_workers(_gather_worker, 2)
+
+
+def test_device_meters_single_all_reduce():
+    run_workers(_meters_worker, 2)
+
+
+def _ddp_update_worker(rank, world_size, grad_accumulation_step, tiny_model, tiny_batch):
+    model = tiny_model(local_rank=rank, world_size=world_size, grad_accumulation_step=grad_accumulation_step)
+    assert not model.mnetwork.find_unused_parameters
+    # the ranks train different tasks in the same step, so each head is idle on one rank
+    for step in range(4):
+        task_id = (step + rank) % 2
+        batch_meta, batch_data = tiny_batch(task_id, model.config['task_def_list'][task_id], seed=step * world_size + rank)
+        model.update(batch_meta, batch_data)
+    assert model.updates == 4 // grad_accumulation_step
+    for param in model.network.parameters():
+        params = [torch.zeros_like(param) for _ in range(world_size)]
+        dist.all_gather(params, param.data)
+        assert torch.equal(params[0], params[1])
+
+
+@pytest.mark.parametrize('grad_accumulation_step', [1, 2])
+def test_ddp_update_without_find_unused_parameters(grad_accumulation_step, tiny_model, tiny_batch):
+    run_workers(_ddp_update_worker, 2, grad_accumulation_step, tiny_model, tiny_batch)
+
+
+def _ddp_matches_single_process_worker(rank, world_size, tiny_model, tiny_batch):
+    model = tiny_model(local_rank=rank, world_size=world_size)
+    single = tiny_model()
+    task_defs = model.config['task_def_list']
+    # every rank trains the same task on the same batch, the other head is idle everywhere
+    for step, task_id in enumerate([0, 0, 1, 0]):
+        # the word dropout of the collater draws from random
+        random.seed(step)
+        batch_meta, batch_data = tiny_batch(task_id, task_defs[task_id], seed=step)
+        for trained in (model, single):
+            # the same dropout masks
+            torch.manual_seed(step)
+            trained.update(batch_meta, batch_data)
+    for (name, param), expected in zip(model.network.named_parameters(), single.network.parameters()):
+        assert torch.allclose(param, expected, atol=1e-6), name
+    # the head of task 1 is only in the optimizer state since its step
+    states = [model.optimizer.state[p] for p in model.network.scoring_list[1].parameters()]
+    assert all(state['step'] == single.optimizer.state[p]['step'] == 1
+               for state, p in zip(states, single.network.scoring_list[1].parameters()))
+
+
+@pytest.mark.parametrize('foreach', [True, False])
+def test_drop_idle_grads(monkeypatch, foreach, tiny_model):
+    import mt_dnn.model
+    monkeypatch.setattr(mt_dnn.model, 'FOREACH_AVAILABLE', foreach and mt_dnn.model.FOREACH_AVAILABLE)
+    model = tiny_model()
+    model._ddp_idle_params = model._maybe_unused_parameters()
+    used, idle = model.network.scoring_list[0].weight, model.network.scoring_list[1].weight
+    used.grad, idle.grad = torch.ones_like(used), torch.zeros_like(idle)
+    model._drop_idle_grads()
+    assert used.grad is not None and idle.grad is None
+
+
+def test_ddp_update_matches_single_process(tiny_model, tiny_batch):
+    run_workers(_ddp_matches_single_process_worker, 2, tiny_model, tiny_batch)
+
+
+def test_distributed_env(monkeypatch):
+    for name in ('RANK', 'LOCAL_RANK', 'WORLD_SIZE', 'LOCAL_WORLD_SIZE', 'OMPI_COMM_WORLD_RANK'):
+        monkeypatch.delenv(name, raising=False)
+    assert distributed_env() == (0, -1, 1, 1)
+    assert distributed_env(local_rank=1, world_size=2) == (1, 1, 2, 2)
+    # torchrun, second node of 2 x 4 processes
+    monkeypatch.setenv('RANK', '6')
+    monkeypatch.setenv('LOCAL_RANK', '2')
+    monkeypatch.setenv('WORLD_SIZE', '8')
+    monkeypatch.setenv('LOCAL_WORLD_SIZE', '4')
+    assert distributed_env() == (6, 2, 4, 8)
+    # mpirun takes precedence
+    monkeypatch.setenv('OMPI_COMM_WORLD_RANK', '5')
+    monkeypatch.setenv('OMPI_COMM_WORLD_LOCAL_RANK', '1')
+    monkeypatch.setenv('OMPI_COMM_WORLD_LOCAL_SIZE', '4')
+    monkeypatch.setenv('OMPI_COMM_WORLD_SIZE', '8')
+    assert distributed_env() == (5, 1, 4, 8)
+
+
+def _launcher_worker(rank, world_size, port, tiny_model, tiny_batch):
+    from mt_dnn.batcher import Collater
+    # the environment torchrun sets up
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(world_size),
+                       'LOCAL_WORLD_SIZE': str(world_size), 'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+    rank, local_rank, local_size, world_size = distributed_env()
+    device = init_distributed(rank, local_rank, local_size, world_size, use_cuda=False)
+    try:
+        assert dist.get_backend() == 'gloo'
+        assert device.type == 'cpu'
+        model = tiny_model(local_rank=local_rank, world_size=world_size)
+        for step in range(2):
+            batch_meta, batch_data = tiny_batch(0, model.config['task_def_list'][0], seed=step * world_size + rank)
+            batch_meta, batch_data = Collater.patch_data(device, batch_meta, batch_data)
+            model.update(batch_meta, batch_data)
+        model.sync_meters()
+        assert model.train_loss.count == 4 * 2 * world_size
+        weight = model.network.scoring_list[0].weight.data
+        weights = [torch.zeros_like(weight) for _ in range(world_size)]
+        dist.all_gather(weights, weight)
+        assert torch.equal(weights[0], weights[1])
+    finally:
+        dist.destroy_process_group()
+
+
+def test_cpu_training_from_launcher_env(tiny_model, tiny_batch):
+    mp.spawn(_launcher_worker, args=(2, free_port(), tiny_model, tiny_batch), nprocs=2, join=True)
+
+
+def _write_task_data(path, num_samples):
+    import json
+    with open(path, 'w', encoding='utf-8') as writer:
+        for i in range(num_samples):
+            sample = {'uid': str(i), 'label': i % 3, 'token_id': [101, 5 + i % 50, 102], 'type_id': [0, 0, 0]}
+            writer.write('{}\n'.format(json.dumps(sample)))
+
+
+def _sharded_loading_worker(rank, world_size, data_dir):
+    from experiments.exp_def import TaskDefs
+    from mt_dnn.batcher import SingleTaskDataset, MultiTaskDataset, DistMultiTaskBatchSampler
+    task_def = TaskDefs('experiments/glue/glue_task_def.yml').get_task_def('mnli')
+    datasets = [SingleTaskDataset(os.path.join(data_dir, '{}.json'.format(name)), True, task_id=task_id, task_def=task_def,
+                                  printable=False, shard_rank=rank, num_shards=world_size)
+                for task_id, name in enumerate(['large', 'small'])]
+    # samples are split by line, nothing else is loaded
+    assert len(datasets[0]) == (23 + 1 - rank) // 2
+    assert len(datasets[1]) == 5
+    uids = [int(datasets[0][i]['sample']['uid']) for i in range(len(datasets[0]))]
+    assert all(uid % world_size == rank for uid in uids)
+
+    # a different global state on every rank must not change the task order
+    random.seed(rank)
+    sampler = DistMultiTaskBatchSampler(datasets, 4, mix_opt=0, extra_task_ratio=0, rank=rank, world_size=world_size,
+                                        sharded=True, seed=7)
+    dataset = MultiTaskDataset(datasets)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 6 + 3
+    assert all(len(batch) <= 2 for batch in batches)
+    for batch in batches:
+        for task_id, sample_id in batch:
+            assert dataset[(task_id, sample_id)]['task']['task_id'] == task_id
+    task_ids = torch.tensor([batch[0][0] for batch in batches])
+    gathered = [torch.zeros_like(task_ids) for _ in range(world_size)]
+    dist.all_gather(gathered, task_ids)
+    assert torch.equal(gathered[0], gathered[1])
+
+
+def test_rank_local_sharded_loading(tmpdir):
+    _write_task_data(os.path.join(str(tmpdir), 'large.json'), 23)
+    _write_task_data(os.path.join(str(tmpdir), 'small.json'), 10)
+    run_workers(_sharded_loading_worker, 2, str(tmpdir))
+
+
+def _sharded_eval_worker(rank, world_size, data_dir, tiny_model):
+    from torch.utils.data import DataLoader
+    from data_utils.metrics import Metric
+    from data_utils.prediction_store import PredictionWriter, PredictionReader, merge_predictions, prediction_shard_path
+    from mt_dnn.batcher import SingleTaskDataset, DistTaskDataset, DistSingleTaskBatchSampler, Collater
+    from mt_dnn.inference import eval_model
+    # DDP broadcasts the weights of rank 0
+    model = tiny_model(seed=rank, local_rank=rank, world_size=world_size)
+    task_def = model.config['task_def_list'][0]
+    dataset = SingleTaskDataset(os.path.join(data_dir, 'dev.json'), False, task_id=0, task_def=task_def, printable=False)
+    collater = Collater(is_train=False)
+    dist_dataset = DistTaskDataset(dataset, 0)
+    sampler = DistSingleTaskBatchSampler(dist_dataset, 2, rank=rank, world_size=world_size)
+    assert sampler.num_samples == (7 * (rank + 1)) // 2 - (7 * rank) // 2
+    data = DataLoader(dist_dataset, batch_sampler=sampler, collate_fn=collater.collate_fn)
+    metric_meta = [Metric.ACC, Metric.MCC]
+    store = os.path.join(data_dir, 'dev_scores.pred')
+    with torch.no_grad():
+        metrics, predictions, scores, golds, ids = eval_model(model, data, metric_meta, torch.device('cpu'),
+                                                              label_mapper=task_def.label_vocab, dist_gather=True)
+        # every rank writes its outputs, only the metrics are gathered
+        writer = PredictionWriter(prediction_shard_path(store, rank))
+        binary_metrics, binary_predictions = eval_model(model, data, metric_meta, torch.device('cpu'),
+                                                        label_mapper=task_def.label_vocab, keep_predictions=False,
+                                                        prediction_writer=writer, dist_gather=True)[:2]
+        writer.close()
+        dist.barrier()
+        if rank != 0:
+            assert (metrics, predictions, ids) == ({}, [], [])
+            return
+        expected = eval_model(model, DataLoader(dataset, batch_size=2, collate_fn=collater.collate_fn), metric_meta,
+                              torch.device('cpu'), label_mapper=task_def.label_vocab)
+    assert ids == [str(i) for i in range(7)]
+    assert ids == expected[4]
+    assert predictions == expected[1]
+    assert np.allclose(scores, expected[2])
+    assert golds == expected[3]
+    for key, value in expected[0].items():
+        assert np.allclose(metrics[key], value)
+        assert np.allclose(binary_metrics[key], value)
+
+    assert binary_predictions == []
+    merge_predictions(store, world_size, binary_metrics)
+    reader = PredictionReader(store)
+    assert reader.uids == expected[4]
+    assert reader.predictions.tolist() == expected[1]
+    assert np.allclose(reader.scores.reshape(-1), expected[2])
+
+
+def test_sharded_evaluation_gathers_in_order(tmpdir, tiny_model):
+    _write_task_data(os.path.join(str(tmpdir), 'dev.json'), 7)
+    run_workers(_sharded_eval_worker, 2, str(tmpdir), tiny_model)
@@ -0,0 +1,78 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import pytest
+import torch
+import torch.nn.functional as F
+from mt_dnn.inference import eval_model
+
+
+@pytest.fixture
+def exit_model(tiny_model):
+    def build(**kw):
+        return tiny_model(num_hidden_layers=3, early_exit=True, **kw)
+    return build
+
+
+def _inputs(batch_meta, batch_data, task_id):
+    return batch_data[:3] + [None, None, task_id]
+
+
+@pytest.mark.parametrize('exit_distill', [False, True])
+def test_exit_heads_are_trained(exit_distill, exit_model, tiny_batch):
+    # no optimizer step, so the gradients stay
+    model = exit_model(grad_accumulation_step=2, exit_distill=exit_distill)
+    assert [len(exits) for exits in model.network.exit_list] == [2, 2]
+    model.update(*tiny_batch(0, model.config['task_def_list'][0], seed=0))
+    for task_id, exits in enumerate(model.network.exit_list):
+        for exit_head in exits:
+            has_grad = exit_head.proj.weight.grad is not None and exit_head.proj.weight.grad.abs().sum() > 0
+            assert has_grad == (task_id == 0)
+
+
+def test_exit_forward_matches_the_layers_it_exits_on(exit_model, tiny_batch):
+    model = exit_model()
+    network = model.network.eval()
+    batch_meta, batch_data = tiny_batch(0, model.config['task_def_list'][0], seed=1)
+    inputs = _inputs(batch_meta, batch_data, 0)
+    with torch.no_grad():
+        full = network(*inputs)
+        logits, exit_layer, computed = network.exit_forward(*inputs, criterion='entropy', entropy=-1.0)
+        assert torch.allclose(logits, full, atol=1e-6)
+        assert exit_layer.tolist() == [3] * 4 and computed == 12
+
+        # an untrained exit head is close to uniform for every sample
+        network.exit_list[0][0].proj.weight.mul_(300)
+        _, _, all_hidden_states = network.encode(*batch_data[:3])
+        first_exit = network.exit_list[0][0](all_hidden_states[1])
+        prob = F.softmax(first_exit, dim=-1)
+        entropy = -(prob * prob.log()).sum(-1)
+        ordered = entropy.sort().values
+        threshold = (ordered[1] + ordered[2]).item() / 2
+        results = [network.exit_forward(*inputs, criterion='entropy', entropy=threshold, compact=compact)
+                   for compact in (False, True)]
+    (logits, exit_layer, computed), (compact_logits, compact_exit_layer, compact_computed) = results
+    early = entropy < threshold
+    assert 0 < early.sum() < 4
+    assert torch.equal(exit_layer, compact_exit_layer)
+    assert torch.allclose(logits, compact_logits, atol=1e-6)
+    assert (exit_layer[early] == 1).all()
+    assert torch.allclose(logits[early], first_exit[early], atol=1e-6)
+    # compaction runs the later layers on the remaining samples only
+    assert compact_computed < computed
+
+
+def test_eval_model_reports_exits(exit_model, tiny_eval_batch):
+    model = exit_model(exit_criterion='entropy', exit_entropy=10.0, exit_compact=True)
+    task_def = model.config['task_def_list'][0]
+    batches = [tiny_eval_batch(task_def, seed=seed) for seed in range(2)]
+    metrics = eval_model(model, batches, task_def.metric_meta, 'cpu', label_mapper=task_def.label_vocab)[0]
+    assert metrics['exit_layer'] == 1.0
+    assert metrics['exit_speedup'] == 3.0
+    model.config['exit_criterion'] = 'none'
+    metrics = eval_model(model, batches, task_def.metric_meta, 'cpu', label_mapper=task_def.label_vocab)[0]
+    assert 'exit_layer' not in metrics
+
+
+def test_early_exit_needs_a_layered_encoder(exit_model):
+    with pytest.raises(ValueError):
+        exit_model(encoder_type=3)
@@ -0,0 +1,34 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import torch
+from module.my_optim import EMA
+
+
+def test_ema_update_and_swap():
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 3)
+    ema = EMA(0.9, model, update_per_steps=2)
+    expected = dict((k, v.detach().clone()) for k, v in model.named_parameters())
+    for step in range(1, 5):
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1.0)
+        ema.update()
+        if step % 2 == 0:
+            for k, p in model.named_parameters():
+                expected[k] = 0.9 * expected[k] + 0.1 * p.detach()
+    for k, v in ema.state_dict().items():
+        assert torch.allclose(v, expected[k])
+        assert not ema.shadow[k].requires_grad
+
+    weight = model.weight.detach().clone()
+    ema.swap_parameters()
+    assert torch.allclose(model.weight, expected['weight'])
+    # state_dict still returns the EMA weights while they are swapped in
+    assert torch.allclose(ema.state_dict()['weight'], expected['weight'])
+    ema.swap_parameters()
+    assert torch.equal(model.weight, weight)
+
+    other = EMA(0.9, torch.nn.Linear(4, 3))
+    other.load_state_dict(ema.state_dict())
+    assert torch.allclose(other.shadow['bias'], expected['bias'])
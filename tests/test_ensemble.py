@@ -0,0 +1,63 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import tempfile
+import torch
+import torch.nn.functional as F
+from data_utils.task_def import TaskType
+from mt_dnn.ensemble import combine_logits, build_ensemble, EnsembleModel
+
+
+def test_combine_logits():
+    first, second = torch.tensor([[2.0, 0.0, -1.0]]), torch.tensor([[0.0, 1.0, 0.0]])
+    prob = (3 * F.softmax(first, -1) + F.softmax(second, -1)) / 4
+    combined = combine_logits([first, second], [3, 1], 'prob', TaskType.Classification)
+    assert torch.allclose(F.softmax(combined, -1), prob)
+    combined = combine_logits([first, second], [3, 1], 'logit', TaskType.Classification)
+    assert torch.allclose(combined, (3 * first + second) / 4)
+    # regression is averaged as it is
+    combined = combine_logits([first[0], second[0]], [1, 1], 'prob', TaskType.Regression)
+    assert torch.allclose(combined, (first[0] + second[0]) / 2)
+    # ranking groups are normalized over their candidates
+    combined = combine_logits([first.view(-1), second.view(-1)], [1, 1], 'prob', TaskType.Ranking, pairwise_size=3)
+    assert combined.shape == (3,)
+    assert torch.allclose(F.softmax(combined, -1), (F.softmax(first, -1) + F.softmax(second, -1))[0] / 2)
+
+
+def test_ensemble_of_one_model_predicts_like_it(tiny_model, tiny_eval_batch):
+    model = tiny_model()
+    task_def = model.config['task_def_list'][0]
+    batch_meta, batch_data = tiny_eval_batch(task_def, seed=0)
+    with torch.no_grad():
+        expected = model.predict(batch_meta, batch_data)
+        score, predict, _ = EnsembleModel([model, model], weights=[1.0, 2.0]).predict(batch_meta, batch_data)
+    assert torch.allclose(score, expected[0], atol=1e-6)
+    assert torch.equal(predict, expected[1])
+
+
+def test_worker_ensemble_matches_local_ensemble(monkeypatch, tiny_model, tiny_eval_batch):
+    # checkpoints keep the config, which newer torch does not load by default
+    monkeypatch.setenv('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')
+    models = [tiny_model(seed) for seed in range(3)]
+    task_def = models[0].config['task_def_list'][0]
+    batch_meta, batch_data = tiny_eval_batch(task_def, seed=1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoints = []
+        for idx, model in enumerate(models):
+            checkpoints.append(os.path.join(tmp_dir, 'model_{}.pt'.format(idx)))
+            model.save(checkpoints[-1])
+        weights = [1.0, 2.0, 0.5]
+        local = build_ensemble(checkpoints, task_def, torch.device('cpu'), weights=weights)
+        remote = build_ensemble(checkpoints, task_def, torch.device('cpu'), weights=weights, num_workers=2)
+        try:
+            assert len(local.models) == 3 and len(remote.models) == 1 and len(remote.workers) == 2
+            with torch.no_grad():
+                local_score = local.predict(batch_meta, batch_data)[0]
+                remote_score = remote.predict(batch_meta, batch_data)[0]
+        finally:
+            remote.close()
+    assert torch.allclose(local_score, remote_score, atol=1e-6)
+    with torch.no_grad():
+        probs = [F.softmax(model.predict_logits(batch_meta, batch_data), -1) for model in models]
+    expected = sum(w * prob for w, prob in zip(weights, probs)) / sum(weights)
+    assert torch.allclose(local_score, expected.view(-1), atol=1e-6)
@@ -0,0 +1,60 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import time
+from data_utils.mrc_store import MRCFeatureWriter, mrc_store_path
+from experiments.exp_def import TaskDefs
+from eval_worker import DONE_FILE, checkpoint_step, eval_file, pending_checkpoints, split_paths, watch
+from mt_dnn.batcher import SingleTaskDataset
+
+
+def test_checkpoint_step():
+    assert checkpoint_step('run/model_1_2000.pt') == ('updates', 2000)
+    assert checkpoint_step('model_3.pt') == ('epoch', 3)
+    assert checkpoint_step('model_3.pt.tmp') is None
+    assert checkpoint_step('config.json') is None
+
+
+class RecordingEvaluator(object):
+    logger = __import__('logging').getLogger('test_eval_worker')
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.evaluated = []
+
+    def evaluate(self, checkpoint):
+        self.evaluated.append(os.path.basename(checkpoint))
+        open(eval_file(checkpoint), 'w').close()
+        if len(self.evaluated) == 1:
+            # saved while the first checkpoint is evaluated, right before training ends
+            open(os.path.join(self.output_dir, 'model_0.pt'), 'w').close()
+            open(os.path.join(self.output_dir, DONE_FILE), 'w').close()
+
+
+def test_watch_evaluates_every_checkpoint_once(tmpdir):
+    output_dir = str(tmpdir)
+    for name in ['model_0_10.pt', 'model_0_20.pt', 'model_0_30.pt.tmp']:
+        open(os.path.join(output_dir, name), 'w').close()
+        time.sleep(0.01)
+    open(eval_file(os.path.join(output_dir, 'model_0_10.pt')), 'w').close()
+    assert [os.path.basename(path) for path in pending_checkpoints(output_dir)] == ['model_0_20.pt']
+
+    evaluator = RecordingEvaluator(output_dir)
+    watch(evaluator, output_dir, poll_interval=0.01)
+    assert evaluator.evaluated == ['model_0_20.pt', 'model_0.pt']
+    assert pending_checkpoints(output_dir) == []
+
+
+def test_split_paths_find_mrc_stores(tmpdir, mrc_feature):
+    data_dir = str(tmpdir)
+    # prepro_std.py writes the store of squad dev data, not squad_dev.json
+    writer = MRCFeatureWriter(mrc_store_path(os.path.join(data_dir, 'squad_dev.json')), vocab=['v%d' % i for i in range(16)])
+    writer.add_feature(writer.add_example('q0', 'a b c', ['b']), mrc_feature(0, 0, 3, [0, 1, 2]))
+    writer.close()
+    open(os.path.join(data_dir, 'mnli_test.json'), 'w').close()
+
+    assert split_paths(data_dir, ['squad', 'mnli'], 'dev') == [('squad', os.path.join(data_dir, 'squad_dev.json'))]
+    assert split_paths(data_dir, ['squad', 'mnli'], 'test') == [('mnli', os.path.join(data_dir, 'mnli_test.json'))]
+    task_def = TaskDefs('experiments/squad/squad_task_def.yml').get_task_def('squad')
+    data_set = SingleTaskDataset(os.path.join(data_dir, 'squad_dev.json'), False, task_def=task_def, printable=False)
+    assert len(data_set) == 1 and data_set[0]['sample']['uid'] == 'q0'
@@ -0,0 +1,121 @@
+import os
+import pickle
+import numpy as np
+import pytest
+import torch
+from data_utils.feature_store import FeatureWriter, FeatureStore
+from mt_dnn.inference import pool_features
+
+
+def _batches(seed=0, hidden_size=4, num_layers=2):
+    rng = np.random.RandomState(seed)
+    uid = 0
+    for batch_size in (3, 2, 4):
+        lengths = rng.randint(1, 6, size=batch_size)
+        features = rng.randn(int(lengths.sum()), num_layers, hidden_size).astype(np.float32)
+        uids = [str(uid + i) for i in range(batch_size)]
+        uid += batch_size
+        yield features, lengths, uids
+
+
+def _write(path, batches, **kwargs):
+    writer = FeatureWriter(path, [10, 11], 4, **kwargs)
+    for features, lengths, uids in batches:
+        writer.write(features, lengths, uids)
+    writer.close()
+    return writer
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'float32'])
+def test_round_trip(tmpdir, dtype):
+    path = str(tmpdir.join('features'))
+    batches = list(_batches())
+    _write(path, batches, dtype=dtype)
+    store = pickle.loads(pickle.dumps(FeatureStore(path)))
+    samples = [f for features, lengths, _ in batches for f in np.split(features, np.cumsum(lengths)[:-1])]
+    assert len(store) == len(samples)
+    assert store.layers == [10, 11]
+    for idx, expected in enumerate(samples):
+        assert store[idx].dtype == np.dtype(dtype)
+        np.testing.assert_allclose(store[idx], expected, rtol=1e-3, atol=1e-3)
+    np.testing.assert_array_equal(store.get(4), store[4])
+
+
+def test_resume_drops_partial_sample(tmpdir):
+    path = str(tmpdir.join('features'))
+    batches = list(_batches())
+    _write(path, batches[:2], dtype='float32')
+    # a crash between two files: rows and an offset without its uid
+    with open(os.path.join(path, 'features.0.bin'), 'ab') as writer:
+        writer.write(np.ones((3, 2, 4), dtype=np.float32).tobytes())
+    with open(os.path.join(path, 'index.bin'), 'ab') as writer:
+        writer.write(np.array([0, 1000, 3], dtype=np.int64).tobytes())
+    writer = FeatureWriter(path, [10, 11], 4, dtype='float32', resume=True)
+    assert writer.num_samples == 5
+    writer.write(*batches[2])
+    writer.close()
+
+    expected = str(tmpdir.join('expected'))
+    _write(expected, batches, dtype='float32')
+    store, expected = FeatureStore(path), FeatureStore(expected)
+    assert store.uids == expected.uids
+    for idx in range(len(expected)):
+        np.testing.assert_array_equal(store[idx], expected[idx])
+    with pytest.raises(ValueError):
+        FeatureWriter(path, [11], 4, dtype='float32', resume=True)
+
+
+def test_shards(tmpdir):
+    path = str(tmpdir.join('features'))
+    batches = list(_batches())
+    _write(path, batches, dtype='float32', shard_rows=5)
+    store = FeatureStore(path)
+    shards = sorted(name for name in os.listdir(path) if name.startswith('features.'))
+    assert shards == ['features.{}.bin'.format(shard) for shard in range(store.index[-1, 0] + 1)]
+    rows = np.concatenate([features for features, _, _ in batches])
+    # a batch goes to a new shard once the current one holds shard_rows rows
+    start = 0
+    for idx, (shard, offset, length) in enumerate(store.index):
+        assert offset == 0 or store.index[idx - 1, 0] == shard
+        np.testing.assert_array_equal(store[idx], rows[start:start + length])
+        start += length
+    assert start == len(rows)
+
+
+def test_encode_mode_writes_unpadded_encodings(tmpdir):
+    from mt_dnn.batcher import Collater
+    from mt_dnn.inference import extract_encoding
+
+    class Encoder(object):
+        device = torch.device('cpu')
+
+        def encode(self, batch_info, batch_data):
+            return batch_data[batch_info['token_id']].float().unsqueeze(2).repeat(1, 1, 4)
+
+    collater = Collater(is_train=False)
+    samples = [{'uid': str(i), 'token_id': list(range(1, i + 3)), 'type_id': [0] * (i + 2)} for i in range(5)]
+    data = [collater._prepare_model_input(samples[:3], None), collater._prepare_model_input(samples[3:], None)]
+    for (batch_info, _), batch in zip(data, (samples[:3], samples[3:])):
+        batch_info['uids'] = [sample['uid'] for sample in batch]
+    path = str(tmpdir.join('encoding'))
+    writer = FeatureWriter(path, [-1], 4, dtype='float32', shard_rows=8)
+    assert extract_encoding(Encoder(), data, writer) == 5
+    writer.close()
+    store = FeatureStore(path)
+    for sample in samples:
+        encoding = store.get(sample['uid'])
+        assert encoding.shape == (len(sample['token_id']), 1, 4)
+        np.testing.assert_array_equal(encoding[:, 0, 0], sample['token_id'])
+
+
+def test_pool_features():
+    hidden_states = torch.randn(2, 5, 2, 4)
+    mask = torch.LongTensor([[1, 1, 1, 0, 0], [1, 1, 1, 1, 1]])
+    rows, lengths = pool_features(hidden_states, mask, 'full')
+    assert lengths.tolist() == [3, 5]
+    assert torch.equal(rows, torch.cat([hidden_states[0, :3], hidden_states[1]]))
+    rows, lengths = pool_features(hidden_states, mask, 'mean')
+    assert lengths.tolist() == [1, 1]
+    assert torch.allclose(rows[0], hidden_states[0, :3].mean(0))
+    rows, _ = pool_features(hidden_states, mask, 'cls')
+    assert torch.equal(rows, hidden_states[:, 0])
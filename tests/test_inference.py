@@ -0,0 +1,47 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import torch
+from data_utils.metrics import Metric
+from mt_dnn.inference import eval_model, OutputBuffer
+from tasks import ClassificationTask
+
+
+class FakeModel(object):
+    def predict(self, batch_meta, batch_data, score_mode='full'):
+        score, predict = ClassificationTask.test_predict(batch_data[0], score_mode)
+        return score, predict, batch_meta['label']
+
+
+def make_data(logits, labels, batch_size=3):
+    for start in range(0, len(labels), batch_size):
+        end = start + batch_size
+        yield {'uids': list(range(start, min(end, len(labels)))), 'label': labels[start:end]}, [logits[start:end]]
+
+
+def test_eval_model_score_modes():
+    torch.manual_seed(0)
+    logits = torch.randn(10, 3)
+    labels = torch.randint(0, 3, (10,)).tolist()
+    probs = torch.softmax(logits, dim=1)
+    expected_predict = probs.argmax(1).tolist()
+    acc = 100.0 * sum(p == l for p, l in zip(expected_predict, labels)) / len(labels)
+
+    metrics, predictions, scores, golds, ids = eval_model(FakeModel(), make_data(logits, labels), [Metric.ACC], 'cpu')
+    assert predictions == expected_predict and golds == labels and ids == list(range(10))
+    assert torch.allclose(torch.tensor(scores), probs.reshape(-1))
+    assert abs(metrics['ACC'] - acc) < 1e-6
+
+    _, predictions, scores, _, _ = eval_model(FakeModel(), make_data(logits, labels), [Metric.ACC], 'cpu', score_mode='top1')
+    assert predictions == expected_predict
+    assert torch.allclose(torch.tensor(scores), probs.max(1)[0])
+
+    _, _, scores, _, _ = eval_model(FakeModel(), make_data(logits, labels), [Metric.ACC], 'cpu', score_mode='none')
+    assert scores == []
+
+
+def test_output_buffer_grows():
+    buffer = OutputBuffer(num_rows=2)
+    for start in range(0, 9, 2):
+        batch = torch.arange(start, min(start + 2, 9)).int()
+        buffer.append(batch, len(batch))
+    assert buffer.tolist() == list(range(9))
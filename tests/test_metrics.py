@@ -0,0 +1,86 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import numpy as np
+import pytest
+from data_utils.metrics import Metric, StreamingMetrics, calc_metrics
+
+
+def stream(metric_meta, golds, predictions, scores, n_class, batch_size=7, **kwargs):
+    accumulator = StreamingMetrics(metric_meta, **kwargs)
+    for start in range(0, len(golds), batch_size):
+        end = start + batch_size
+        accumulator.update(predictions[start:end], golds[start:end], scores[start * n_class:end * n_class])
+    return accumulator.compute()
+
+
+@pytest.mark.parametrize("n_class", [2, 3])
+def test_classification_metrics_match(n_class):
+    rng = np.random.RandomState(1)
+    golds = rng.randint(0, n_class, size=103).tolist()
+    scores = rng.rand(103, n_class)
+    predictions = scores.argmax(1).tolist()
+    scores = scores.reshape(-1).tolist()
+    metric_meta = [Metric.ACC, Metric.MCC, Metric.F1MAC, Metric.F1MIC, Metric.CMAT]
+    metric_meta += [Metric.F1, Metric.AUC] if n_class == 2 else []
+    expected = calc_metrics(metric_meta, golds, predictions, scores)
+    result = stream(metric_meta, golds, predictions, scores, n_class)
+    for mm in metric_meta:
+        assert np.allclose(result[mm.name], expected[mm.name]), mm
+
+
+def test_regression_metrics_match():
+    rng = np.random.RandomState(2)
+    golds = (rng.rand(211) * 5).tolist()
+    scores = (np.array(golds) + rng.randn(211) + 100).tolist()
+    metric_meta = [Metric.Pearson, Metric.Spearman]
+    expected = calc_metrics(metric_meta, golds, scores, scores)
+    result = stream(metric_meta, golds, scores, scores, 1)
+    for mm in metric_meta:
+        assert np.isclose(result[mm.name], expected[mm.name]), mm
+    sampled = stream(metric_meta, golds, scores, scores, 1, rank_sample_size=50)
+    assert abs(sampled['Spearman'] - expected['Spearman']) < 20
+    assert len(StreamingMetrics([Metric.Spearman], rank_sample_size=50).accumulators) == 1
+
+
+def test_string_labels_and_unseen_predictions():
+    golds = ['a', 'b', 'a', 'c']
+    predictions = ['a', 'a', 'd', 'c']
+    metric_meta = [Metric.ACC, Metric.F1MAC, Metric.CMAT]
+    expected = calc_metrics(metric_meta, golds, predictions, [])
+    result = stream(metric_meta, golds, predictions, [], 0, batch_size=3)
+    for mm in metric_meta:
+        assert np.allclose(result[mm.name], expected[mm.name]), mm
+
+
+def test_merged_shards_match():
+    rng = np.random.RandomState(3)
+    golds = rng.randint(0, 2, size=90).tolist()
+    scores = rng.rand(90, 2)
+    predictions = scores.argmax(1).tolist()
+    scores = scores.reshape(-1).tolist()
+    metric_meta = [Metric.ACC, Metric.F1, Metric.MCC, Metric.CMAT, Metric.AUC]
+    # shards of different sizes; the second one only sees label 1
+    shards = [(0, 50), (50, 51), (51, 90)]
+    golds[50] = 1
+    predictions[50] = 1
+    expected = calc_metrics(metric_meta, golds, predictions, scores)
+    merged = None
+    for start, end in shards:
+        accumulator = StreamingMetrics(metric_meta)
+        accumulator.update(predictions[start:end], golds[start:end], scores[2 * start:2 * end])
+        merged = accumulator if merged is None else merged.merge(accumulator)
+    result = merged.compute()
+    for mm in metric_meta:
+        assert np.allclose(result[mm.name], expected[mm.name]), mm
+
+    golds = rng.rand(90).tolist()
+    scores = (np.asarray(golds) + rng.rand(90)).tolist()
+    expected = calc_metrics([Metric.Pearson, Metric.Spearman], golds, scores, scores)
+    merged = StreamingMetrics([Metric.Pearson, Metric.Spearman])
+    for start, end in shards:
+        accumulator = StreamingMetrics([Metric.Pearson, Metric.Spearman])
+        accumulator.update(scores[start:end], golds[start:end], scores[start:end])
+        merged.merge(accumulator)
+    result = merged.compute()
+    assert np.allclose(result['Pearson'], expected['Pearson'])
+    assert np.allclose(result['Spearman'], expected['Spearman'])
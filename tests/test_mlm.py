@@ -0,0 +1,162 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import collections
+import random
+import numpy as np
+from experiments.mlm.mlm_utils import build_mlm_vocab, truncate_seq_pair, truncate_seq_pair_ids
+from experiments.mlm.mlm_utils import create_masked_lm_predictions_ids, create_instance_from_document_ids
+
+
+class FakeTokenizer(object):
+    def __init__(self):
+        tokens = ['[PAD]', '[CLS]', '[SEP]', '[MASK]'] + ['w%d' % i for i in range(20)] + ['##s%d' % i for i in range(10)]
+        self.vocab = collections.OrderedDict((token, idx) for idx, token in enumerate(tokens))
+
+
+VOCAB = build_mlm_vocab(FakeTokenizer())
+WORD, SUB = 4, 24
+
+
+def test_truncate_lengths_match_reference():
+    rng = np.random.default_rng(0)
+    for len_a, len_b, max_num in [(10, 3, 8), (3, 10, 8), (6, 6, 9), (7, 6, 9), (2, 2, 9), (5, 9, 5)]:
+        ref_a, ref_b = list(range(len_a)), list(range(len_b))
+        truncate_seq_pair(ref_a, ref_b, max_num, random.Random(0))
+        ids_a, ids_b = truncate_seq_pair_ids(np.arange(len_a), np.arange(len_b), max_num, rng)
+        assert (len(ids_a), len(ids_b)) == (len(ref_a), len(ref_b))
+
+
+def test_whole_word_masking():
+    rng = np.random.default_rng(1)
+    # words: w, w ##s ##s, w ##s, ...
+    ids = [VOCAB.cls_id]
+    for i in range(30):
+        ids.append(WORD + i % 20)
+        ids.extend([SUB + j for j in range(i % 3)])
+    ids.append(VOCAB.sep_id)
+    ids = np.array(ids)
+    for _ in range(20):
+        output, positions, labels = create_masked_lm_predictions_ids(ids, 0.15, 20, VOCAB, rng)
+        num_to_predict = min(20, max(1, int(round(len(ids) * 0.15))))
+        assert 0 < len(positions) <= num_to_predict
+        assert np.all(np.diff(positions) > 0)
+        assert np.array_equal(labels, ids[positions])
+        assert VOCAB.cls_id not in labels and VOCAB.sep_id not in labels
+        masked = set(positions.tolist())
+        for pos in positions:
+            # a masked word piece implies the whole word is masked
+            start = pos
+            while VOCAB.is_subword[ids[start]]:
+                start -= 1
+                assert start in masked
+            end = pos + 1
+            while end < len(ids) and VOCAB.is_subword[ids[end]]:
+                assert end in masked
+                end += 1
+        unmasked = np.ones(len(ids), dtype=bool)
+        unmasked[positions] = False
+        assert np.array_equal(output[unmasked], ids[unmasked])
+
+
+def test_instance_from_document():
+    rng = np.random.default_rng(2)
+    docs = [[np.arange(WORD, WORD + n) for n in (5, 7, 3, 9)] for _ in range(4)]
+    for idx in range(len(docs)):
+        for _ in range(10):
+            token_ids, segment_ids, positions, labels, is_random_next = create_instance_from_document_ids(
+                docs, idx, 16, 0.2, 0.15, 5, VOCAB, rng)
+            assert len(token_ids) == len(segment_ids) <= 16
+            assert token_ids[0] == VOCAB.cls_id and token_ids[-1] == VOCAB.sep_id
+            assert np.all(np.diff(segment_ids) >= 0) and segment_ids[-1] == 1
+            assert token_ids[segment_ids == 0][-1] == VOCAB.sep_id
+            assert 0 < len(positions) <= 5 and len(labels) == len(positions)
+
+
+def test_masked_positions_lm_head_matches_full():
+    import torch
+    from module.san import MaskLmHeader
+    from mt_dnn.loss import MlmCriterion
+    torch.manual_seed(0)
+    head = MaskLmHeader(torch.nn.Parameter(torch.randn(30, 8)))
+    hidden = torch.randn(2, 5, 8)
+    labels = torch.full((2, 5), -1, dtype=torch.long)
+    labels[0, 1], labels[1, 3], labels[1, 4] = 7, 2, 29
+    nsp = torch.LongTensor([0, 1])
+    masked_positions = torch.LongTensor([[1, -1], [3, 4]])
+    full_loss = MlmCriterion()(head(hidden), (labels, nsp))
+    mlm_out, nsp_out = head(hidden, masked_positions)
+    assert mlm_out.shape == (3, 30)
+    compact_loss = MlmCriterion()((mlm_out, nsp_out), (torch.LongTensor([7, 2, 29]), nsp))
+    assert torch.allclose(full_loss, compact_loss)
+
+
+def test_mlm_corpus_store(tmp_path):
+    import pickle
+    from data_utils.mlm_store import MLMCorpusWriter, MLMCorpusStore, mlm_store_path, is_mlm_store
+    from experiments.mlm.mlm_prepro import tokenize_document
+
+    class WordTokenizer(FakeTokenizer):
+        def tokenize(self, text):
+            return text.split()
+
+        def convert_tokens_to_ids(self, tokens):
+            return [self.vocab[token] for token in tokens]
+
+    tokenizer = WordTokenizer()
+    lines = ['{"text": "w1 w2 ##s1\\n\\nw3\\n\\n  "}', '{"text": ""}', '{"text": "w4 w5"}']
+    path = mlm_store_path(str(tmp_path / 'corpus_train.json'))
+    writer = MLMCorpusWriter(path, tokenizer.vocab, bert_model='fake')
+    for line in lines:
+        writer.add_document(tokenize_document(line, tokenizer))
+    writer.close()
+
+    assert is_mlm_store(path)
+    store = pickle.loads(pickle.dumps(MLMCorpusStore(path)))
+    assert len(store) == 2 and store.num_tokens == 6
+    assert [para.tolist() for para in store[0]] == [[5, 6, 25], [7]]
+    assert [para.tolist() for para in store[1]] == [[8, 9]]
+    assert build_mlm_vocab(store).is_subword.tolist() == VOCAB.is_subword.tolist()
+
+
+def _mlm_batch(task_def, seed):
+    from mt_dnn.batcher import Collater
+    rnd = random.Random(seed)
+    batch = []
+    for i in range(4):
+        length = rnd.randint(6, 12)
+        position = sorted(rnd.sample(range(1, length - 1), rnd.randint(0, 3)))
+        label = [-1] * length
+        for pos in position:
+            label[pos] = rnd.randint(5, 99)
+        sample = {'uid': i, 'token_id': [101] + [rnd.randint(5, 99) for _ in range(length - 2)] + [102],
+                  'type_id': [0] * length, 'nsp_lab': rnd.randint(0, 1), 'position': position, 'label': label}
+        batch.append({'task': {'task_id': 0, 'task_def': task_def}, 'sample': sample})
+    return Collater(is_train=True, dropout_w=0).collate_fn(batch)
+
+
+def test_masked_positions_split_with_the_batch(tiny_model):
+    import torch
+    from experiments.exp_def import TaskDefs
+    task_def = TaskDefs('experiments/mlm/mlm.yml').get_task_def('mlm')
+    model = tiny_model(task_def_list=[task_def], multi_gpu_on=True)
+    assert isinstance(model.mnetwork, torch.nn.DataParallel)
+    network = model.network.eval()
+    batch_meta, batch_data = _mlm_batch(task_def, seed=0)
+    inputs = batch_data[:batch_meta['input_len']]
+    masked_positions = batch_data[batch_meta['masked_positions']]
+    with torch.no_grad():
+        mlm_out, nsp_out = network(*inputs, None, None, 0, masked_positions=masked_positions)
+        # DataParallel scatters every tensor along the batch and concatenates the outputs
+        chunks = [network(*[part[rows] for part in inputs], None, None, 0, masked_positions=masked_positions[rows])
+                  for rows in (slice(0, 1), slice(1, 4))]
+        full_mlm, _ = network(*inputs, None, None, 0)
+    assert torch.allclose(torch.cat([chunk[0] for chunk in chunks]), mlm_out, atol=1e-6)
+    assert torch.allclose(torch.cat([chunk[1] for chunk in chunks]), nsp_out, atol=1e-6)
+    # the rows of the masked positions of the full sequence logits, sample by sample
+    valid = masked_positions >= 0
+    rows = valid.nonzero()[:, 0]
+    assert torch.allclose(full_mlm[rows, masked_positions[valid]], mlm_out, atol=1e-5)
+    assert mlm_out.size(0) == len(batch_data[batch_meta['label']][0])
+
+    model.update(batch_meta, batch_data)
+    assert model.updates == 1
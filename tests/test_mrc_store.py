@@ -0,0 +1,32 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import pickle
+import numpy as np
+from data_utils.mrc_store import MRCFeatureWriter, MRCFeatureStore, mrc_store_path, is_mrc_store
+
+
+def test_mrc_store_round_trip(tmp_path, mrc_feature):
+    path = mrc_store_path(str(tmp_path / 'squad_dev.json'))
+    writer = MRCFeatureWriter(path, vocab=['v%d' % i for i in range(16)])
+    idx = writer.add_example('q0', u'a b c d é', ['b c'])
+    writer.add_feature(idx, mrc_feature(0, 0, 3, [0, 1, 2]))
+    writer.add_feature(idx, mrc_feature(0, 1, 3, [2, 3, 4]))
+    idx = writer.add_example('q1', 'x y', ['y'])
+    writer.add_feature(idx, mrc_feature(2, 0, 3, [0, 1]))
+    writer.close()
+
+    assert path.endswith('squad_dev.mrc') and is_mrc_store(path)
+    store = MRCFeatureStore(path)
+    assert len(store) == 3
+    assert list(store.seq_lens()) == [7, 7, 6]
+    sample = store[1]
+    assert sample['uid'] == 'q0' and sample['answer'] == ['b c']
+    assert sample['token_id'] == list(range(7))
+    assert sample['token_to_orig_map'].tolist() == [-1, -1, -1, 2, 3, 4, -1]
+    assert sample['token_is_max_context'].tolist() == [False, False, False, True, False, True, False]
+    assert (sample['example_index'], sample['doc_span_index'], sample['doc_offset']) == (0, 1, 3)
+    assert store.get_doc(sample['store_index']) == u'a b c d é'
+    assert store.convert_ids_to_tokens([1, 3]) == ['v1', 'v3']
+
+    subset = pickle.loads(pickle.dumps(store.select(np.array([2]))))
+    assert len(subset) == 1 and subset[0]['uid'] == 'q1'
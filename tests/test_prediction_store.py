@@ -0,0 +1,62 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import numpy as np
+from data_utils import load_score_file
+from data_utils.prediction_store import PredictionWriter, PredictionReader, prediction_path, is_prediction_store, \
+    merge_predictions, prediction_shard_path
+from experiments.glue.glue_utils import submit
+
+
+def test_classification_round_trip(tmp_path):
+    path = prediction_path(str(tmp_path / 'rte_dev_scores_epoch_0.json'))
+    rng = np.random.RandomState(0)
+    scores = rng.rand(10, 2).astype(np.float32)
+    writer = PredictionWriter(path)
+    for start in range(0, 10, 4):
+        batch = scores[start:start + 4]
+        writer.write(batch.argmax(1).tolist(), batch.reshape(-1).tolist(), list(range(start, start + len(batch))))
+    writer.close({'ACC': 50.0})
+
+    assert is_prediction_store(path)
+    reader = PredictionReader(path)
+    assert len(reader) == 10 and reader['metrics'] == {'ACC': 50.0}
+    assert np.array_equal(reader['scores'], scores)
+    assert reader['predictions'].tolist() == scores.argmax(1).tolist()
+    assert reader['uids'] == list(range(10))
+
+    score_dic = load_score_file(path, 2)
+    assert np.allclose(score_dic[3][1], scores[3]) and score_dic[3][0] == scores[3].argmax()
+
+    submit(str(tmp_path / 'rte.tsv'), reader, label_dict={0: 'entailment', 1: 'not_entailment'})
+    lines = open(str(tmp_path / 'rte.tsv')).read().splitlines()
+    assert len(lines) == 11 and lines[1].startswith('0\t')
+
+
+def test_ragged_scores_and_text_predictions(tmp_path):
+    path = str(tmp_path / 'squad.pred')
+    writer = PredictionWriter(path)
+    writer.write(['an answer', 'b'], [0.5, 0.25], ['q1', 'q2'])
+    writer.write([[1, 2, 3]], [0.1, 0.2, 0.3], ['q3'])
+    writer.close()
+    reader = PredictionReader(path)
+    assert reader.uids == ['q1', 'q2', 'q3']
+    assert reader.predictions == ['an answer', 'b', [1, 2, 3]]
+    assert [s.tolist() for s in reader.scores] == [[0.5], [0.25], np.float32([0.1, 0.2, 0.3]).tolist()]
+
+
+def test_merge_rank_shards(tmp_path):
+    path = str(tmp_path / 'squad.pred')
+    rows = [(['a', 'b'], [0.5, 0.25], [1, 2]), ([], [], []), ([[1, 2]], [0.1, 0.2], ['q3'])]
+    for rank, (predictions, scores, uids) in enumerate(rows):
+        writer = PredictionWriter(prediction_shard_path(path, rank))
+        writer.write(predictions, scores, uids)
+        writer.close()
+    merge_predictions(path, 3, {'EM': 50.0})
+
+    assert not any(os.path.exists(prediction_shard_path(path, rank)) for rank in range(3))
+    reader = PredictionReader(path)
+    assert len(reader) == 3 and reader.metrics == {'EM': 50.0}
+    assert reader.uids == ['1', '2', 'q3']
+    assert reader.predictions == ['a', 'b', [1, 2]]
+    assert [s.tolist() for s in reader.scores] == [[0.5], [0.25], np.float32([0.1, 0.2]).tolist()]
@@ -0,0 +1,17 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import subprocess
+import sys
+
+
+def test_model_classes_are_imported_on_lookup():
+    code = ("import sys\n"
+            "from pretrained_models import MODEL_CLASSES\n"
+            "import mt_dnn.model\n"
+            "assert 'transformers' not in sys.modules\n"
+            "assert 'tensorboardX' not in sys.modules and 'sklearn' not in sys.modules\n"
+            "assert sorted(MODEL_CLASSES) == ['albert', 'bert', 'roberta', 'san', 'xlm', 'xlnet']\n"
+            "config_class, model_class, tokenizer_class = MODEL_CLASSES['bert']\n"
+            "assert model_class.__name__ == 'BertModel'\n"
+            "assert MODEL_CLASSES['bert'][0] is config_class\n")
+    subprocess.check_call([sys.executable, '-c', code])
@@ -0,0 +1,78 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import copy
+import types
+import pytest
+import torch
+from data_utils.task_def import EncoderModelType
+from mt_dnn.pruning import importance_scores, select_pruned, prune_heads, prune_ffn, pruned_config
+
+
+@pytest.fixture
+def prunable_model(tiny_model):
+    def build(**kw):
+        kw.setdefault('num_attention_heads', 4)
+        return tiny_model(**kw)
+    return build
+
+
+def test_select_pruned():
+    scores = [torch.tensor([4.0, 1.0, 3.0]), torch.tensor([1.0, 2.0, 0.0])]
+    # normalized per layer; the last unit of a layer is kept
+    assert select_pruned(scores, 0.5) == [[1], [2, 0]]
+    assert select_pruned(scores, 1.0) == [[1, 2], [2, 0]]
+    assert select_pruned(scores, 0.0) == [[], []]
+
+
+def test_pruned_heads_match_head_mask(prunable_model, tiny_batch):
+    network = prunable_model().network.eval()
+    batch_meta, batch_data = tiny_batch(0, network.task_def_list[0], seed=0)
+    token_ids, type_ids, mask = batch_data[:3]
+    prune_heads(network, [[1], [0, 3]])
+    # indices among the remaining heads: the second one of layer 0 is head 2
+    prune_heads(network, [[1], []])
+    assert network.bert.encoder.layer[0].attention.self.num_attention_heads == 2
+    assert sorted(network.bert.config.pruned_heads[0]) == [1, 2]
+    head_mask = torch.ones(2, 4)
+    head_mask[0, 1] = head_mask[0, 2] = head_mask[1, 0] = head_mask[1, 3] = 0
+    full = prunable_model().network.eval()
+    with torch.no_grad():
+        expected = full.bert(token_ids, attention_mask=mask, token_type_ids=type_ids, head_mask=head_mask)[0]
+        pruned = network.bert(token_ids, attention_mask=mask, token_type_ids=type_ids)[0]
+    assert torch.allclose(pruned, expected, atol=1e-5)
+
+
+def test_pruned_checkpoint_loads_with_smaller_weights(prunable_model, tiny_batch):
+    model = prunable_model()
+    task_def = model.config['task_def_list'][0]
+    batches = [tiny_batch(0, task_def, seed=seed) for seed in range(3)]
+    head_scores, ffn_scores = importance_scores(model, batches)
+    assert [len(score) for score in head_scores] == [4, 4]
+    assert [len(score) for score in ffn_scores] == [32, 32]
+    assert all((score >= 0).all() and score.sum() > 0 for score in head_scores + ffn_scores)
+    assert all(p.grad is None or not p.grad.any() for p in model.network.parameters())
+
+    prune_heads(model.network, select_pruned(head_scores, 0.5))
+    prune_ffn(model.network, select_pruned(ffn_scores, 0.5))
+    config = pruned_config(model.config, model.network)
+    assert sum(config['intermediate_sizes']) == 32
+    assert sum(len(heads) for heads in config['pruned_heads'].values()) == 4
+
+    state = copy.deepcopy(model.network.state_dict())
+    reloaded = prunable_model(state=state, **config)
+    assert reloaded.network.bert.encoder.layer[0].intermediate.dense.weight.size(0) == config['intermediate_sizes'][0]
+    batch_meta, batch_data = tiny_batch(0, task_def, seed=5)
+    inputs = batch_data[:3] + [None, None, 0]
+    with torch.no_grad():
+        assert torch.allclose(reloaded.network.eval()(*inputs), model.network.eval()(*inputs), atol=1e-6)
+    # the pruned model trains
+    reloaded.update(*tiny_batch(0, task_def, seed=6))
+
+
+def test_pruning_needs_a_layered_encoder():
+    # XLNet has no encoder.layer
+    network = types.SimpleNamespace(encoder_type=EncoderModelType.XLNET)
+    with pytest.raises(ValueError):
+        prune_heads(network, [[0]])
+    with pytest.raises(ValueError):
+        prune_ffn(network, [[0]])
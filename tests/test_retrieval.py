@@ -0,0 +1,109 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import os
+import random
+import tempfile
+import numpy as np
+import torch
+import torch.nn.functional as F
+from data_utils.metrics import Metric
+from data_utils.task_def import DataFormat, TaskType
+from experiments.exp_def import TaskDef
+from mt_dnn.batcher import Collater
+from mt_dnn.loss import LossCriterion
+from mt_dnn.retrieval import CandidateIndex, build_ivf, candidate_writer, encode_candidates, join_pair, \
+    sequence_batches
+
+
+def _ranking_task_def():
+    return TaskDef(None, 1, DataFormat.PremiseAndMultiHypothesis, TaskType.Ranking, (Metric.ACC,), ['dev'], False, None,
+                   LossCriterion.RankCeCriterion, None, None)
+
+
+def _sequence(rnd, length):
+    return [101] + [rnd.randint(5, 99) for _ in range(length - 2)] + [102]
+
+
+def _ranking_batch(task_def, seed, pairwise_size=3, is_train=True):
+    rnd = random.Random(seed)
+    batch = []
+    for i in range(2):
+        premise = _sequence(rnd, rnd.randint(3, 6))
+        hypotheses = [_sequence(rnd, rnd.randint(3, 8)) for _ in range(pairwise_size)]
+        pairs = [join_pair(premise, hypothesis) for hypothesis in hypotheses]
+        sample = {'uid': str(i), 'label': rnd.randint(0, pairwise_size - 1),
+                  'token_id': [pair['token_id'] for pair in pairs], 'type_id': [pair['type_id'] for pair in pairs],
+                  'ruid': ['{}_{}'.format(i, j) for j in range(pairwise_size)], 'olabel': [0] * pairwise_size}
+        batch.append({'task': {'task_id': 0, 'task_def': task_def}, 'sample': sample})
+    return batch, Collater(is_train=is_train, dropout_w=0, bi_encoder=True).collate_fn(batch)
+
+
+def test_split_pair():
+    assert Collater.split_pair([101, 7, 8, 102, 9, 102]) == ([101, 7, 8, 102], [101, 9, 102])
+    # RoBERTa: <s> premise </s></s> hypothesis </s>
+    assert Collater.split_pair([0, 7, 2, 2, 9, 10, 2]) == ([0, 7, 2], [0, 9, 10, 2])
+
+
+def test_bi_encoder_ranking(tiny_model):
+    task_def = _ranking_task_def()
+    model = tiny_model(task_def_list=[task_def])
+    batch, (batch_meta, batch_data) = _ranking_batch(task_def, seed=0)
+    # the premises once, the hypotheses of every pair
+    assert batch_data[batch_meta['token_id']].size(0) == 2
+    assert batch_data[batch_meta['candidates']][0].size(0) == 6
+    model.update(batch_meta, batch_data)
+
+    batch, (batch_meta, batch_data) = _ranking_batch(task_def, seed=1, is_train=False)
+    with torch.no_grad():
+        logits = model.predict_logits(batch_meta, batch_data)
+        score, predict, _ = model.decode(batch_meta, batch_data, logits)
+        for i, sample in enumerate(batch):
+            sample = sample['sample']
+            premise = Collater.split_pair(sample['token_id'][0])[0]
+            hypotheses = [Collater.split_pair(pair)[1] for pair in sample['token_id']]
+            hypotheses = [{'uid': j, 'token_id': tokens, 'type_id': [0] * len(tokens)} for j, tokens in enumerate(hypotheses)]
+            embeddings = [model.embed(*next(sequence_batches(samples, 8)))
+                          for samples in ([{'uid': 'q', 'token_id': premise, 'type_id': [0] * len(premise)}], hypotheses)]
+            expected = (embeddings[1] @ embeddings[0][0]) / model.network.bi_encoder_temperature
+            assert torch.allclose(logits.view(2, 3)[i], expected, atol=1e-5)
+    assert torch.allclose(score.view(2, 3).sum(1), torch.ones(2))
+    assert predict.view(2, 3).sum(1).tolist() == [1, 1]
+
+
+def test_candidate_index():
+    rng = np.random.default_rng(0)
+    vectors = F.normalize(torch.from_numpy(rng.standard_normal((50, 8)).astype(np.float32)), dim=-1)
+    queries = F.normalize(torch.from_numpy(rng.standard_normal((4, 8)).astype(np.float32)), dim=-1)
+
+    class Embedder(object):
+        device = torch.device('cpu')
+
+        def embed(self, batch_meta, batch_data):
+            return vectors[batch_data[0][:, 1] - 1]
+
+    samples = [{'uid': 'c{}'.format(i), 'token_id': [101, i + 1, 102], 'type_id': [0, 0, 0]} for i in range(50)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'index')
+        writer = candidate_writer(path, 8, shard_rows=16)
+        assert encode_candidates(Embedder(), sequence_batches(samples, 7), writer) == 50
+        writer.close()
+        index = CandidateIndex(path, chunk_rows=10)
+        assert index.num_shards == 3
+        scores, rows = index.search(queries, 5)
+        expected_scores, expected_rows = (queries @ vectors.t()).topk(5, dim=1)
+        assert torch.equal(rows, expected_rows)
+        assert torch.allclose(scores, expected_scores, atol=1e-6)
+        assert index.uids[rows[0, 0].item()] == 'c{}'.format(expected_rows[0, 0].item())
+
+        index = build_ivf(index, 4, sample_rows=40)
+        assert index.ivf['offsets'][-1] == 50 and sorted(index.ivf['rows'].tolist()) == list(range(50))
+        # every list probed is exhaustive
+        scores, rows = index.search(queries, 5, nprobe=4)
+        assert torch.equal(rows, expected_rows)
+        scores, rows = index.search(queries, 5, nprobe=1)
+        found = rows >= 0
+        assert found.any()
+        assert torch.allclose(scores[found], (queries.unsqueeze(1) * vectors[rows.clamp(min=0)]).sum(-1)[found], atol=1e-6)
+        # a new candidate store drops the index of the old one
+        candidate_writer(path, 8).close()
+        assert CandidateIndex(path).ivf is None
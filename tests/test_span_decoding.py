@@ -0,0 +1,42 @@
+# coding=utf-8
+# Copyright (c) Microsoft. All rights reserved.
+import torch
+from experiments.squad.squad_utils import decode_spans, span_band_mask
+
+
+def brute_force_best_span(start, end, word_map, max_context, max_len):
+    start_p = torch.softmax(start.masked_fill(~((word_map >= 0) & max_context), -1e5), 0)
+    end_p = torch.softmax(end.masked_fill(word_map < 0, -1e5), 0)
+    best = (-1.0, None, None)
+    for s in range(len(start)):
+        for e in range(s, min(s + max_len, len(start))):
+            score = (start_p[s] * end_p[e]).item()
+            if score > best[0]:
+                best = (score, s, e)
+    return best
+
+
+def test_decode_spans_matches_brute_force():
+    torch.manual_seed(1)
+    batch_size, seq_len, max_len = 6, 24, 4
+    start, end = torch.randn(batch_size, seq_len), torch.randn(batch_size, seq_len)
+    word_map = torch.full((batch_size, seq_len), -1, dtype=torch.long)
+    max_context = torch.zeros(batch_size, seq_len, dtype=torch.bool)
+    for i in range(batch_size):
+        doc_offset, doc_len = 3 + i, seq_len - 6 - i
+        word_map[i, doc_offset:doc_offset + doc_len] = torch.arange(doc_len) // 2
+        max_context[i, doc_offset + i:doc_offset + doc_len] = True
+    scores, s_idx, e_idx = decode_spans(start, end, word_map, max_context, max_len, topk=3)
+    assert scores.size() == (batch_size, 3)
+    for i in range(batch_size):
+        score, s, e = brute_force_best_span(start[i], end[i], word_map[i], max_context[i], max_len)
+        assert (s_idx[i, 0].item(), e_idx[i, 0].item()) == (s, e)
+        assert abs(scores[i, 0].item() - score) < 1e-5
+        assert (scores[i, :-1] >= scores[i, 1:]).all()
+
+
+def test_span_band_mask_is_sliced_from_cache():
+    big = span_band_mask(16, 3, torch.device('cpu'))
+    small = span_band_mask(5, 3, torch.device('cpu'))
+    assert torch.equal(small, big[:5, :5])
+    assert small[1, 3] and not small[1, 4] and not small[2, 1]
@@ -4,22 +4,28 @@ import argparse
 import json
 import os
 import random
+import subprocess
+import sys
 from datetime import datetime
 from pprint import pprint
 import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader, BatchSampler
-from pretrained_models import *
-from tensorboardX import SummaryWriter
-#from torch.utils.tensorboard import SummaryWriter
+from pretrained_models import MODEL_CLASSES
 from experiments.exp_def import TaskDefs
 from mt_dnn.inference import eval_model, extract_encoding
+from data_utils.feature_store import FeatureWriter, DTYPES
+from data_utils.prediction_store import PredictionWriter, PredictionReader, prediction_path, prediction_shard_path, \
+    merge_predictions
 from data_utils.log_wrapper import create_logger
+from data_utils.mrc_store import prepared_data_exists
 from data_utils.task_def import EncoderModelType
-from data_utils.utils import set_environment
+from data_utils.utils import set_environment, distributed_env, init_distributed
 from mt_dnn.batcher import SingleTaskDataset, MultiTaskDataset, Collater, MultiTaskBatchSampler, DistMultiTaskBatchSampler, DistSingleTaskBatchSampler
 from mt_dnn.batcher import DistTaskDataset
+from mt_dnn.matcher import EXIT_CRITERIA
 from mt_dnn.model import MTDNNModel
+from eval_worker import DONE_FILE
 
 
 def model_config(parser):
@@ -51,6 +57,28 @@ def model_config(parser):
     parser.add_argument('--encoder_type', type=int, default=EncoderModelType.BERT)
     parser.add_argument('--num_hidden_layers', type=int, default=-1)
 
+    # early exit
+    parser.add_argument('--early_exit', action='store_true',
+                        help='train exit heads on the encoder layers for classification/regression tasks')
+    parser.add_argument('--exit_loss_weight', type=float, default=1.0)
+    parser.add_argument('--exit_distill', action='store_true',
+                        help='train the exit heads on the task head output instead of the labels')
+    parser.add_argument('--exit_criterion', type=str, default='entropy', choices=EXIT_CRITERIA,
+                        help='when a sample leaves the encoder at inference; none runs every layer')
+    parser.add_argument('--exit_entropy', type=float, default=0.3,
+                        help='entropy criterion: exit once the class distribution entropy is below this')
+    parser.add_argument('--exit_patience', type=int, default=3,
+                        help='patience criterion: exit once the prediction is the same for this many more layers')
+    parser.add_argument('--exit_tolerance', type=float, default=0.01,
+                        help='patience criterion of regression tasks: largest change of the same prediction')
+    parser.add_argument('--exit_compact', action='store_true',
+                        help='drop the finished samples from the batch instead of running it until all are finished')
+
+    # bi-encoder ranking, see mt_dnn/retrieval.py
+    parser.add_argument('--bi_encoder', action='store_true',
+                        help='ranking tasks encode premise and hypothesis separately and score their cosine')
+    parser.add_argument('--bi_encoder_temperature', type=float, default=0.05)
+
     # BERT pre-training
     parser.add_argument('--bert_model_type', type=str, default='bert-base-uncased')
     parser.add_argument('--do_lower_case', action='store_true')
@@ -68,7 +96,7 @@ def model_config(parser):
     parser.add_argument("--world_size", type=int, default=1, help="For distributed training: world size")
     parser.add_argument("--master_addr", type=str, default="localhost")
     parser.add_argument("--master_port", type=str, default="6600")
-    parser.add_argument("--backend", type=str, default="nccl")
+    parser.add_argument("--backend", type=str, default=None, help="nccl/gloo, defaults to nccl on GPU and gloo on CPU")
     return parser
 
 
@@ -84,6 +112,14 @@ def data_config(parser):
     parser.add_argument('--train_datasets', default='mnli')
     parser.add_argument('--test_datasets', default='mnli_matched,mnli_mismatched')
     parser.add_argument('--glue_format_on', action='store_true')
+    parser.add_argument('--prediction_dump_off', action='store_true',
+                        help='only write the metrics to the score files, not the predictions/scores/uids')
+    parser.add_argument('--prediction_format', type=str, default='json', choices=['json', 'binary'],
+                        help='binary streams predictions to a memory-mappable .pred directory (data_utils/prediction_store.py)')
+    parser.add_argument('--score_mode', type=str, default='full', choices=['full', 'top1', 'none'],
+                        help='scores kept in the prediction dumps: all classes, the predicted class or none')
+    parser.add_argument('--metric_sample_size', type=int, default=0,
+                        help='>0 to compute Spearman/AUC on a reservoir sample of this size instead of all predictions')
     parser.add_argument('--mkd-opt', type=int, default=0, 
                         help=">0 to turn on knowledge distillation, requires 'softlabel' column in input data")
     parser.add_argument('--do_padding', action='store_true')
@@ -93,9 +129,17 @@ def data_config(parser):
 def train_config(parser):
     parser.add_argument('--cuda', type=bool, default=torch.cuda.is_available(),
                         help='whether to use GPU acceleration.')
+    parser.add_argument('--ddp_find_unused', action='store_true',
+                        help='let DDP search unused parameters every step instead of giving idle task heads zero gradients')
     parser.add_argument('--log_per_updates', type=int, default=500)
     parser.add_argument('--save_per_updates', type=int, default=10000)
     parser.add_argument('--save_per_updates_on', action='store_true')
+    parser.add_argument('--async_eval', action='store_true',
+                        help='evaluate the saved checkpoints in a separate eval_worker.py process instead of pausing training')
+    parser.add_argument('--async_eval_devices', type=str, default=None,
+                        help='CUDA_VISIBLE_DEVICES of the evaluation process, empty for CPU')
+    parser.add_argument('--defer_test_eval', action='store_true',
+                        help='score the test sets only at the end of training')
     parser.add_argument('--epochs', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=8)
     parser.add_argument('--batch_size_eval', type=int, default=8)
@@ -109,6 +153,11 @@ def train_config(parser):
     parser.add_argument('--warmup', type=float, default=0.1)
     parser.add_argument('--warmup_schedule', type=str, default='warmup_linear')
     parser.add_argument('--adam_eps', type=float, default=1e-6)
+    # EMA of weights
+    parser.add_argument('--ema_opt', type=int, default=0, help='>0 to keep an EMA of weights, used for evaluation')
+    parser.add_argument('--ema_gamma', type=float, default=0.995)
+    parser.add_argument('--ema_per_updates', type=int, default=1, help='update the EMA every k updates')
+    parser.add_argument('--ema_offload', action='store_true', help='keep the EMA weights in pinned host memory')
 
     parser.add_argument('--vb_dropout', action='store_false')
     parser.add_argument('--dropout_p', type=float, default=0.1)
@@ -149,6 +198,10 @@ def train_config(parser):
     parser.add_argument('--adv_noise_var', default=1e-5, type=float)
     parser.add_argument('--adv_epsilon', default=1e-6, type=float)
     parser.add_argument('--encode_mode', action='store_true', help="only encode test data")
+    parser.add_argument('--encode_dtype', type=str, default='float32', choices=DTYPES,
+                        help='precision of the encodings written in encode mode')
+    parser.add_argument('--encode_shard_rows', type=int, default=1000000,
+                        help='tokens per encoding shard')
     parser.add_argument('--debug', action='store_true', help="print debug info")
     return parser
 
@@ -159,6 +212,10 @@ parser = model_config(parser)
 parser = train_config(parser)
 
 args = parser.parse_args()
+# the bi-encoder batches carry their candidates beside the inputs: the adversarial pass reruns the
+# inputs without them, and DataParallel would split the queries and the candidates differently
+assert not (args.bi_encoder and args.adv_train), '--bi_encoder does not support --adv_train'
+assert not (args.bi_encoder and args.multi_gpu_on), '--bi_encoder does not support --multi_gpu_on'
 
 output_dir = args.output_dir
 data_dir = args.data_dir
@@ -188,12 +245,24 @@ def evaluation(model, datasets, data_list, task_defs, output_dir='checkpoints',
     else:
         updates_str = "epoch"
     updates = model.updates if n_updates > 0 else epoch
+    model.ema_eval()
+    binary_dump = args.prediction_format == 'binary' and not args.prediction_dump_off
+    # the GLUE submission is read back from the binary store
+    keep_predictions = not (args.prediction_dump_off or binary_dump) or (glue_format_on and not binary_dump)
+    # the ranks evaluate their shards; rank 0 gets the metrics of all ranks, and the outputs unless
+    # each rank writes its own binary store, merged by rank 0
+    dist_gather = args.local_rank != -1
     for idx, dataset in enumerate(datasets):
         prefix = dataset.split('_')[0]
         task_def = task_defs.get_task_def(prefix)
         label_dict = task_def.label_vocab
         test_data = data_list[idx]
         if test_data is not None:
+            score_file = os.path.join(output_dir, '{}_{}_scores_{}_{}.json'.format(dataset, test_prefix.lower(), updates_str, updates))
+            prediction_writer = None
+            if binary_dump:
+                store = prediction_path(score_file)
+                prediction_writer = PredictionWriter(prediction_shard_path(store, args.rank) if dist_gather else store)
             with torch.no_grad():
                 test_metrics, test_predictions, test_scores, test_golds, test_ids= eval_model(model,
                                                                                 test_data,
@@ -201,7 +270,12 @@ def evaluation(model, datasets, data_list, task_defs, output_dir='checkpoints',
                                                                                 device=device,
                                                                                 with_label=with_label,
                                                                                 label_mapper=label_dict,
-                                                                                task_type=task_def.task_type)
+                                                                                task_type=task_def.task_type,
+                                                                                keep_predictions=keep_predictions,
+                                                                                rank_sample_size=args.metric_sample_size,
+                                                                                prediction_writer=prediction_writer,
+                                                                                score_mode=args.score_mode,
+                                                                                dist_gather=dist_gather)
             for key, val in test_metrics.items():
                 if tensorboard:
                     tensorboard.add_scalar('{}/{}/{}'.format(test_prefix, dataset, key), val, global_step=updates)
@@ -213,43 +287,51 @@ def evaluation(model, datasets, data_list, task_defs, output_dir='checkpoints',
                     test_metrics[key] = str(val)
                     print_message(logger, 'Task {0} -- {1} {2} -- {3} {4}: \n{5}'.format(dataset, updates_str, updates, test_prefix, key, val), level=1)
 
-            if args.local_rank in [-1, 0]:
-                score_file = os.path.join(output_dir, '{}_{}_scores_{}_{}.json'.format(dataset, test_prefix.lower(), updates_str, updates))
+            if prediction_writer is not None:
+                prediction_writer.close(None if dist_gather else test_metrics)
+                if dist_gather:
+                    torch.distributed.barrier()
+            if args.rank == 0:
                 results = {'metrics': test_metrics, 'predictions': test_predictions, 'uids': test_ids, 'scores': test_scores}
-                dump(score_file, results)
+                if prediction_writer is not None:
+                    if dist_gather:
+                        merge_predictions(prediction_path(score_file), args.world_size, test_metrics)
+                    results = PredictionReader(prediction_path(score_file))
+                elif args.prediction_dump_off:
+                    dump(score_file, {'metrics': test_metrics})
+                else:
+                    dump(score_file, results)
                 if glue_format_on:
                     from experiments.glue.glue_utils import submit
                     official_score_file = os.path.join(output_dir, '{}_{}_scores_{}.tsv'.format(dataset, test_prefix.lower(), updates_str))
                     submit(official_score_file, results, label_dict)
+    model.ema_train()
+
 def initialize_distributed(args):
     """Initialize torch.distributed."""
-    args.rank = int(os.getenv('RANK', '0'))
-    args.world_size = int(os.getenv("WORLD_SIZE", '1'))
-
-    if os.getenv('OMPI_COMM_WORLD_LOCAL_RANK'):
-        # We are using (OpenMPI) mpirun for launching distributed data parallel processes
-        local_rank = int(os.getenv('OMPI_COMM_WORLD_LOCAL_RANK'))
-        local_size = int(os.getenv('OMPI_COMM_WORLD_LOCAL_SIZE'))
-        args.local_rank = local_rank
-        args.rank = nodeid * local_size + local_rank
-        args.world_size = num_nodes * local_size
-    #args.batch_size = args.batch_size * args.world_size
-
-    device = args.rank % torch.cuda.device_count()
-    if args.local_rank is not None:
-        device = args.local_rank
-    torch.cuda.set_device(device)
-    device = torch.device('cuda', args.local_rank)
-    # Call the init process
-    init_method = 'tcp://'
-    master_ip = os.getenv('MASTER_ADDR', 'localhost')
-    master_port = os.getenv('MASTER_PORT', '6600')
-    init_method += master_ip + ':' + master_port
-    torch.distributed.init_process_group(
-        backend=args.backend,
-        world_size=args.world_size, rank=args.rank,
-        init_method=init_method)
-    return device
+    return init_distributed(args.rank, args.local_rank, args.local_size, args.world_size,
+                            backend=args.backend, use_cuda=args.cuda)
+
+def start_eval_worker(args):
+    """eval_worker.py watching output_dir; it exits after DONE_FILE is written"""
+    done_file = os.path.join(output_dir, DONE_FILE)
+    if os.path.exists(done_file):
+        os.remove(done_file)
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eval_worker.py'),
+           '--output_dir', output_dir, '--data_dir', data_dir, '--task_def', args.task_def,
+           '--test_datasets', ','.join(args.test_datasets), '--max_seq_len', str(args.max_seq_len),
+           '--batch_size_eval', str(args.batch_size_eval), '--prediction_format', args.prediction_format,
+           '--score_mode', args.score_mode, '--log_file', os.path.join(output_dir, 'eval_worker.log')]
+    if args.defer_test_eval:
+        cmd.append('--skip_test')
+    if args.glue_format_on:
+        cmd.append('--glue_format_on')
+    if args.tensorboard:
+        cmd.extend(['--tensorboard', '--tensorboard_logdir', args.tensorboard_logdir])
+    env = dict(os.environ)
+    if args.async_eval_devices is not None:
+        env['CUDA_VISIBLE_DEVICES'] = args.async_eval_devices
+    return subprocess.Popen(cmd, env=env)
 
 def print_message(logger, message, level=0):
     if torch.distributed.is_initialized():
@@ -267,7 +349,7 @@ def print_message(logger, message, level=0):
 
 def main():
     # set up dist
-    device = torch.device("cuda")
+    args.rank, args.local_rank, args.local_size, args.world_size = distributed_env(args.local_rank, args.world_size)
     if args.local_rank > -1:
         device = initialize_distributed(args)
     elif torch.cuda.is_available():
@@ -284,7 +366,9 @@ def main():
     tasks = {}
     task_def_list = []
     dropout_list = []
-    printable = args.local_rank in [-1, 0]
+    printable = args.rank == 0
+    # each rank only loads its shard of the training data
+    num_shards = args.world_size if args.local_rank != -1 else 1
 
     train_datasets = []
     for dataset in args.train_datasets:
@@ -297,12 +381,18 @@ def main():
         task_def_list.append(task_def)
         train_path = os.path.join(data_dir, '{}_train.json'.format(dataset))
         print_message(logger, 'Loading {} as task {}'.format(train_path, task_id))
-        train_data_set = SingleTaskDataset(train_path, True, maxlen=args.max_seq_len, task_id=task_id, task_def=task_def, printable=printable)
+        train_data_set = SingleTaskDataset(train_path, True, maxlen=args.max_seq_len, task_id=task_id, task_def=task_def,
+                                           bert_model=args.bert_model_type, do_lower_case=args.do_lower_case,
+                                           masked_lm_prob=args.masked_lm_prob, seed=args.seed, short_seq_prob=args.short_seq_prob,
+                                           max_seq_length=args.max_seq_len, max_predictions_per_seq=args.max_predictions_per_seq,
+                                           printable=printable, shard_rank=args.rank % num_shards, num_shards=num_shards)
         train_datasets.append(train_data_set)
-    train_collater = Collater(dropout_w=args.dropout_w, encoder_type=encoder_type, soft_label=args.mkd_opt > 0, max_seq_len=args.max_seq_len, do_padding=args.do_padding)
+    train_collater = Collater(dropout_w=args.dropout_w, encoder_type=encoder_type, soft_label=args.mkd_opt > 0, max_seq_len=args.max_seq_len, do_padding=args.do_padding,
+                              bi_encoder=args.bi_encoder)
     multi_task_train_dataset = MultiTaskDataset(train_datasets)
     if args.local_rank != -1:
-        multi_task_batch_sampler = DistMultiTaskBatchSampler(train_datasets, args.batch_size, args.mix_opt, args.ratio, rank=args.local_rank, world_size=args.world_size)
+        multi_task_batch_sampler = DistMultiTaskBatchSampler(train_datasets, args.batch_size, args.mix_opt, args.ratio, rank=args.rank, world_size=args.world_size,
+                                                             sharded=True, seed=args.seed)
     else:
         multi_task_batch_sampler = MultiTaskBatchSampler(train_datasets, args.batch_size, args.mix_opt, args.ratio, bin_on=args.bin_on, bin_size=args.bin_size, bin_grow_ratio=args.bin_grow_ratio)
     multi_task_train_data = DataLoader(multi_task_train_dataset, batch_sampler=multi_task_batch_sampler, collate_fn=train_collater.collate_fn, pin_memory=args.cuda)
@@ -311,7 +401,8 @@ def main():
 
     dev_data_list = []
     test_data_list = []
-    test_collater = Collater(is_train=False, encoder_type=encoder_type, max_seq_len=args.max_seq_len, do_padding=args.do_padding)
+    test_collater = Collater(is_train=False, encoder_type=encoder_type, max_seq_len=args.max_seq_len, do_padding=args.do_padding,
+                             bi_encoder=args.bi_encoder)
     for dataset in args.test_datasets:
         prefix = dataset.split('_')[0]
         task_def = task_defs.get_task_def(prefix)
@@ -321,11 +412,11 @@ def main():
 
         dev_path = os.path.join(data_dir, '{}_dev.json'.format(dataset))
         dev_data = None
-        if os.path.exists(dev_path):
+        if prepared_data_exists(dev_path):
             dev_data_set = SingleTaskDataset(dev_path, False, maxlen=args.max_seq_len, task_id=task_id, task_def=task_def, printable=printable)
             if args.local_rank != -1:
                 dev_data_set = DistTaskDataset(dev_data_set, task_id)
-                single_task_batch_sampler = DistSingleTaskBatchSampler(dev_data_set, args.batch_size_eval, rank=args.local_rank, world_size=args.world_size)
+                single_task_batch_sampler = DistSingleTaskBatchSampler(dev_data_set, args.batch_size_eval, rank=args.rank, world_size=args.world_size)
                 dev_data = DataLoader(dev_data_set, batch_sampler=single_task_batch_sampler, collate_fn=test_collater.collate_fn, pin_memory=args.cuda)
             else:
                 dev_data = DataLoader(dev_data_set, batch_size=args.batch_size_eval, collate_fn=test_collater.collate_fn, pin_memory=args.cuda)
@@ -333,11 +424,11 @@ def main():
 
         test_path = os.path.join(data_dir, '{}_test.json'.format(dataset))
         test_data = None
-        if os.path.exists(test_path):
+        if prepared_data_exists(test_path):
             test_data_set = SingleTaskDataset(test_path, False, maxlen=args.max_seq_len, task_id=task_id, task_def=task_def, printable=printable)
             if args.local_rank != -1:
                 test_data_set = DistTaskDataset(test_data_set, task_id)
-                single_task_batch_sampler = DistSingleTaskBatchSampler(test_data_set, args.batch_size_eval, rank=args.local_rank, world_size=args.world_size)
+                single_task_batch_sampler = DistSingleTaskBatchSampler(test_data_set, args.batch_size_eval, rank=args.rank, world_size=args.world_size)
                 test_data = DataLoader(test_data_set, batch_sampler=single_task_batch_sampler, collate_fn=test_collater.collate_fn, pin_memory=args.cuda)
             else:
                 test_data = DataLoader(test_data_set, batch_size=args.batch_size_eval, collate_fn=test_collater.collate_fn, pin_memory=args.cuda)
@@ -417,17 +508,30 @@ def main():
     tensorboard = None
     if args.tensorboard:
         args.tensorboard_logdir = os.path.join(args.output_dir, args.tensorboard_logdir)
+        from tensorboardX import SummaryWriter
+        #from torch.utils.tensorboard import SummaryWriter
         tensorboard = SummaryWriter(log_dir=args.tensorboard_logdir)
     
     if args.encode_mode:
         for idx, dataset in enumerate(args.test_datasets):
             prefix = dataset.split('_')[0]
             test_data = test_data_list[idx]
+            # unpadded encodings, streamed to shards; read them with data_utils.feature_store.FeatureStore
+            encoding_dir = os.path.join(output_dir, '{}_encoding'.format(dataset))
+            if args.world_size > 1:
+                encoding_dir = '{}.{}'.format(encoding_dir, args.rank)
+            writer = FeatureWriter(encoding_dir, [-1], model.network.bert.config.hidden_size, dtype=args.encode_dtype,
+                                   shard_rows=args.encode_shard_rows)
             with torch.no_grad():
-                encoding = extract_encoding(model, test_data, use_cuda=args.cuda)
-            torch.save(encoding, os.path.join(output_dir, '{}_encoding.pt'.format(dataset)))
+                num_samples = extract_encoding(model, test_data, writer)
+            writer.close()
+            logger.info('Wrote the encodings of {} samples of {} to {}'.format(num_samples, dataset, encoding_dir))
         return
 
+    eval_worker = None
+    if args.async_eval and args.rank == 0:
+        eval_worker = start_eval_worker(args)
+
     for epoch in range(0, args.epochs):
         print_message(logger, 'At epoch {}'.format(epoch), level=1)
         start = datetime.now()
@@ -438,7 +542,11 @@ def main():
             model.update(batch_meta, batch_data)
 
             if (model.updates) % (args.log_per_updates) == 0 or model.updates == 1:
-                ramaining_time = str((datetime.now() - start) / (i + 1) * (len(multi_task_train_data) - i - 1)).split('.')[0]
+                model.sync_meters()
+                elapsed = datetime.now() - start
+                ramaining_time = str(elapsed / (i + 1) * (len(multi_task_train_data) - i - 1)).split('.')[0]
+                # samples per second over all ranks
+                throughput = (i + 1) * args.batch_size * args.world_size / max(elapsed.total_seconds(), 1e-6)
                 if args.adv_train and args.debug:
                     debug_info = ' adv loss[%.5f] emb val[%.8f] eff_perturb[%.8f] ' % (
                         model.adv_loss.avg,
@@ -447,28 +555,46 @@ def main():
                     )
                 else:
                     debug_info = ' '
-                print_message(logger, 'Task [{0:2}] updates[{1:6}] train loss[{2:.5f}]{3}remaining[{4}]'.format(task_id,
+                print_message(logger, 'Task [{0:2}] updates[{1:6}] train loss[{2:.5f}]{3}throughput[{4:.1f}/s] remaining[{5}]'.format(task_id,
                                                                                                     model.updates,
                                                                                                     model.train_loss.avg,
                                                                                                     debug_info,
+                                                                                                    throughput,
                                                                                                     ramaining_time))
                 if args.tensorboard:
                     tensorboard.add_scalar('train/loss', model.train_loss.avg, global_step=model.updates)
+                    for tid, task_meter in enumerate(model.meters.task_meters['train_loss']):
+                        if task_meter.count > 0:
+                            tensorboard.add_scalar('train/loss_task{}'.format(tid), task_meter.avg, global_step=model.updates)
 
 
-            if args.save_per_updates_on and ((model.local_updates) % (args.save_per_updates * args.grad_accumulation_step) == 0) and args.local_rank in [-1, 0]:
+            if args.save_per_updates_on and ((model.local_updates) % (args.save_per_updates * args.grad_accumulation_step) == 0):
                 model_file = os.path.join(output_dir, 'model_{}_{}.pt'.format(epoch, model.updates))
-                evaluation(model, args.test_datasets, dev_data_list, task_defs, output_dir, epoch, n_updates=args.save_per_updates, with_label=True, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=False, device=device, logger=logger)
-                evaluation(model, args.test_datasets, test_data_list, task_defs, output_dir, epoch, n_updates=args.save_per_updates, with_label=False, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=True, device=device, logger=logger)
-                print_message(logger, 'Saving mt-dnn model to {}'.format(model_file))
-                model.save(model_file)
-
-        evaluation(model, args.test_datasets, dev_data_list, task_defs, output_dir, epoch, with_label=True, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=False, device=device, logger=logger)
-        evaluation(model, args.test_datasets, test_data_list, task_defs, output_dir, epoch, with_label=False, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=True, device=device, logger=logger)
-        print_message(logger, '[new test scores at {} saved.]'.format(epoch))
-        if args.local_rank in [-1, 0]:
+                if not args.async_eval:
+                    # every rank evaluates its shard
+                    evaluation(model, args.test_datasets, dev_data_list, task_defs, output_dir, epoch, n_updates=args.save_per_updates, with_label=True, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=False, device=device, logger=logger)
+                    if not args.defer_test_eval:
+                        evaluation(model, args.test_datasets, test_data_list, task_defs, output_dir, epoch, n_updates=args.save_per_updates, with_label=False, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=True, device=device, logger=logger)
+                if args.rank == 0:
+                    print_message(logger, 'Saving mt-dnn model to {}'.format(model_file))
+                    model.save(model_file)
+
+        if not args.async_eval:
+            evaluation(model, args.test_datasets, dev_data_list, task_defs, output_dir, epoch, with_label=True, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=False, device=device, logger=logger)
+            if not args.defer_test_eval or epoch == args.epochs - 1:
+                evaluation(model, args.test_datasets, test_data_list, task_defs, output_dir, epoch, with_label=False, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=True, device=device, logger=logger)
+            print_message(logger, '[new test scores at {} saved.]'.format(epoch))
+        if args.rank == 0:
             model_file = os.path.join(output_dir, 'model_{}.pt'.format(epoch))
             model.save(model_file)
+    if args.async_eval and args.defer_test_eval:
+        # on every rank before rank 0 waits for the worker, the ranks gather the outputs together
+        evaluation(model, args.test_datasets, test_data_list, task_defs, output_dir, args.epochs - 1, with_label=False, tensorboard=tensorboard, glue_format_on=args.glue_format_on, test_on=True, device=device, logger=logger)
+    if eval_worker is not None:
+        # the worker evaluates the remaining checkpoints, then exits
+        open(os.path.join(output_dir, DONE_FILE), 'w').close()
+        print_message(logger, 'Waiting for the evaluation of the last checkpoints')
+        eval_worker.wait()
     if args.tensorboard:
         tensorboard.close()
 